@@ -0,0 +1,99 @@
+import argparse
+import configparser
+import json
+import logging
+from src.loading_config_utils import load_matrix, create_model_loader, load_AR_display_config, \
+    load_AR_display_options
+from src.render_profiles import RENDER_PROFILES, benchmark_render_profile, format_render_report
+from cl_benchmark_tracking import get_git_commit
+
+
+def create_benchmark_parser():
+    """
+    Creates the command line parser for the rendering benchmark.
+    :return: argparse.ArgumentParser()
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the overlay rendering of each render profile '
+                                                 'offscreen, with the models of the config')
+
+    parser.add_argument('--config_path',
+                        required=False,
+                        type=str,
+                        default='config/config.ini',
+                        help='path to config file containing the display settings.')
+
+    parser.add_argument("-p", "--profiles",
+                        required=False,
+                        nargs='+',
+                        choices=list(RENDER_PROFILES),
+                        default=list(RENDER_PROFILES),
+                        help="Render profiles timed. Defaults to all.")
+
+    parser.add_argument("-n", "--frames",
+                        required=False,
+                        type=int,
+                        default=200,
+                        help="Number of frames rendered per profile.")
+
+    parser.add_argument("--width",
+                        required=False,
+                        type=int,
+                        default=None,
+                        help="Video and window width. Defaults to twice the principal point x.")
+
+    parser.add_argument("--height",
+                        required=False,
+                        type=int,
+                        default=None,
+                        help="Video and window height. Defaults to twice the principal point y.")
+
+    parser.add_argument("-o", "--output",
+                        required=False,
+                        type=str,
+                        default=None,
+                        help="Path of a .json file the results are saved to.")
+
+    return parser
+
+
+def main():
+    """
+    Parses args and config, loads the models, then renders them with each profile and prints the timings.
+    """
+    logging.basicConfig(level=logging.INFO)
+    parser = create_benchmark_parser()
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config_path)
+
+    intrinsics_pth, distortion_pth, video_source, registration_matrix, models, rendering_defaults, frame_rate = \
+        load_AR_display_config(config)
+    display_args = load_AR_display_options(config)
+    intrinsics = load_matrix(name="intrinsics", path_to_file=intrinsics_pth, expected_shape=(3, 3))
+
+    # all models are drawn, hidden ones included, as any may be shown while the GUI runs
+    model_loader = create_model_loader(path_to_directory=models,
+                                       rendering_defaults=rendering_defaults,
+                                       cache_dir=display_args['model_cache'],
+                                       defer_hidden=False)
+    actors = [m.actor for m in model_loader.models]
+    for actor in actors:
+        actor.VisibilityOn()
+
+    frame_size = (args.width or int(round(2 * intrinsics[0, 2])),
+                  args.height or int(round(2 * intrinsics[1, 2])))
+
+    results = {name: benchmark_render_profile(actors, intrinsics, frame_size, RENDER_PROFILES[name],
+                                              frame_count=args.frames)
+               for name in args.profiles}
+    print(f"{len(actors)} models, {frame_size[0]}x{frame_size[1]}")
+    print(format_render_report(results))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': get_git_commit(), 'frame_size': frame_size, 'profiles': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
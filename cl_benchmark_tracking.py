@@ -0,0 +1,133 @@
+import argparse
+import configparser
+import logging
+import subprocess
+from src.loading_config_utils import load_matrix, load_AR_display_config, load_tracking_config, \
+    load_tool_config
+from src.tracking_benchmark import run_benchmark, format_report, save_results, load_results
+
+
+def create_benchmark_parser():
+    """
+    Creates the command line parser for the tracking benchmark.
+    :return: argparse.ArgumentParser()
+    """
+    parser = argparse.ArgumentParser(description='Benchmark detection and pose estimation on synthetic frames '
+                                                 'of the tracked tools, without a camera')
+
+    parser.add_argument('--config_path',
+                        required=False,
+                        type=str,
+                        default='config/config.ini',
+                        help='path to config file containing the aruco, tracking and calibration settings.')
+
+    parser.add_argument("-n", "--frames",
+                        required=False,
+                        type=int,
+                        default=300,
+                        help="Number of synthetic frames timed.")
+
+    parser.add_argument("--width",
+                        required=False,
+                        type=int,
+                        default=None,
+                        help="Frame width. Defaults to twice the principal point x.")
+
+    parser.add_argument("--height",
+                        required=False,
+                        type=int,
+                        default=None,
+                        help="Frame height. Defaults to twice the principal point y.")
+
+    parser.add_argument("--noise",
+                        required=False,
+                        type=float,
+                        default=0.0,
+                        help="Standard deviation of gaussian noise added to the frames (grey levels).")
+
+    parser.add_argument("--blur",
+                        required=False,
+                        type=float,
+                        default=0.0,
+                        help="Sigma of gaussian blur applied to the frames (pixels).")
+
+    parser.add_argument("--occlusion",
+                        required=False,
+                        type=float,
+                        default=0.0,
+                        help="Fraction of each board covered by a random rectangle.")
+
+    parser.add_argument("--seed",
+                        required=False,
+                        type=int,
+                        default=0,
+                        help="Random seed of the noise and occlusions.")
+
+    parser.add_argument("-o", "--output",
+                        required=False,
+                        type=str,
+                        default=None,
+                        help="Path of a .json file the results are saved to.")
+
+    parser.add_argument("--compare",
+                        required=False,
+                        type=str,
+                        default=None,
+                        help="Path of a .json file saved by an earlier run (eg. on another commit) to compare against.")
+
+    return parser
+
+
+def get_git_commit():
+    """
+    Returns the current git commit hash, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    """
+    Parses args and config, then runs the benchmark and prints the report.
+    """
+    logging.basicConfig(level=logging.INFO)
+    parser = create_benchmark_parser()
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config_path)
+
+    intrinsics_pth, distortion_pth, video_source, registration_matrix, models, rendering_defaults, frame_rate = \
+        load_AR_display_config(config)
+    tracking_args = load_tracking_config(config)
+
+    intrinsics = load_matrix(name="intrinsics", path_to_file=intrinsics_pth, expected_shape=(3, 3))
+    distortion = load_matrix(name="distortion", path_to_file=distortion_pth, expected_shape=(1, 5))
+
+    # the board, the pointer and the [TOOL:<name>] sections
+    tools = load_tool_config(config)
+
+    frame_size = None
+    if args.width and args.height:
+        frame_size = (args.width, args.height)
+
+    results = run_benchmark(tools, intrinsics, distortion, tracking_args,
+                            frame_count=args.frames, frame_size=frame_size,
+                            noise_std=args.noise, blur_sigma=args.blur, occlusion=args.occlusion,
+                            seed=args.seed)
+    results['commit'] = get_git_commit()
+
+    baseline = load_results(args.compare) if args.compare else None
+    if baseline:
+        print(f"Comparing commit {results['commit']} against {baseline.get('commit')}")
+    print(format_report(results, baseline))
+
+    if args.output:
+        save_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
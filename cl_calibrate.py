@@ -0,0 +1,75 @@
+import argparse
+import configparser
+import logging
+from src.loading_config_utils import load_tool_config, load_calibration_config
+from src.aruco_utils import create_aruco_board
+from src.batch_calibration import calibrate_from_source, save_calibration, format_calibration_report
+
+
+def create_calibration_parser():
+    """
+    Creates the command line parser for camera calibration.
+    :return: argparse.ArgumentParser()
+    """
+    parser = argparse.ArgumentParser(description='Calibrate the camera from recorded images or a video, '
+                                                 'or live, using the [CALIBRATION] section of the config')
+
+    parser.add_argument('--config_path',
+                        required=False,
+                        type=str,
+                        default='config/config.ini',
+                        help='path to config file containing the calibration and aruco settings.')
+
+    parser.add_argument("-s", "--source",
+                        required=False,
+                        type=str,
+                        help="Folder of calibration images, or video. Defaults to save_path_imgs in the config file.")
+
+    parser.add_argument("-w", "--workers",
+                        required=False,
+                        type=int,
+                        default=None,
+                        help="Number of worker processes. Defaults to the number of CPUs.")
+
+    return parser
+
+
+def main():
+    """
+    Parses args and config, calibrates and saves intrinsics.txt and distortion.txt.
+    """
+    logging.basicConfig(level=logging.INFO)
+    parser = create_calibration_parser()
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config_path)
+
+    calibration_args = load_calibration_config(config)
+    # the board of [ARUCO], with its marker ids, as tracked
+    _, board_args = load_tool_config(config)[0]
+
+    if calibration_args['run_live'] and not args.source:
+        if calibration_args['calibration_type'] != 'aruco':
+            raise ValueError("Live calibration only supports the aruco calibration type.")
+        # imported here, as live calibration opens the camera and a window
+        from src.calibration import calibrate_camera_intrinsics_with_aruco_board
+        intrinsics, distortion = calibrate_camera_intrinsics_with_aruco_board(create_aruco_board(**board_args))
+    else:
+        source = args.source if args.source else calibration_args['save_path_imgs']
+        result = calibrate_from_source(source,
+                                       calibration_args['calibration_type'],
+                                       board_args=board_args,
+                                       checkerboard_dims=calibration_args['checkerboard_dims'],
+                                       workers=args.workers,
+                                       frame_step=calibration_args['frame_step'],
+                                       max_views=calibration_args['max_views'],
+                                       bootstrap_samples=calibration_args['bootstrap_samples'])
+        print(format_calibration_report(result))
+        intrinsics, distortion = result['intrinsics'], result['distortion']
+
+    save_calibration(calibration_args['calibration_data'], intrinsics, distortion)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,8 @@
 
-import argparse, configparser
-from src.aruco_utils import generate_aruco_board_for_printing    
+import argparse, configparser, json
+from src.board_printing import generate_printable_boards, FORMATS
 from data.aruco_dict_types import ARUCO_DICT
-from src.loading_config_utils import load_aruco_config
+from src.loading_config_utils import load_tool_config, load_board_printing_config
 
 def add_aruco_args_to_parser(parser):
     parser.add_argument('--config_path', 
@@ -16,11 +16,6 @@ def add_aruco_args_to_parser(parser):
                         type=str, 
                         default="DICT_4X4_50", 
                         help='dictionary of aruco board- full list of options can be seen in data/aruco_dict_types.py')
-    parser.add_argument('--size_in_bits', 
-                        required=False,
-                        type=int, 
-                        default=4, 
-                        help='The size_in_bits variable must match the size of dictionary, i.e. DICT_4X4_50.')   
     parser.add_argument('--border_bits', 
                         required=False,
                         type=int, 
@@ -55,6 +50,25 @@ def add_aruco_args_to_parser(parser):
                         type=str, 
                         default='data/resources/aruco_boards/aruco_board.png', 
                         help='path where aruco board will be saved')    
+    parser.add_argument('--format',
+                        required=False,
+                        type=str,
+                        default='png',
+                        choices=FORMATS,
+                        help='svg or pdf for exact millimetre vector output, png for one image, '
+                             'tiles for png tiles of very large boards')
+    parser.add_argument('--board_list',
+                        required=False,
+                        type=str,
+                        default=None,
+                        help='json file with a list of boards to generate instead of the boards of the config. '
+                             'Each entry has aruco_dict (name), markers_w, markers_h, marker_length and save_path, '
+                             'and optionally border_bits, gap_between_markers_in_bits, pixels_per_bit and first_id.')
+    parser.add_argument('--workers',
+                        required=False,
+                        type=int,
+                        default=None,
+                        help='number of worker processes used to generate several boards. Defaults to the number of CPUs.')
     return parser
 
 
@@ -64,50 +78,51 @@ def main():
     args = parser.parse_args()
     
 
+    main_board = dict(aruco_dict=ARUCO_DICT[args.aruco_dict],
+                      border_bits=int(args.border_bits),
+                      gap_between_markers_in_bits=int(args.gap_between_markers_in_bits),
+                      marker_length=int(args.marker_length),
+                      markers_w=int(args.markers_w),
+                      markers_h=int(args.markers_h),
+                      pixels_per_bit=int(args.pixels_per_bit),
+                      save_path=args.save_path,
+                      output_format=args.format)
+
     if len(args.config_path) > 0:
         config = configparser.ConfigParser()
         config.read(args.config_path)
 
-        aruco_dict, size_in_bits, border_bits, gap_between_markers_in_bits, \
-            marker_length, markers_w, markers_h, pixels_per_bit, save_path, marker_separation, \
-            pointer_marker_length, pointer_markers_w, pointer_markers_h, pointer_marker_separation, \
-            pointer_aruco_dict, pointer_save_path \
-                  = load_aruco_config(config)
+        # every board tracked, the board first, with its marker ids
+        printing_args = load_board_printing_config(config)
+        boards = [dict(aruco_dict=board_args['aruco_dict_type'],
+                       border_bits=printing_args['border_bits'],
+                       gap_between_markers_in_bits=printing_args['gap_between_markers_in_bits'],
+                       marker_length=board_args['marker_length'],
+                       markers_w=board_args['markers_w'],
+                       markers_h=board_args['markers_h'],
+                       pixels_per_bit=printing_args['pixels_per_bit'],
+                       save_path=printing_args['save_paths'][name],
+                       output_format=args.format,
+                       first_id=board_args['first_id'])
+                  for name, board_args in load_tool_config(config)]
+        main_board = boards[0]
     else:
-        aruco_dict = ARUCO_DICT[args.aruco_dict]
-        size_in_bits = int(args.size_in_bits)
-        border_bits = int(args.border_bits)
-        gap_between_markers_in_bits = int(args.gap_between_markers_in_bits)
-        marker_length = int(args.marker_length)
-        markers_w = int(args.markers_w)
-        markers_h = int(args.markers_h)
-        pixels_per_bit = int(args.pixels_per_bit)
-        save_path = args.save_path
+        boards = [main_board]
 
-    generate_aruco_board_for_printing(
-        aruco_dict=aruco_dict,
-        size_in_bits=size_in_bits,
-        border_bits=border_bits,
-        gap_between_markers_in_bits=gap_between_markers_in_bits,
-        marker_length=marker_length,
-        markers_w=markers_w,
-        markers_h=markers_h,
-        pixels_per_bit=pixels_per_bit,
-        save_path=save_path
-    )
+    if args.board_list:
+        # entries override the main board settings
+        with open(args.board_list) as f:
+            entries = json.load(f)
+        boards = []
+        for entry in entries:
+            board = dict(main_board, **entry)
+            if isinstance(board['aruco_dict'], str):
+                board['aruco_dict'] = ARUCO_DICT[board['aruco_dict']]
+            boards.append(board)
+
+    for description in generate_printable_boards(boards, workers=args.workers):
+        print(description)
 
-    generate_aruco_board_for_printing(
-        aruco_dict=pointer_aruco_dict,
-        size_in_bits=size_in_bits,
-        border_bits=border_bits,
-        gap_between_markers_in_bits=gap_between_markers_in_bits,
-        marker_length=pointer_marker_length,
-        markers_w=pointer_markers_w,
-        markers_h=pointer_markers_h,
-        pixels_per_bit=pixels_per_bit,
-        save_path=pointer_save_path
-    )
-    
     return 
 
 
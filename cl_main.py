@@ -1,10 +1,12 @@
 import os
 import argparse
-import numpy as np
-import sksurgeryvtk.models.vtk_surface_model_directory_loader as vdl
-from src.loading_config_utils import load_matrix, create_model_loader, load_AR_display_config, load_aruco_config
-from src.main import run_ar_gui
 import configparser
+# only the standard library is imported here. numpy, VTK, OpenCV and Qt are
+# imported in main, once the config has been checked.
+from src.startup import StartupTimer, read_config, check_config, check_AR_display_files
+from src.loading_config_utils import load_matrix, create_model_loader, load_AR_display_config, \
+    load_tracking_config, load_AR_display_options, load_performance_config, \
+    load_recording_config, load_scene_config, load_tool_config
 
 
 def create_AR_parser():
@@ -58,15 +60,38 @@ def create_AR_parser():
                         type=int,
                         help="Approximate frame rate (fps).")
 
+    parser.add_argument("--check",
+                        action="store_true",
+                        help="Only check the config and the files it points to, then exit.")
+
+    parser.add_argument("--profile_startup",
+                        action="store_true",
+                        help="Print how long each startup phase took, and how many modules it imported. "
+                             "Run with python -X importtime for a breakdown per module.")
+
     return parser
 
 
+def exit_if_invalid(parser, errors, parsed_args, timer):
+    """
+    Exits with the errors if there are any, or after a successful --check.
+    """
+    if len(errors) == 0 and not parsed_args.check:
+        return
+    if parsed_args.profile_startup:
+        print(timer.report())
+    if len(errors) > 0:
+        parser.exit(1, '\n'.join(['Invalid config:'] + errors) + '\n')
+    parser.exit(0, 'Config OK\n')
+
+
 def main(args=None):
     """
     Main function, parses args, exits early if error then launches GUI.
     """
+    timer = StartupTimer()
     parser = create_AR_parser()
-    parsed_args = parser.parse_args()
+    parsed_args = parser.parse_args(args)
 
     # Command line parser will check for the presence/absence of required/optional
     # arguments. We will now do some basic loading and checking of inputs
@@ -75,26 +100,25 @@ def main(args=None):
 
     # check if user submitted config file
     if len(parsed_args.config_path) > 0:
-        config = configparser.ConfigParser()
-        config.read(parsed_args.config_path)
+        # every field and file is checked before anything heavy is imported,
+        # so all mistakes are reported at once
+        with timer.phase('check config'):
+            config, errors = read_config(parsed_args.config_path)
+            if len(errors) == 0:
+                errors = check_config(config)
+        exit_if_invalid(parser, errors, parsed_args, timer)
 
         # load all the arguments from the config file
         intrinsics_pth, distortion_pth, video_source, registration_matrix, models, rendering_defaults, frame_rate = load_AR_display_config(
             config)
-        # load aruco params
-        aruco_dict, size_in_bits, border_bits, gap_between_markers_in_bits, \
-            marker_length, markers_w, markers_h, pixels_per_bit, save_path, marker_separation, \
-            pointer_marker_length, pointer_markers_w, pointer_markers_h, pointer_marker_separation, \
-            pointer_aruco_dict, pointer_save_path \
-                  = load_aruco_config(config)
-        print('marker length: ', marker_length)
-        print('markers w: ', markers_w)
-        print('markers h: ', markers_h)
-        print('marker separation: ', marker_separation)
-        print('pointer marker length: ', pointer_marker_length)
-        print('pointer markers w: ', pointer_markers_w)
-        print('pointer markers h: ', pointer_markers_h)
-        print('pointer marker separation: ', pointer_marker_separation)
+
+        tracking_args = load_tracking_config(config)
+        display_args = load_AR_display_options(config)
+        performance_args = load_performance_config(config)
+        recording_args = load_recording_config(config)
+        scene_args = load_scene_config(config)
+        # the board, the pointer and the [TOOL:<name>] sections
+        tools = load_tool_config(config)
 
     else:
         intrinsics_pth = parsed_args.intrinsics
@@ -104,43 +128,67 @@ def main(args=None):
         models = parsed_args.models
         rendering_defaults = parsed_args.rendering_defaults
 
-        video_source = parsed_args.video_realsense
+        video_source = parsed_args.video_source
 
         frame_rate = parsed_args.frame_rate
 
+        with timer.phase('check files'):
+            errors = check_AR_display_files(intrinsics_pth, distortion_pth, video_source,
+                                            registration_matrix, models, rendering_defaults)
+        exit_if_invalid(parser, errors, parsed_args, timer)
+
+        tracking_args = load_tracking_config(configparser.ConfigParser())
+        display_args = load_AR_display_options(configparser.ConfigParser())
+        performance_args = load_performance_config(configparser.ConfigParser())
+        recording_args = load_recording_config(configparser.ConfigParser())
+        scene_args = load_scene_config(configparser.ConfigParser())
+        # without a config, only the board is tracked, as created by create_aruco_board's defaults
+        tools = [('board', dict())]
 
     cl_args = dict()
-    cl_args['intrinsics'] = load_matrix(name="intrinsics",
-                                                  path_to_file=intrinsics_pth,
-                                                  expected_shape=(3, 3))
+    with timer.phase('load matrices (numpy)'):
+        cl_args['intrinsics'] = load_matrix(name="intrinsics",
+                                            path_to_file=intrinsics_pth,
+                                            expected_shape=(3, 3))
 
-    cl_args['distortion'] = load_matrix(name="distortion",
-                                                  path_to_file=distortion_pth,
-                                                  expected_shape=(1, 5))
+        cl_args['distortion'] = load_matrix(name="distortion",
+                                            path_to_file=distortion_pth,
+                                            expected_shape=(1, 5))
 
-    cl_args['registration_matrix'] = load_matrix(name="registration_matrix",
-                                                 path_to_file=registration_matrix,
-                                                 expected_shape=(4, 4))
+        cl_args['registration_matrix'] = load_matrix(name="registration_matrix",
+                                                     path_to_file=registration_matrix,
+                                                     expected_shape=(4, 4))
 
-    cl_args['model_loader'] = create_model_loader(path_to_directory=models,
-                                                  rendering_defaults=rendering_defaults)
+    with timer.phase('load models (VTK)'):
+        cl_args['model_loader'] = create_model_loader(path_to_directory=models,
+                                                      rendering_defaults=rendering_defaults,
+                                                      cache_dir=display_args['model_cache'],
+                                                      defer_hidden=display_args['defer_hidden_models'])
 
     cl_args['video_source'] = video_source  # 0/1
 
-    # aruco params
-    cl_args['aruco_markers_w'] = markers_w
-    cl_args['aruco_markers_h'] = markers_h
-    cl_args['aruco_marker_length'] = marker_length
-    cl_args['aruco_marker_separation'] = marker_separation
+    # tracked tools, the board first, as (name, board_args)
+    cl_args['tools'] = tools
+
+    cl_args['frame_rate'] = frame_rate
+    cl_args.update(display_args)
 
+    # tracking params
+    cl_args.update(tracking_args)
 
-    cl_args['pointer_aruco_markers_w'] = pointer_markers_w
-    cl_args['pointer_aruco_markers_h'] = pointer_markers_h
-    cl_args['pointer_aruco_marker_length'] =pointer_marker_length
-    cl_args['pointer_aruco_marker_separation'] = pointer_marker_separation
+    # latency statistics, HUD and export
+    cl_args.update(performance_args)
 
-    cl_args['frame_rate'] = frame_rate
+    # session recording and replay
+    cl_args.update(recording_args)
+
+    # models moving with the tracked tools
+    cl_args.update(scene_args)
 
+    with timer.phase('import GUI (Qt, OpenCV)'):
+        from src.main import run_ar_gui
+    if parsed_args.profile_startup:
+        print(timer.report())
 
     run_ar_gui(cl_args)
 
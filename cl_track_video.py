@@ -0,0 +1,76 @@
+import argparse
+import configparser
+import logging
+from src.loading_config_utils import load_matrix, load_AR_display_config, load_tracking_config, \
+    load_tool_config
+from src.offline_tracking import track_video
+
+
+def create_track_video_parser():
+    """
+    Creates the command line parser for headless tracking of recorded videos.
+    :return: argparse.ArgumentParser()
+    """
+    parser = argparse.ArgumentParser(description='Track the board and the other tools in a recorded video, without the GUI')
+
+    parser.add_argument('--config_path',
+                        required=False,
+                        type=str,
+                        default='config/config.ini',
+                        help='path to config file containing the aruco, tracking and calibration settings.')
+
+    parser.add_argument("-v", "--video",
+                        required=False,
+                        type=str,
+                        help="Path to the recorded video. Defaults to video_source in the config file.")
+
+    parser.add_argument("-o", "--output",
+                        required=False,
+                        type=str,
+                        default='data/tracking/tracking.npz',
+                        help="Path of the .npz file the per-frame poses are written to.")
+
+    parser.add_argument("-w", "--workers",
+                        required=False,
+                        type=int,
+                        default=None,
+                        help="Number of worker processes. Defaults to the number of CPUs.")
+
+    parser.add_argument("-c", "--chunk_size",
+                        required=False,
+                        type=int,
+                        default=500,
+                        help="Number of frames per chunk handed to a worker.")
+
+    return parser
+
+
+def main():
+    """
+    Parses args and config, then tracks the video.
+    """
+    logging.basicConfig(level=logging.INFO)
+    parser = create_track_video_parser()
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config_path)
+
+    intrinsics_pth, distortion_pth, video_source, registration_matrix, models, rendering_defaults, frame_rate = \
+        load_AR_display_config(config)
+    tracking_args = load_tracking_config(config)
+
+    intrinsics = load_matrix(name="intrinsics", path_to_file=intrinsics_pth, expected_shape=(3, 3))
+    distortion = load_matrix(name="distortion", path_to_file=distortion_pth, expected_shape=(1, 5))
+
+    # the board, the pointer and the [TOOL:<name>] sections
+    tools = load_tool_config(config)
+
+    video_path = args.video if args.video else video_source
+
+    track_video(video_path, args.output, tools, intrinsics, distortion, tracking_args,
+                workers=args.workers, chunk_size=args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
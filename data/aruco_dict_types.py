@@ -1,28 +1,51 @@
-import cv2
-
-# define names of each possible ArUco tag OpenCV supports
+# define names of each possible ArUco tag OpenCV supports.
+# The values are those of cv2.aruco.DICT_*, written out so that the config can be
+# loaded and checked without importing OpenCV.
 ARUCO_DICT = {
-	"DICT_4X4_50": cv2.aruco.DICT_4X4_50,
-	"DICT_4X4_100": cv2.aruco.DICT_4X4_100,
-	"DICT_4X4_250": cv2.aruco.DICT_4X4_250,
-	"DICT_4X4_1000": cv2.aruco.DICT_4X4_1000,
-	"DICT_5X5_50": cv2.aruco.DICT_5X5_50,
-	"DICT_5X5_100": cv2.aruco.DICT_5X5_100,
-	"DICT_5X5_250": cv2.aruco.DICT_5X5_250,
-	"DICT_5X5_1000": cv2.aruco.DICT_5X5_1000,
-	"DICT_6X6_50": cv2.aruco.DICT_6X6_50,
-	"DICT_6X6_100": cv2.aruco.DICT_6X6_100,
-	"DICT_6X6_250": cv2.aruco.DICT_6X6_250,
-	"DICT_6X6_1000": cv2.aruco.DICT_6X6_1000,
-	"DICT_7X7_50": cv2.aruco.DICT_7X7_50,
-	"DICT_7X7_100": cv2.aruco.DICT_7X7_100,
-	"DICT_7X7_250": cv2.aruco.DICT_7X7_250,
-	"DICT_7X7_1000": cv2.aruco.DICT_7X7_1000,
-	"DICT_ARUCO_ORIGINAL": cv2.aruco.DICT_ARUCO_ORIGINAL,
-	"DICT_APRILTAG_16h5": cv2.aruco.DICT_APRILTAG_16h5,
-	"DICT_APRILTAG_25h9": cv2.aruco.DICT_APRILTAG_25h9,
-	"DICT_APRILTAG_36h10": cv2.aruco.DICT_APRILTAG_36h10,
-	"DICT_APRILTAG_36h11": cv2.aruco.DICT_APRILTAG_36h11
+	"DICT_4X4_50": 0,
+	"DICT_4X4_100": 1,
+	"DICT_4X4_250": 2,
+	"DICT_4X4_1000": 3,
+	"DICT_5X5_50": 4,
+	"DICT_5X5_100": 5,
+	"DICT_5X5_250": 6,
+	"DICT_5X5_1000": 7,
+	"DICT_6X6_50": 8,
+	"DICT_6X6_100": 9,
+	"DICT_6X6_250": 10,
+	"DICT_6X6_1000": 11,
+	"DICT_7X7_50": 12,
+	"DICT_7X7_100": 13,
+	"DICT_7X7_250": 14,
+	"DICT_7X7_1000": 15,
+	"DICT_ARUCO_ORIGINAL": 16,
+	"DICT_APRILTAG_16h5": 17,
+	"DICT_APRILTAG_25h9": 18,
+	"DICT_APRILTAG_36h10": 19,
+	"DICT_APRILTAG_36h11": 20
 }
 
-print(ARUCO_DICT)
\ No newline at end of file
+# number of bits along the side of a marker of each dictionary, border excluded
+ARUCO_DICT_MARKER_SIZE = {
+	"DICT_4X4_50": 4,
+	"DICT_4X4_100": 4,
+	"DICT_4X4_250": 4,
+	"DICT_4X4_1000": 4,
+	"DICT_5X5_50": 5,
+	"DICT_5X5_100": 5,
+	"DICT_5X5_250": 5,
+	"DICT_5X5_1000": 5,
+	"DICT_6X6_50": 6,
+	"DICT_6X6_100": 6,
+	"DICT_6X6_250": 6,
+	"DICT_6X6_1000": 6,
+	"DICT_7X7_50": 7,
+	"DICT_7X7_100": 7,
+	"DICT_7X7_250": 7,
+	"DICT_7X7_1000": 7,
+	"DICT_ARUCO_ORIGINAL": 5,
+	"DICT_APRILTAG_16h5": 4,
+	"DICT_APRILTAG_25h9": 5,
+	"DICT_APRILTAG_36h10": 6,
+	"DICT_APRILTAG_36h11": 6
+}
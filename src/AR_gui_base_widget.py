@@ -4,11 +4,21 @@
 
 import platform
 import logging
+import time
 import cv2
 import numpy as np
 from PySide6 import QtWidgets, QtCore
 import sksurgeryimage.acquire.video_source as vs
 import sksurgeryvtk.widgets.vtk_overlay_window as ow
+from src.undistortion_utils import UndistortionEngine
+from src.video_capture_utils import ThreadedVideoSource
+from src.tracking_pipeline import TrackingWorker, LatestValueSlot
+from src.frame_buffer_pool import FrameBufferPool
+from src.frame_scheduler import FrameNotifier, FrameRateMeter
+from src.perf_stats import PerfStats, PerfStatsExporter, PerfHUD
+from src.session_recording import SessionRecorder, RecordingVideoSource, ReplayVideoSource, is_session
+from src.scene_graph import SceneGraph
+from src.render_profiles import RENDER_PROFILES, apply_render_profile, scale_intrinsics, scaled_size
 
 #from src.AR_gui_rs_api_widget import RealsenseVideoSourceAPI
 
@@ -32,6 +42,19 @@ class ARGuiBaseWidget(QtWidgets.QWidget):
         self.model_loader = cl_args['model_loader']
         self.video_source = cl_args['video_source']
         self.update_rate = cl_args['frame_rate']
+        # names of the tracked tools, the board first, in the order derived classes track and record them
+        self.tool_names = tuple(name for name, _ in cl_args['tools'])
+        # if True, markers are detected on the raw grey frame and only the
+        # displayed image is undistorted
+        self.detect_on_raw_frame = cl_args['detect_on_raw_frame']
+
+        # undistortion maps are built on the first frame and reused until
+        # the frame size or calibration changes. If cached on disk by a previous
+        # run with the same calibration, they are loaded now instead.
+        self.undistortion = UndistortionEngine(self.intrinsics, self.distortion,
+                                               cache_dir=cl_args['calibration_cache'])
+        for frame_size, alpha in self.undistortion.preload():
+            LOGGER.info(f"Loaded cached undistortion maps for frame size {frame_size}")
 
         # whether to use realsense API or not for realsense viewer
         #self.rs_api = cl_args['realsense_api']
@@ -57,8 +80,35 @@ class ARGuiBaseWidget(QtWidgets.QWidget):
         self.layout.addWidget(self.video_viewer)
         #self.layout.addWidget(self.endoscope_viewer)
 
+        # transparency, anti-aliasing and video resolution of the overlay. The video is
+        # scaled by video_scale before upload, and the overlay's projection with it;
+        # the models are still rendered at the window's resolution.
+        self.render_profile = RENDER_PROFILES[cl_args['render_profile']]
+        apply_render_profile(self.video_viewer.GetRenderWindow(),
+                             self.video_viewer.get_foreground_renderer(),
+                             self.render_profile)
+        self.video_scale = self.render_profile['video_scale']
+        self.display_intrinsics = scale_intrinsics(self.intrinsics, self.video_scale)
+        self.display_buffer = None
+
+        # frames are either processed when they arrive, or polled by a timer at frame_rate
+        self.frame_driven = cl_args['scheduler'] == 'frame_driven'
         self.timer = QtCore.QTimer()
         self.timer.timeout.connect(self.update_view)
+        self.frame_notifier = FrameNotifier()
+        self.frame_notifier.ready.connect(self.update_view, QtCore.Qt.QueuedConnection)
+        self.rate_meter = FrameRateMeter(self.update_rate)
+
+        # rolling latency of each stage of the frame loop, optionally shown on
+        # the video and periodically exported for monitoring
+        self.perf_stats = PerfStats(cl_args['perf_stats_window'], 1000.0 / self.update_rate)
+        self.perf_exporter = PerfStatsExporter(self.perf_stats,
+                                               path=cl_args['perf_export_path'],
+                                               port=cl_args['perf_export_port'],
+                                               period=cl_args['perf_export_period'])
+        self.perf_hud = None
+        if cl_args['perf_hud']:
+            self.perf_hud = PerfHUD(self.video_viewer, self.perf_stats, cl_args['perf_hud_period'])
 
         # Initialise models for both windows.
 
@@ -71,9 +121,31 @@ class ARGuiBaseWidget(QtWidgets.QWidget):
             
             self.video_viewer.add_vtk_models([m])
 
+        # models indexed by name, and bound to the tools they move with
+        self.scene = SceneGraph(cl_args['scene_bindings'], self.tool_names,
+                                translation_threshold=cl_args['pose_threshold_mm'],
+                                rotation_threshold_deg=cl_args['pose_threshold_deg'])
+        self.scene.add_models(self.model_loader.models)
+
+        # decimated versions of the models, switched by projected size (only with the model cache)
+        self.model_lods = getattr(self.model_loader, 'lods', [])
+
+        # models hidden at start may be deferred by the loader, and are then
+        # loaded in the background once frames are shown
+        self.deferred_models = None
+
         # Setup file reading for videos.
         self.video = None
-        if self.video_source:
+        # recorded sessions are replayed through the same pipeline, at their original
+        # timing or as fast as possible. At full speed no frame is dropped, so replays
+        # are deterministic.
+        self.replay = is_session(self.video_source)
+        replay_at_full_speed = self.replay and cl_args['replay_timing'] == 'max'
+        if self.replay:
+            self.video = ReplayVideoSource(self.video_source,
+                                           original_timing=not replay_at_full_speed)
+
+        elif self.video_source:
 
             if self.video_source.isdigit():
                 self.video_source = int(self.video_source)
@@ -87,51 +159,231 @@ class ARGuiBaseWidget(QtWidgets.QWidget):
         else:
             raise RuntimeError(f"You haven't provided a video source.")
 
+        # raw frames, then the tracking of each frame, are appended to the session directory
+        self.recorder = None
+        self.frame_index = None
+        if cl_args['record_session']:
+            self.recorder = SessionRecorder(cl_args['record_session'], self.tool_names,
+                                            self.intrinsics, self.distortion)
+            self.video = RecordingVideoSource(self.video, self.recorder)
+
+        # frames are read on a separate thread, so a blocking camera doesn't stall rendering.
+        # Recorded videos are paced to the frame rate, as they would otherwise be read
+        # as fast as possible. Replayed sessions pace themselves.
+        self.capture = ThreadedVideoSource(self.video,
+                                           buffer_size=cl_args['capture_buffer_size'],
+                                           frame_rate=self.update_rate,
+                                           pace=not isinstance(self.video_source, int) and not self.replay,
+                                           drop_frames=not replay_at_full_speed)
+
+        # undistorted and grey frames are written into recycled buffers,
+        # released once the frame has been displayed
+        self.frame_buffers = FrameBufferPool(cl_args['frame_buffer_count'])
+
+        # if pipelined, frames are undistorted and tracked on a worker thread while
+        # the GUI thread renders the previous result
+        self.pipelined = cl_args['pipelined']
+        self.tracking_worker = None
+        if self.pipelined:
+            self.tracking_worker = TrackingWorker(self.acquire_frame, self.process_frame,
+                                                  LatestValueSlot(on_discard=self.discard_result),
+                                                  release=lambda img_undistorted, img_grey:
+                                                  self.release_frame(img_undistorted))
+
+        # when frame driven, the GUI thread is notified of each new frame, or of
+        # each new tracking result if pipelined
+        if self.frame_driven:
+            if self.pipelined:
+                self.tracking_worker.on_result = self.frame_notifier.notify
+            else:
+                self.capture.on_frame = self.frame_notifier.notify
+
         LOGGER.info("Created ARGuiBaseWidget")
 
     def start(self):
         """
-        Starts the timer, which repeatedly triggers the update_view() method.
+        Starts the capture thread and the tracking worker if pipelined. Then
+        update_view() is triggered by each new frame if frame driven, or
+        repeatedly by the timer otherwise.
         """
-        self.timer.start(1000.0 / self.update_rate)
+        self.capture.start()
+        if self.tracking_worker is not None:
+            self.tracking_worker.start()
+        if not self.frame_driven:
+            self.timer.start(1000.0 / self.update_rate)
+        if getattr(self.model_loader, 'deferred', None):
+            self.deferred_models = self.model_loader.load_deferred_in_background()
 
     def stop(self):
         """
-        Stops the timer.
+        Stops the timer, the tracking worker and the capture thread.
         """
         self.timer.stop()
+        if self.tracking_worker is not None:
+            self.tracking_worker.stop()
+            LOGGER.info(f"Tracking worker stats: {self.tracking_worker.get_stats()}")
+        self.capture.stop()
+        LOGGER.info(f"Capture stats: {self.capture.get_stats()}")
+        LOGGER.info(f"Stage latencies:\n{self.perf_stats.format_text()}")
+        if self.perf_exporter.enabled:
+            self.perf_exporter.export()
+        self.perf_exporter.close()
+        if self.recorder is not None:
+            self.recorder.close()
 
     def terminate(self):
         """
         Make sure that the VTK Interactor terminates nicely, otherwise
         it can throw some error messages, depending on the usage.
         """
+        if self.tracking_worker is not None:
+            self.tracking_worker.stop()
+        self.capture.stop()
+        if self.recorder is not None:
+            self.recorder.close()
         self.video_viewer._RenderWindow.Finalize()  # pylint: disable=protected-access
         self.video_viewer.TerminateApp()
 
-    def update_view(self):
+    def acquire_frame(self, timeout=0.0):
         """
-        Grabs video, then calls update_video which derived classes should implement.
+        Takes the newest frame from the capture thread, and returns it undistorted
+        for display together with the grey frame for tracking.
+
+        returns:
+            - (im_undistorted, im_grey), or None if no new frame arrived within timeout
         """
-        im_undistorted = np.zeros((3, 3, 3), np.uint8)
-        im_undistorted_grey = np.zeros((3, 3), np.uint8)
+        frame = self.capture.read_latest(timeout)
+        if frame is None:
+            return None
 
-        ret, image = self.video.read()
+        # time the frame waited in the capture buffer
+        start = time.perf_counter()
+        self.perf_stats.record('capture', start - frame.arrival_time)
 
-        if ret:
-            im_undistorted = cv2.undistort(image, self.intrinsics,
-                                                  self.distortion)
-            im_undistorted_grey = cv2.cvtColor(im_undistorted, cv2.COLOR_RGB2GRAY)
+        # index of the frame being tracked, for recording. acquire_frame and
+        # process_frame always run one after the other on the same thread.
+        self.frame_index = frame.index
+
+        image = frame.image
+        buffers = self.frame_buffers.acquire(image.shape, image.dtype)
+        im_undistorted = self.undistortion.undistort(image, dst=buffers.colour)
+        undistorted = time.perf_counter()
+        self.perf_stats.record('undistort', undistorted - start)
+
+        if self.detect_on_raw_frame:
+            # tracking only needs the marker corners, which are undistorted afterwards
+            im_grey = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY, dst=buffers.grey)
         else:
-            LOGGER.error("Failed to read from source")
+            im_grey = cv2.cvtColor(im_undistorted, cv2.COLOR_RGB2GRAY, dst=buffers.grey)
+        self.perf_stats.record('grey', time.perf_counter() - undistorted)
+        return im_undistorted, im_grey
+
+    def release_frame(self, img_undistorted):
+        """
+        Returns the buffers of a frame returned by acquire_frame to the pool,
+        once it has been displayed.
+        """
+        self.frame_buffers.release(img_undistorted)
 
+    def scale_for_display(self, image):
+        """
+        Returns image scaled by the render profile's video_scale, for upload as
+        the video background. The scaled image is reused by the next call.
+        """
+        if self.video_scale == 1.0:
+            return image
+        width, height = scaled_size(image.shape, self.video_scale)
+        if self.display_buffer is None or self.display_buffer.shape[:2] != (height, width):
+            self.display_buffer = np.empty((height, width) + image.shape[2:], image.dtype)
+        return cv2.resize(image, (width, height), dst=self.display_buffer, interpolation=cv2.INTER_AREA)
 
-        if ret:
+    def update_view(self):
+        """
+        Grabs video, then calls update_video which derived classes should implement.
+
+        If pipelined, the frame was already grabbed and processed on the tracking
+        worker, and only the newest result is rendered. Each frame is processed
+        once, so nothing is rendered if nothing new arrived.
+        """
+        self.frame_notifier.clear()
+        start = time.perf_counter()
+
+        if self.pipelined:
+            result = self.tracking_worker.slot.take()
+            if result is not None:
+                self.render_result(result)
+                self.frame_done(start)
+            return
+
+        # newest frame from the capture thread, None if nothing new arrived since the last tick
+        frame = self.acquire_frame()
+
+        if frame is not None:
+            im_undistorted, im_grey = frame
             self.update_video(im_undistorted,
-                              im_undistorted_grey)
+                              im_grey)
+            self.frame_done(start)
+
+        # when no frame is dropped, each update only takes the oldest frame, and pending
+        # notifications are combined into one, so the GUI thread is notified again until
+        # the buffer is empty. Otherwise the frames left after the last capture are never shown.
+        if self.frame_driven and not self.capture.drop_frames and self.capture.frames_buffered() > 0:
+            self.frame_notifier.notify()
+
+    def frame_done(self, start):
+        """
+        Records the time update_view spent on a frame, and updates the frame rate
+        and exported stats. The HUD is updated by render_result, before it renders.
+        """
+        self.perf_stats.record('update_view', time.perf_counter() - start)
+        self.rate_meter.tick(*self.capture.capture_progress())
+        self.perf_exporter.maybe_export()
+        if self.deferred_models is not None and self.deferred_models.done():
+            self.add_deferred_models()
+
+    def add_deferred_models(self):
+        """
+        Adds the models loaded in the background to the viewer. They are
+        added hidden, as they were deferred for not being visible at start.
+        """
+        future, self.deferred_models = self.deferred_models, None
+        if future.exception() is not None:
+            LOGGER.error(f"Failed to load the deferred models: {future.exception()}")
+            return
+        models = future.result()
+        self.video_viewer.add_vtk_models(models)
+        self.scene.add_models(models)
+        LOGGER.info(f"Added {len(models)} deferred models")
+
+    def update_video(self, img_undistorted, img_grey):
+        """
+        Updates the screen from one frame, by rendering the result of process_frame.
+
+        img_undistorted is the undistorted colour frame used for display.
+        img_grey is the grey frame used for tracking, which is the raw
+        (distorted) frame if detect_on_raw_frame is set.
+        """
+        self.render_result(self.process_frame(img_undistorted, img_grey))
+
+    def process_frame(self, img_undistorted, img_grey):
+        """
+        Derived classes should implement this method to track one frame. It may
+        run on the tracking worker thread, so it must not touch VTK or Qt objects.
+        The returned result is passed to render_result.
+        """
+        raise NotImplementedError("Derived classes should implement 'process_frame()'")
+
+    def render_result(self, result):
+        """
+        Derived classes should implement this method to update the screen from
+        the result of process_frame. Always runs on the GUI thread, and should
+        call release_frame once the frame has been displayed, and perf_hud.update()
+        (if perf_hud is set) before rendering.
+        """
+        raise NotImplementedError("Derived classes should implement 'render_result()'")
 
-    def update_video(self, image_from_realsense, image_from_endoscope):
+    def discard_result(self, result):
         """
-        Derived classes should implement this method to update the screen.
+        Called with results of process_frame that were replaced by a newer one
+        before being rendered. Derived classes should release their frame.
         """
-        raise NotImplementedError("Derived classes should implement 'update_video()'")
@@ -2,16 +2,19 @@
 
 """ Main Widget defining functionality for AR_gui. """
 import logging
+import time
+from collections import namedtuple
 import cv2
 import numpy as np
 import src.AR_gui_base_widget as bw
 #import sksurgeryvtk.utils.matrix_utils as mu
-from sksurgerycalibration.video.video_calibration_utils import extrinsic_vecs_to_matrix
+from src.undistortion_utils import undistort_marker_corners
+from src.aruco_tracking import MultiBoardTracker, BoardTracker
 import sksurgeryvtk.utils.matrix_utils as mu
 
 LOGGER = logging.getLogger(__name__)
 
-from src.aruco_utils import create_aruco_board
+from src.aruco_utils import create_aruco_board, create_board_tracker
 
 """
 def create_aruco_board(aruco_dict_type=cv2.aruco.DICT_4X4_50,
@@ -38,6 +41,11 @@ def guess_clipping_range_from_pose(pose_matrix):
     return min_clip, max_clip
 
 
+# result of tracking one frame, handed from process_frame to render_result.
+# poses_ok and poses have one entry per tool, the board first.
+TrackingResult = namedtuple('TrackingResult', ['annotated_image', 'poses_ok', 'poses'])
+
+
 class ARGuiMainWidget(bw.ARGuiBaseWidget):
     """
     AR_gui main widget. Responsible for most application logic.
@@ -53,6 +61,8 @@ class ARGuiMainWidget(bw.ARGuiBaseWidget):
         # Creating member variables from command line args passed in.
         # Note: frame_rate, model_loader and video sources are used in base class.
         self.registration_matrix = cl_args['registration_matrix']
+        # whether to draw detected markers and axes on the video
+        self.annotate = cl_args['annotate']
         #self.calibration_matrix = cl_args['calibration_matrix']
 
         # The models (face, tumour etc) should be in MR space, so they need multiplying by registration.
@@ -60,75 +70,131 @@ class ARGuiMainWidget(bw.ARGuiBaseWidget):
         # for m in self.model_loader.models:
         #    m.set_model_transform(self.registration_matrix_vtk)
 
-        # initialising aruco board for tracking
-        self.aruco_board = create_aruco_board(
-            aruco_dict_type=cv2.aruco.DICT_4X4_50,
-            markers_w=cl_args['aruco_markers_w'],  # Number of markers in the X direction.
-            markers_h=cl_args['aruco_markers_h'],  # Number of markers in the y direction.
-            marker_length=cl_args['aruco_marker_length'],  # length of aruco marker (mm)
-            marker_separation=cl_args['aruco_marker_separation']  # separation between markers (mm)
-        )
-
-        self.pointer_aruco_board = create_aruco_board(
-            aruco_dict_type=cv2.aruco.DICT_5X5_50,
-            markers_w=cl_args['pointer_aruco_markers_w'],  # Number of markers in the X direction.
-            markers_h=cl_args['pointer_aruco_markers_h'],  # Number of markers in the y direction.
-            marker_length=cl_args['pointer_aruco_marker_length'],  # length of aruco marker (mm)
-            marker_separation=cl_args['pointer_aruco_marker_separation']  # separation between markers (mm)
-        )
-
-        self.aruco_dict = self.aruco_board.getDictionary()
-        self.pointer_aruco_dict = self.pointer_aruco_board.getDictionary()
+        # initialising aruco boards for tracking, one per tool. The first tool is the
+        # board the camera pose is measured against, the others are moved relative to it.
         self.aruco_params = cv2.aruco.DetectorParameters()
 
+        # trackers keep the last pose of each board, to seed the next pose estimate.
+        # If markers are detected on the raw frame, the pose solver undistorts the corners.
+        tracking_distortion = self.distortion if self.detect_on_raw_frame else None
+        self.trackers = [create_board_tracker(self.intrinsics, tracking_distortion,
+                                              parameters=self.aruco_params, **board_args)
+                         for _, board_args in cl_args['tools']]
+        self.board_tracker = self.trackers[0]
+        self.aruco_board = self.board_tracker.board
+
+        # one detection pass per dictionary each frame, whose markers are routed to the
+        # tools by marker id, and restricted to the region around the boards while they are tracked.
+        # Optionally on a downscaled image, picked from the predicted marker size, and
+        # only every few frames, following the corners with optical flow in between.
+        self.tracking = MultiBoardTracker(self.trackers,
+                                          self.aruco_params,
+                                          use_roi=cl_args['roi_detection'],
+                                          roi_padding=cl_args['roi_padding'],
+                                          full_frame_period=cl_args['full_frame_period'],
+                                          use_pyramid=cl_args['pyramid_detection'],
+                                          min_marker_pixels=cl_args['pyramid_min_marker_pixels'],
+                                          max_pyramid_level=cl_args['pyramid_max_level'],
+                                          detection_interval=cl_args['klt_detection_interval'],
+                                          min_flow_quality=cl_args['klt_min_quality'])
+
+        # whether the overlay's projection was set from the intrinsics
+        self.camera_matrix_set = False
+
         LOGGER.info("Created ARGuiMainWidget")
 
-    def detect_aruco_board_pose(self, undistorted_image, undistorted_grey_image, intrinsics, aruco_board, aruco_dict):
+    def stop(self):
+        """
+        Stops the timer and the capture thread, and reports the tracking stats.
+        """
+        super(ARGuiMainWidget, self).stop()
+        LOGGER.info(f"Tracking stats: {self.tracking.get_stats()}")
+        LOGGER.info(f"Scene stats: {self.scene.get_stats()}")
+
+    def detect_aruco_board_pose(self, undistorted_image, corners, ids, tracker, name='board'):
         """
-        Detects aruco board pose from single image frame.
+        Estimates aruco board pose from the markers detected in a single image frame,
+        and draws them into undistorted_image if annotate is set.
+
+        corners and ids are the detections routed to the tracker's board by self.tracking.
+        If detect_on_raw_frame is set, they come from the raw (distorted) frame:
+        the tracker passes the distortion to the pose solver and only the detected
+        corners are undistorted, for drawing on undistorted_image.
+
+        The pose estimation and annotation times are recorded as pose_<name> and annotate_<name>.
         """
         is_success = False
         image = undistorted_image
         pose = np.eye(4)
 
-        corners, ids, rejected_img_points = cv2.aruco.detectMarkers(undistorted_grey_image,
-                                                                    aruco_dict,
-                                                                    parameters=self.aruco_params)
-
         if corners:
-            ret, rvec, tvec = cv2.aruco.estimatePoseBoard(corners, ids,
-                                                          aruco_board, intrinsics,
-                                                          None, None, None)
+            with self.perf_stats.measure(f'pose_{name}'):
+                ret, rvec, tvec = tracker.estimate_pose(corners, ids)
 
             if ret:
-                pose = extrinsic_vecs_to_matrix(rvec, tvec)
-                image = cv2.aruco.drawDetectedMarkers(undistorted_image, corners)
-                image = cv2.drawFrameAxes(image, intrinsics, None, rvec, tvec, length=37)
+                pose = tracker.pose
+                if self.annotate:
+                    with self.perf_stats.measure(f'annotate_{name}'):
+                        if tracker.distortion is not None:
+                            corners = undistort_marker_corners(corners, self.intrinsics, tracker.distortion)
+                        image = cv2.aruco.drawDetectedMarkers(undistorted_image, corners)
+                        image = cv2.drawFrameAxes(image, self.intrinsics, None, rvec, tvec, length=37)
                 is_success = True
+        else:
+            tracker.reset()
 
         return is_success, image, pose
 
-    def update_video(self,
-                     img_undistorted,
-                     img_undistorted_grey):
+    def process_frame(self,
+                      img_undistorted,
+                      img_grey):
+        """
+        Tracks the board and all other tools in one frame. Called by update_view in base
+        class, or on the tracking worker thread if pipelined.
+
+        img_undistorted is a pooled buffer owned by this frame, so annotations
+        are drawn into it directly.
+        """
+        annotated_image = img_undistorted
+
+        with self.perf_stats.measure('detection'):
+            detections = self.tracking.detect(img_grey)
+
+        poses_ok = []
+        poses = []
+        for name, tracker, (corners, ids) in zip(self.tool_names, self.trackers, detections):
+            pose_ok, annotated_image, pose = self.detect_aruco_board_pose(annotated_image, corners, ids,
+                                                                          tracker, name=name)
+            poses_ok.append(pose_ok)
+            poses.append(pose)
+
+        if self.recorder is not None:
+            self.recorder.record_tracking(self.frame_index,
+                                          [(corners, ids, pose_ok, pose)
+                                           for (corners, ids), pose_ok, pose in zip(detections, poses_ok, poses)])
+
+        return TrackingResult(annotated_image, poses_ok, poses)
+
+    def discard_result(self, result):
+        """
+        Recycles the frame of a result that was replaced before being rendered.
+        """
+        self.release_frame(result.annotated_image)
+
+    def render_result(self, result):
         """
-        Called by update_view in base class.
+        Updates the video and overlay from the result of process_frame. Runs on the GUI thread.
         """
-        annotated_image = np.copy(img_undistorted)
-        pose_ok, annotated_image, pose = self.detect_aruco_board_pose(annotated_image,
-                                                                                img_undistorted_grey,
-                                                                                self.intrinsics, 
-                                                                                self.aruco_board,
-                                                                                self.aruco_dict)
-        
-        pointer_pose_ok, annotated_image, pose_pointer = self.detect_aruco_board_pose(annotated_image,
-                                                                                img_undistorted_grey,
-                                                                                self.intrinsics, 
-                                                                                self.pointer_aruco_board, 
-                                                                                self.pointer_aruco_dict)
-        # First set video images.
-        self.video_viewer.set_video_image(annotated_image)
+        annotated_image, poses_ok, poses = result
+        pose_ok, pose = poses_ok[0], poses[0]
+
+        # First set video images. The overlay window copies the image, so its buffer can be recycled.
+        start = time.perf_counter()
+        self.video_viewer.set_video_image(self.scale_for_display(annotated_image))
             #self.video_viewer.set_video_image(img_undistorted)
+        self.release_frame(annotated_image)
+        video_set = time.perf_counter()
+        self.perf_stats.record('video_image', video_set - start)
 
         # Then sort out cameras. Slight code duplication, but easier to read.
         # So, currently, if tracking not ok, then overlays stop updating.
@@ -155,23 +221,32 @@ class ARGuiMainWidget(bw.ARGuiBaseWidget):
             # So, we have to invert the pose.
 
             camera_to_world = np.linalg.inv(pose @ self.registration_matrix)
-            # set camera pose relative to world
-            self.video_viewer.set_camera_matrix(self.intrinsics)
+            # set camera pose relative to world. The projection only depends on the
+            # intrinsics (and the window size, which the overlay window handles), so it is set once.
+            if not self.camera_matrix_set:
+                self.video_viewer.set_camera_matrix(self.display_intrinsics)
+                self.camera_matrix_set = True
             self.video_viewer.set_camera_pose(camera_to_world)
             min_clip, max_clip = guess_clipping_range_from_pose(camera_to_world)
             self.video_viewer.get_foreground_camera().SetClippingRange(min_clip, max_clip)
+            # draw each model at the level of detail its size on screen needs
+            for lod in self.model_lods:
+                lod.update(camera_to_world, self.intrinsics[0, 0])
 
             #world_mtx_vtk = mu.create_vtk_matrix_from_numpy(np.linalg.inv(pose))
 
-            # set pointer model relative to world
-            if pointer_pose_ok:
-                # to get the pointer relative to the world reference: pointer to camera multiplied by camera to world
-                world_to_pointer = camera_to_world@pose_pointer
-                pointer_mtx_vtk = mu.create_vtk_matrix_from_numpy(world_to_pointer)
-                # move the pointer model to the pointer position
-                for m in self.model_loader.models:
-                    if m.get_name() in ['tweezers']:
-                        print('found pointer', m.get_name())
-                        m.set_user_matrix(pointer_mtx_vtk)
-
+            # set the models of the other tools relative to world
+            for name, tool_pose_ok, tool_pose in zip(self.tool_names[1:], poses_ok[1:], poses[1:]):
+                if tool_pose_ok:
+                    # to get the tool relative to the world reference: tool to camera multiplied by camera to world
+                    world_to_tool = camera_to_world @ tool_pose
+                    # move the models bound to the tool in [SCENE], if it moved enough
+                    self.scene.set_pose(name, world_to_tool)
+
+        self.perf_stats.record('vtk_update', time.perf_counter() - video_set)
+        # the HUD is drawn by this Render(), so it shows the stats of the frame it is drawn on
+        if self.perf_hud is not None:
+            self.perf_hud.update()
+        rendering = time.perf_counter()
         self.video_viewer.Render()
+        self.perf_stats.record('render', time.perf_counter() - rendering)
@@ -36,3 +36,9 @@ class ARGuiMainWindow(QtWidgets.QMainWindow):
         """
         self.main_widget.start()
 
+    def closeEvent(self, event):  # pylint: disable=invalid-name
+        """
+        Stops the capture and tracking threads, and finishes any recording, when the window is closed.
+        """
+        self.main_widget.stop()
+        super().closeEvent(event)
@@ -0,0 +1,588 @@
+# -*- coding: utf-8 -*-
+
+""" Marker detection and board tracking shared by the GUI, calibration and offline tools. """
+
+import logging
+import cv2
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _same_dictionary(dict_a, dict_b):
+    """
+    Returns True if two aruco dictionaries contain the same markers.
+    """
+    return dict_a.markerSize == dict_b.markerSize and \
+        np.array_equal(dict_a.bytesList, dict_b.bytesList)
+
+
+class MultiDictionaryDetector:
+    """
+    Detects markers of several dictionaries, with one cv2.aruco.ArucoDetector
+    per distinct dictionary, so boards sharing a dictionary share one
+    detection pass. Markers are identified by OpenCV itself rather than by
+    re-decoding another detector's rejected candidates.
+
+    If the marker ids of each board are given, boards sharing a dictionary
+    are told apart by id: the markers found for a dictionary are routed to
+    their boards through a lookup table from id to board.
+    """
+
+    def __init__(self, dictionaries, parameters=None, ids=None):
+        """
+        MultiDictionaryDetector constructor.
+
+        params:
+            - dictionaries: list of cv2.aruco.Dictionary, one per tracked board
+            - parameters: cv2.aruco.DetectorParameters, [defaults]
+            - ids: list of the marker ids of each board, eg. board.getIds(). If None,
+                   boards sharing a dictionary all get all of its markers, [None]
+        """
+        if len(dictionaries) == 0:
+            raise ValueError("MultiDictionaryDetector needs at least one dictionary.")
+
+        self.parameters = parameters if parameters is not None else cv2.aruco.DetectorParameters()
+
+        # boards sharing a dictionary share its detection results
+        self.dictionaries = []
+        self.dictionary_index = []
+        for dictionary in dictionaries:
+            for i, unique_dictionary in enumerate(self.dictionaries):
+                if _same_dictionary(dictionary, unique_dictionary):
+                    self.dictionary_index.append(i)
+                    break
+            else:
+                self.dictionary_index.append(len(self.dictionaries))
+                self.dictionaries.append(dictionary)
+
+        self.detectors = [cv2.aruco.ArucoDetector(dictionary, self.parameters) for dictionary in self.dictionaries]
+
+        # per dictionary, the board each marker id belongs to, -1 if none
+        self.id_tables = None
+        if ids is not None:
+            self.id_tables = [np.full(len(dictionary.bytesList), -1, np.int32) for dictionary in self.dictionaries]
+            for board, (board_ids, dictionary_index) in enumerate(zip(ids, self.dictionary_index)):
+                table = self.id_tables[dictionary_index]
+                board_ids = np.asarray(board_ids, dtype=np.int32).ravel()
+                taken = board_ids[table[board_ids] >= 0]
+                if len(taken) > 0:
+                    raise ValueError(f"Marker ids {taken.tolist()} are used by two boards of the same dictionary.")
+                table[board_ids] = board
+
+    def _route(self, results):
+        """
+        Splits the markers found for each dictionary between its boards, by id.
+        """
+        routed = [((), None)] * len(self.dictionary_index)
+        for table, (corners, ids) in zip(self.id_tables, results):
+            if ids is None:
+                continue
+            boards = table[ids.ravel()]
+            for board in np.unique(boards[boards >= 0]):
+                keep = np.flatnonzero(boards == board)
+                routed[board] = (tuple(corners[i] for i in keep), ids.reshape((-1, 1))[keep])
+        return routed
+
+    def detect(self, grey_image):
+        """
+        Detects markers of all dictionaries in grey_image.
+
+        returns:
+            - list with one (corners, ids) tuple per dictionary passed to the
+              constructor, in the same order. ids is None if nothing was found.
+        """
+        results = []
+        for detector in self.detectors:
+            corners, ids, _ = detector.detectMarkers(grey_image)
+            results.append((corners, ids))
+
+        if self.id_tables is not None:
+            return self._route(results)
+        return [results[i] for i in self.dictionary_index]
+
+
+def pose_matrix(rvec, tvec):
+    """
+    Converts a rotation and translation vector to a 4x4 pose matrix.
+    """
+    pose = np.eye(4)
+    pose[0:3, 0:3], _ = cv2.Rodrigues(np.asarray(rvec, dtype=np.float64))
+    pose[0:3, 3] = np.asarray(tvec, dtype=np.float64).reshape(3)
+    return pose
+
+
+class BoardTracker:
+    """
+    Tracks the pose of one aruco GridBoard across frames.
+
+    Holds a preconfigured cv2.aruco.ArucoDetector for the board's dictionary,
+    the board geometry and the last pose. The last pose is passed to the
+    pose solver as an extrinsic guess, so it converges in fewer iterations
+    while the board stays in view.
+    """
+
+    def __init__(self, board, intrinsics=None, distortion=None, parameters=None,
+                 use_extrinsic_guess=True):
+        """
+        BoardTracker constructor.
+
+        params:
+            - board: cv2.aruco.GridBoard, eg. from create_aruco_board
+            - intrinsics: camera matrix (3x3), only needed for pose estimation
+            - distortion: distortion coefficients of the frames the corners are
+                          detected on. None if the frames are undistorted.
+            - parameters: cv2.aruco.DetectorParameters, [defaults]
+            - use_extrinsic_guess: start the pose solver from the last pose, [True]
+        """
+        self.board = board
+        self.dictionary = board.getDictionary()
+        self.parameters = parameters if parameters is not None else cv2.aruco.DetectorParameters()
+        self.detector = cv2.aruco.ArucoDetector(self.dictionary, self.parameters)
+        self.intrinsics = intrinsics
+        self.distortion = distortion
+        self.use_extrinsic_guess = use_extrinsic_guess
+
+        self.pose_ok = False
+        self.rvec = None
+        self.tvec = None
+        self._obj_points = None
+        self._img_points = None
+
+        # outline of the board in board coordinates, used to predict where it will be in the next frame
+        obj_points = np.concatenate([np.asarray(p, dtype=np.float64).reshape((-1, 3))
+                                     for p in board.getObjPoints()])
+        min_x, min_y, _ = obj_points.min(axis=0)
+        max_x, max_y, _ = obj_points.max(axis=0)
+        self.outline = np.array([[min_x, min_y, 0], [max_x, min_y, 0],
+                                 [max_x, max_y, 0], [min_x, max_y, 0]], dtype=np.float64)
+        self.marker_points = obj_points
+
+    def reset(self):
+        """
+        Forgets the last pose, eg. when the board is lost.
+        """
+        self.pose_ok = False
+        self.rvec = None
+        self.tvec = None
+        self._obj_points = None
+        self._img_points = None
+
+    def reprojection_error(self):
+        """
+        RMS reprojection error, in pixels, of the corners used for the last pose.
+
+        returns:
+            - error, or None if the board is not tracked
+        """
+        if not self.pose_ok:
+            return None
+        projected, _ = cv2.projectPoints(self._obj_points, self.rvec, self.tvec, self.intrinsics, self.distortion)
+        residuals = projected.reshape((-1, 2)) - self._img_points.reshape((-1, 2))
+        return float(np.sqrt(np.mean(np.sum(residuals ** 2, axis=1))))
+
+    @property
+    def pose(self):
+        """
+        Last board to camera pose as a 4x4 matrix, identity if the board is not tracked.
+        """
+        if not self.pose_ok:
+            return np.eye(4)
+        return pose_matrix(self.rvec, self.tvec)
+
+    def predict_roi(self, image_shape, padding=0.25):
+        """
+        Projects the board outline through the last pose and returns a padded
+        region of interest around it.
+
+        params:
+            - image_shape: shape of the image the board is detected in
+            - padding: padding added on each side, as a fraction of the outline size
+        returns:
+            - (x0, y0, x1, y1) clipped to the image, or None if there is no last pose
+              or the board is not in front of the camera
+        """
+        if not self.pose_ok or self.intrinsics is None or float(self.tvec.ravel()[2]) <= 0:
+            return None
+
+        points, _ = cv2.projectPoints(self.outline, self.rvec, self.tvec, self.intrinsics, self.distortion)
+        points = points.reshape((-1, 2))
+        (min_x, min_y), (max_x, max_y) = points.min(axis=0), points.max(axis=0)
+        pad_x = padding * (max_x - min_x)
+        pad_y = padding * (max_y - min_y)
+
+        height, width = image_shape[:2]
+        x0 = int(max(0, np.floor(min_x - pad_x)))
+        y0 = int(max(0, np.floor(min_y - pad_y)))
+        x1 = int(min(width, np.ceil(max_x + pad_x)))
+        y1 = int(min(height, np.ceil(max_y + pad_y)))
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return x0, y0, x1, y1
+
+    def predict_marker_pixel_size(self):
+        """
+        Projects the board's markers (of the board's marker_length) through the
+        last pose and returns the side length, in pixels, of the smallest one.
+
+        returns:
+            - side length in pixels, or None if there is no last pose
+        """
+        if not self.pose_ok or self.intrinsics is None or float(self.tvec.ravel()[2]) <= 0:
+            return None
+
+        points, _ = cv2.projectPoints(self.marker_points, self.rvec, self.tvec, self.intrinsics, self.distortion)
+        points = points.reshape((-1, 4, 2))
+        sides = np.linalg.norm(points - np.roll(points, 1, axis=1), axis=2)
+        return float(sides.min())
+
+    def detect(self, grey_image):
+        """
+        Detects the board's markers in grey_image.
+
+        returns:
+            - corners, ids, rejected candidates, as cv2.aruco.ArucoDetector.detectMarkers
+        """
+        return self.detector.detectMarkers(grey_image)
+
+    def estimate_pose(self, corners, ids):
+        """
+        Estimates the board pose from detected markers.
+
+        returns:
+            - is_success: True if the pose was found
+            - rvec: rotation vector of board
+            - tvec: translation vector of board
+        """
+        if self.intrinsics is None:
+            raise ValueError("BoardTracker needs intrinsics to estimate the board pose.")
+
+        if ids is None or len(corners) == 0:
+            self.reset()
+            return False, None, None
+
+        obj_points, img_points = self.board.matchImagePoints(corners, ids)
+        if obj_points is None or len(obj_points) < 4:
+            self.reset()
+            return False, None, None
+
+        use_guess = self.use_extrinsic_guess and self.pose_ok
+        rvec = self.rvec.copy() if use_guess else None
+        tvec = self.tvec.copy() if use_guess else None
+
+        is_success, rvec, tvec = cv2.solvePnP(obj_points, img_points,
+                                              self.intrinsics, self.distortion,
+                                              rvec, tvec,
+                                              useExtrinsicGuess=use_guess,
+                                              flags=cv2.SOLVEPNP_ITERATIVE)
+        if not is_success:
+            self.reset()
+            return False, None, None
+
+        self.pose_ok = True
+        self.rvec = rvec
+        self.tvec = tvec
+        self._obj_points = obj_points
+        self._img_points = img_points
+        return True, rvec, tvec
+
+    def track(self, grey_image):
+        """
+        Detects the board in grey_image and estimates its pose.
+
+        returns:
+            - is_success, rvec, tvec, corners, ids
+        """
+        corners, ids, _ = self.detect(grey_image)
+        is_success, rvec, tvec = self.estimate_pose(corners, ids)
+        return is_success, rvec, tvec, corners, ids
+
+
+class MultiBoardTracker:
+    """
+    Detects the markers of several BoardTrackers in one pass per dictionary and
+    routes them to their boards by marker id.
+
+    When boards were tracked in the previous frame, detection only runs in
+    the region of interest around their predicted outlines. It falls back to
+    a full-frame search when a tracked board is not found in the region, and
+    every full_frame_period frames so that boards that are out of view can
+    be picked up again.
+
+    With pyramid detection, markers are detected on a downscaled image, at
+    the smallest scale where the markers predicted from the last poses are
+    still min_marker_pixels wide, and the corners are then refined at full
+    resolution with cv2.cornerSubPix.
+
+    With a detection_interval K above 1, full detection only runs every K
+    frames. In between, the corners of the tracked boards are propagated
+    from the previous frame with pyramidal Lucas-Kanade optical flow, and
+    detection runs again as soon as the fraction of corners that could be
+    followed drops below min_flow_quality.
+    """
+
+    def __init__(self, trackers, parameters=None, use_roi=True, roi_padding=0.25, full_frame_period=30,
+                 use_pyramid=False, min_marker_pixels=40, max_pyramid_level=2,
+                 detection_interval=1, min_flow_quality=0.8):
+        """
+        MultiBoardTracker constructor.
+
+        params:
+            - trackers: list of BoardTracker
+            - parameters: cv2.aruco.DetectorParameters, [defaults]
+            - use_roi: restrict detection to the region around tracked boards, [True]
+            - roi_padding: padding around the predicted board outlines, as a fraction of their size, [0.25]
+            - full_frame_period: maximum number of frames between full-frame searches, [30]
+            - use_pyramid: detect on a downscaled image and refine corners at full resolution, [False]
+            - min_marker_pixels: minimum marker side length, in pixels, at the detection scale, [40]
+            - max_pyramid_level: maximum number of times the image is halved, [2]
+            - detection_interval: run full detection every this many frames and optical flow
+                                  in between, 1 to detect on every frame, [1]
+            - min_flow_quality: fraction of corners that must be followed by optical flow,
+                                below which full detection runs again, [0.8]
+        """
+        self.trackers = trackers
+        # one detection pass per dictionary, whose markers are routed to the boards by id
+        self.detector = MultiDictionaryDetector([tracker.dictionary for tracker in trackers], parameters,
+                                                ids=[tracker.board.getIds() for tracker in trackers])
+        self.use_roi = use_roi
+        self.roi_padding = roi_padding
+        self.full_frame_period = full_frame_period
+        self.use_pyramid = use_pyramid
+        self.min_marker_pixels = min_marker_pixels
+        self.max_pyramid_level = max_pyramid_level
+        self.refine_criteria = (cv2.TERM_CRITERIA_MAX_ITER | cv2.TERM_CRITERIA_EPS, 30, 0.01)
+
+        self.detection_interval = detection_interval
+        self.min_flow_quality = min_flow_quality
+        self.flow_params = dict(winSize=(21, 21), maxLevel=3,
+                                criteria=(cv2.TERM_CRITERIA_MAX_ITER | cv2.TERM_CRITERIA_EPS, 30, 0.01))
+        # maximum forward-backward error, in pixels, of a corner followed by optical flow
+        self.max_flow_error = 1.0
+
+        self.last_roi = None
+        self.last_pyramid_level = 0
+        self.pyramid_level_counts = [0] * (max_pyramid_level + 1)
+
+        self.last_flow_quality = None
+        self.flow_frames = 0
+        self.detection_frames = 0
+        self._frames_since_detection = 0
+        self._previous_grey = None
+        self._previous_results = None
+        self._frames_since_full_search = 0
+        self.roi_attempts = 0
+        self.roi_hits = 0
+
+    def _select_roi(self, image_shape):
+        """
+        Returns the union of the regions of interest of all tracked boards,
+        or None if the next search should be full frame.
+        """
+        if not self.use_roi or self._frames_since_full_search >= self.full_frame_period:
+            return None
+
+        rois = [tracker.predict_roi(image_shape, self.roi_padding)
+                for tracker in self.trackers if tracker.pose_ok]
+        rois = [roi for roi in rois if roi is not None]
+        if not rois:
+            return None
+
+        rois = np.array(rois)
+        return (int(rois[:, 0].min()), int(rois[:, 1].min()),
+                int(rois[:, 2].max()), int(rois[:, 3].max()))
+
+    def _select_pyramid_level(self):
+        """
+        Returns the pyramid level at which the smallest marker predicted from
+        the tracked boards is still min_marker_pixels wide, 0 if no board is tracked.
+        """
+        if not self.use_pyramid:
+            return 0
+
+        sizes = [tracker.predict_marker_pixel_size() for tracker in self.trackers if tracker.pose_ok]
+        sizes = [size for size in sizes if size is not None]
+        if not sizes:
+            return 0
+
+        level = int(np.floor(np.log2(max(min(sizes), 1.0) / self.min_marker_pixels)))
+        return int(np.clip(level, 0, self.max_pyramid_level))
+
+    def _refine_corners(self, grey_image, corners, scale):
+        """
+        Refines corners upscaled from a pyramid level on the full resolution image.
+        """
+        if len(corners) == 0:
+            return corners
+        points = np.concatenate(corners).reshape((-1, 1, 2)).astype(np.float32)
+        win_size = max(3, 2 * scale)
+        cv2.cornerSubPix(grey_image, points, (win_size, win_size), (-1, -1), self.refine_criteria)
+        points = points.reshape((-1, 1, 4, 2))
+        return tuple(points[i] for i in range(points.shape[0]))
+
+    def _detect_region(self, grey_image, roi=None, level=0):
+        """
+        Detects markers in the roi of grey_image (the whole image if None) at
+        the given pyramid level, returning corners in full resolution image coordinates.
+        """
+        if roi is not None:
+            x0, y0, x1, y1 = roi
+            region = grey_image[y0:y1, x0:x1]
+        else:
+            region = grey_image
+
+        if level == 0:
+            results = self.detector.detect(region)
+        else:
+            scale = 2 ** level
+            height, width = region.shape[:2]
+            small = cv2.resize(region, (max(1, width // scale), max(1, height // scale)),
+                               interpolation=cv2.INTER_AREA)
+            scale_xy = np.array([width / small.shape[1], height / small.shape[0]], dtype=np.float32)
+            results = self.detector.detect(small)
+            # pixel centres are at +0.5, so scale around them
+            results = [(self._refine_corners(region,
+                                             tuple((marker_corners + 0.5) * scale_xy - 0.5
+                                                   for marker_corners in corners),
+                                             scale),
+                        ids)
+                       for corners, ids in results]
+
+        if roi is not None:
+            offset = np.array([x0, y0], dtype=np.float32)
+            results = [(tuple(marker_corners + offset for marker_corners in corners), ids)
+                       for corners, ids in results]
+        return results
+
+    def _follow_corners(self, grey_image):
+        """
+        Propagates the corners of the boards tracked in the previous frame into
+        grey_image with optical flow. Markers are kept only if all their corners
+        pass a forward-backward check.
+
+        returns:
+            - list with one (corners, ids) tuple per tracker, and the fraction of
+              corners that were followed. None, 0 if no board is tracked.
+        """
+        followed = [tracker.pose_ok and ids is not None
+                    for tracker, (corners, ids) in zip(self.trackers, self._previous_results)]
+        if not any(followed):
+            return None, 0.0
+
+        previous_points = np.concatenate([np.concatenate(corners)
+                                          for is_followed, (corners, ids) in zip(followed, self._previous_results)
+                                          if is_followed]).reshape((-1, 1, 2)).astype(np.float32)
+
+        points, status, _ = cv2.calcOpticalFlowPyrLK(self._previous_grey, grey_image,
+                                                     previous_points, None, **self.flow_params)
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(grey_image, self._previous_grey,
+                                                               points, None, **self.flow_params)
+        error = np.linalg.norm((back_points - previous_points).reshape((-1, 2)), axis=1)
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & (error < self.max_flow_error)
+        quality = float(good.mean())
+
+        points = points.reshape((-1, 4, 2))
+        good = good.reshape((-1, 4)).all(axis=1)
+
+        results = []
+        marker = 0
+        for is_followed, (corners, ids) in zip(followed, self._previous_results):
+            if not is_followed:
+                results.append(((), None))
+                continue
+            count = len(corners)
+            keep = np.flatnonzero(good[marker:marker + count]) + marker
+            if len(keep) == 0:
+                results.append(((), None))
+            else:
+                results.append((tuple(points[i].reshape((1, 4, 2)) for i in keep),
+                                ids.reshape((-1, 1))[keep - marker]))
+            marker += count
+
+        # a board that was tracked has to be followed, otherwise detect again
+        if any(is_followed and ids is None for is_followed, (corners, ids) in zip(followed, results)):
+            return None, quality
+        return results, quality
+
+    def _remember(self, grey_image, results):
+        """
+        Keeps a copy of the frame and its results for optical flow in the next frame.
+        """
+        if self.detection_interval > 1:
+            if self._previous_grey is None or self._previous_grey.shape != grey_image.shape:
+                self._previous_grey = np.empty_like(grey_image)
+            np.copyto(self._previous_grey, grey_image)
+            self._previous_results = results
+        return results
+
+    def _detect_markers(self, grey_image):
+        """
+        Runs marker detection, in the roi and at the pyramid level picked from
+        the tracked boards, falling back to the full frame.
+        """
+        roi = self._select_roi(grey_image.shape)
+        level = self._select_pyramid_level()
+        self.last_roi = roi
+        self.last_pyramid_level = level
+
+        if roi is not None:
+            self.roi_attempts += 1
+            self._frames_since_full_search += 1
+            results = self._detect_region(grey_image, roi, level)
+
+            # every board tracked in the previous frame has to be found in the roi,
+            # otherwise search the full frame again, at full resolution
+            lost = any(tracker.pose_ok and ids is None
+                       for tracker, (corners, ids) in zip(self.trackers, results))
+            if not lost:
+                self.roi_hits += 1
+                self.pyramid_level_counts[level] += 1
+                return results
+            self.last_roi = None
+            self.last_pyramid_level = level = 0
+
+        self._frames_since_full_search = 0
+        self.pyramid_level_counts[level] += 1
+        return self._detect_region(grey_image, None, level)
+
+    def detect(self, grey_image):
+        """
+        Detects (or follows with optical flow) the markers of all boards in grey_image.
+
+        returns:
+            - list with one (corners, ids) tuple per tracker, in the same order
+        """
+        can_follow = self.detection_interval > 1 and self._previous_results is not None and \
+            self._previous_grey.shape == grey_image.shape and \
+            self._frames_since_detection < self.detection_interval - 1
+
+        if can_follow:
+            results, self.last_flow_quality = self._follow_corners(grey_image)
+            if results is not None and self.last_flow_quality >= self.min_flow_quality:
+                self.flow_frames += 1
+                self._frames_since_detection += 1
+                return self._remember(grey_image, results)
+
+        self.detection_frames += 1
+        self._frames_since_detection = 0
+        return self._remember(grey_image, self._detect_markers(grey_image))
+
+    @property
+    def roi_hit_rate(self):
+        """
+        Fraction of roi searches that found all the tracked boards.
+        """
+        if self.roi_attempts == 0:
+            return 0.0
+        return self.roi_hits / self.roi_attempts
+
+    def get_stats(self):
+        """
+        Returns the roi, pyramid level and optical flow counters as a dict.
+        """
+        return {'roi_attempts': self.roi_attempts,
+                'roi_hits': self.roi_hits,
+                'roi_hit_rate': self.roi_hit_rate,
+                'pyramid_level_counts': list(self.pyramid_level_counts),
+                'detection_frames': self.detection_frames,
+                'flow_frames': self.flow_frames}
@@ -5,6 +5,8 @@ import numpy as np
 from pathlib import Path
 import copy
 import os
+from src.undistortion_utils import undistort, undistort_marker_corners
+from src.aruco_tracking import BoardTracker
 
 
 def annotate_board(image, corners, color_lines=(0, 255, 0), color_circles=(0, 255, 0)):
@@ -123,7 +125,8 @@ def create_aruco_board(aruco_dict_type=cv2.aruco.DICT_4X4_50,  # aruco dictionar
                        markers_w=5,  # Number of markers in the X direction.
                        markers_h=7,  # Number of markers in the y direction.
                        marker_length=20,  # length of aruco marker (mm)
-                       marker_separation=3  # separation between markers (mm)
+                       marker_separation=3,  # separation between markers (mm)
+                       first_id=0  # id of the first marker
                        ):
     '''
     Creates opencv aruco board object with given parameters
@@ -134,52 +137,106 @@ def create_aruco_board(aruco_dict_type=cv2.aruco.DICT_4X4_50,  # aruco dictionar
         - markers_h (int): Number of markers in the y direction. [7]
         - marker_length (int): length of aruco marker (mm) [16]
         - marker_separation (int): separation between markers (mm) [5]
+        - first_id (int): the board uses markers_w * markers_h consecutive ids from this one, [0]
     '''
 
     # For validating results, show aruco board to camera.
     aruco_dict = cv2.aruco.getPredefinedDictionary(aruco_dict_type)  # aruco dictionary we will use
 
+    marker_count = markers_w * markers_h
+    if first_id < 0 or first_id + marker_count > len(aruco_dict.bytesList):
+        raise ValueError(f"Marker ids [{first_id}, {first_id + marker_count}) are not all in the dictionary, "
+                         f"which has {len(aruco_dict.bytesList)} markers.")
+
     # create arUco board
-    board = cv2.aruco.GridBoard((markers_w, markers_h), marker_length, marker_separation, aruco_dict)
+    board = cv2.aruco.GridBoard((markers_w, markers_h), marker_length, marker_separation, aruco_dict,
+                                np.arange(first_id, first_id + marker_count, dtype=np.int32))
 
     return board
 
 
-def detect_aruco_board_pose(img, intrinsics, distortion, board, return_corners=False, display_pose=False):
+def create_board_tracker(intrinsics=None,
+                         distortion=None,
+                         aruco_dict_type=cv2.aruco.DICT_4X4_50,
+                         markers_w=5,
+                         markers_h=7,
+                         marker_length=20,
+                         marker_separation=3,
+                         first_id=0,
+                         parameters=None):
+    '''
+    Creates a BoardTracker for an aruco board created with create_aruco_board
+
+    params (all optional- default within square brackets):
+        - intrinsics (np.array): camera matrix (3x3), needed for pose estimation [None]
+        - distortion (np.array): distortion of the frames markers are detected on,
+                                 None for undistorted frames [None]
+        - aruco_dict_type, markers_w, markers_h, marker_length, marker_separation, first_id:
+          see create_aruco_board
+        - parameters (cv2.aruco.DetectorParameters): detector parameters [defaults]
+    '''
+    board = create_aruco_board(aruco_dict_type=aruco_dict_type,
+                               markers_w=markers_w,
+                               markers_h=markers_h,
+                               marker_length=marker_length,
+                               marker_separation=marker_separation,
+                               first_id=first_id)
+    return BoardTracker(board, intrinsics, distortion, parameters)
+
+
+# tracker reused by detect_aruco_board_pose for the last board it was called with.
+# Only one is kept, so boards passed in once aren't kept alive for the life of the
+# process (cv2 boards can't be weakly referenced). Callers alternating between
+# boards should pass their own tracker.
+_LAST_BOARD_TRACKER = None
+
+
+def _get_board_tracker(board, intrinsics, distortion):
+    """
+    Returns the cached BoardTracker for board, updated to the given calibration.
+    """
+    global _LAST_BOARD_TRACKER
+    if _LAST_BOARD_TRACKER is None or _LAST_BOARD_TRACKER.board is not board:
+        _LAST_BOARD_TRACKER = BoardTracker(board)
+    board_tracker = _LAST_BOARD_TRACKER
+    board_tracker.intrinsics = intrinsics
+    board_tracker.distortion = distortion
+    return board_tracker
+
+
+def detect_aruco_board_pose(img, intrinsics, distortion, board, return_corners=False, display_pose=False,
+                            tracker=None):
     """
     detects aruco board pose from single image frame and annotates image
 
+    Markers are detected on the raw image with a BoardTracker (reused between
+    consecutive calls for the same board, or passed in as tracker), and the image is only
+    undistorted for annotation.
+
     first parameter is a boolean: if pose detected it's set as true, if not it's set as false
-    annotated_img: image with axis and aruco borders annotated on it
+    annotated_img: undistorted image with axis and aruco borders annotated on it
     rvec: rotation vector of board
     tvec: translation vector of baord
     """
-
-    arucoParams = cv2.aruco.DetectorParameters()
-    # get dictionary from board class
-    aruco_dict = board.getDictionary()
-
-    # im_gray = cv2.cvtColor(img,cv2.COLOR_RGB2GRAY)
-    im_undistorted = cv2.undistort(img, intrinsics, distortion, None, intrinsics)
-    # TODO check when to use im_undistorted and when to use gray (i just changed to gray and using dist)
-    # detect corners of aruco markers
-    corners, ids, rejectedImgPoints = aruco.detectMarkers(im_undistorted, aruco_dict, parameters=arucoParams)
-
-    # if corners are detected, find aruco board pose and display detected aruco markers and axes of board
-    if corners:
-        ret, rvec, tvec = aruco.estimatePoseBoard(corners, ids, board, intrinsics, None, None, None)  # For a board
-
-        # print ("Rotation ", rvec, "Translation", tvec)
-        if ret:
-            # draw detected markers corners on frame
-            im_undistorted = cv2.aruco.drawDetectedMarkers(im_undistorted, corners)
-            annotated_img = cv2.drawFrameAxes(im_undistorted, intrinsics, None, rvec, tvec, length=37)
-            if display_pose:
-                cv2.imshow('annotated pose', annotated_img)
-                cv2.waitKey(1)
-            if return_corners:
-                return True, annotated_img, rvec, tvec, corners, ids
-            return True, annotated_img, rvec, tvec  # , corners, ids
+    if tracker is None:
+        tracker = _get_board_tracker(board, intrinsics, distortion)
+
+    # detect corners of aruco markers and find the board pose
+    ret, rvec, tvec, corners, ids = tracker.track(img)
+
+    # if pose found, display detected aruco markers and axes of board
+    if ret:
+        im_undistorted = undistort(img, intrinsics, distortion)
+        # corners in the undistorted image, as the pose and annotations are
+        corners = undistort_marker_corners(corners, intrinsics, distortion)
+        # draw detected markers corners on frame
+        im_undistorted = cv2.aruco.drawDetectedMarkers(im_undistorted, corners)
+        annotated_img = cv2.drawFrameAxes(im_undistorted, intrinsics, None, rvec, tvec, length=37)
+        if display_pose:
+            cv2.imshow('annotated pose', annotated_img)
+            cv2.waitKey(1)
+        if return_corners:
+            return True, annotated_img, rvec, tvec, corners, ids
+        return True, annotated_img, rvec, tvec  # , corners, ids
 
     return False, [], False, False
-
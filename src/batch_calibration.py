@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+"""
+Offline camera calibration from a folder of images or a video, with aruco
+boards or checkerboards. Corners are detected in parallel in a process
+pool, and bootstrap calibrations on resampled views estimate how much the
+result can be trusted.
+"""
+
+import glob
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+from src.aruco_utils import create_aruco_board
+from src.calibration_engine import solve_calibration
+
+LOGGER = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+
+def checkerboard_points(checkerboard_dims):
+    """
+    Returns the (N, 3) inner corners of a checkerboard, in squares. The
+    square size doesn't change the intrinsics, so it isn't needed.
+    """
+    columns, rows = checkerboard_dims
+    points = np.zeros((columns * rows, 3), np.float32)
+    points[:, :2] = np.mgrid[0:columns, 0:rows].T.reshape((-1, 2))
+    return points
+
+
+def detect_points(grey, calibration_type, board=None, checkerboard_dims=None, detector=None):
+    """
+    Detects the calibration pattern in one grey image.
+
+    returns:
+        - (obj_points (N, 3), img_points (N, 2)) as float32, or None if the pattern wasn't found
+    """
+    if calibration_type == 'checkerboard':
+        flags = cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE | cv2.CALIB_CB_FAST_CHECK
+        found, corners = cv2.findChessboardCorners(grey, tuple(checkerboard_dims), flags=flags)
+        if not found:
+            return None
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+        corners = cv2.cornerSubPix(grey, corners, (11, 11), (-1, -1), criteria)
+        return checkerboard_points(checkerboard_dims), corners.reshape((-1, 2)).astype(np.float32)
+
+    corners, ids, _ = detector.detectMarkers(grey)
+    if ids is None or len(corners) == 0:
+        return None
+    obj_points, img_points = board.matchImagePoints(corners, ids)
+    if obj_points is None or len(obj_points) < 12:
+        return None
+    return obj_points.reshape((-1, 3)).astype(np.float32), img_points.reshape((-1, 2)).astype(np.float32)
+
+
+def detect_in_images(image_paths, calibration_type, board_args=None, checkerboard_dims=None):
+    """
+    Detects the calibration pattern in a list of image files. Runs in a worker process.
+
+    returns:
+        - list of (name, obj_points, img_points) of the images the pattern was found in
+        - (width, height) of the images, None if none could be read
+    """
+    board, detector = _create_board(calibration_type, board_args)
+    views = []
+    frame_size = None
+    for path in image_paths:
+        image = cv2.imread(path)
+        if image is None:
+            LOGGER.warning(f"Could not read {path}")
+            continue
+        grey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        frame_size = _check_size(frame_size, grey, path)
+        points = detect_points(grey, calibration_type, board, checkerboard_dims, detector)
+        if points is not None:
+            views.append((os.path.basename(path),) + points)
+    return views, frame_size
+
+
+def detect_in_video(video_path, first_frame, last_frame, frame_step, calibration_type,
+                    board_args=None, checkerboard_dims=None):
+    """
+    Detects the calibration pattern in every frame_step-th frame of
+    [first_frame, last_frame) of a video. Runs in a worker process.
+
+    returns:
+        - list of (name, obj_points, img_points) of the frames the pattern was found in
+        - (width, height) of the frames, None if none could be read
+    """
+    board, detector = _create_board(calibration_type, board_args)
+    video = cv2.VideoCapture(video_path)
+    video.set(cv2.CAP_PROP_POS_FRAMES, first_frame)
+
+    views = []
+    frame_size = None
+    for frame in range(first_frame, last_frame):
+        if (frame - first_frame) % frame_step != 0:
+            # grab() skips decoding the frames that aren't used
+            if not video.grab():
+                break
+            continue
+        ret, image = video.read()
+        if not ret:
+            break
+        grey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        frame_size = _check_size(frame_size, grey, video_path)
+        points = detect_points(grey, calibration_type, board, checkerboard_dims, detector)
+        if points is not None:
+            views.append((f'frame_{frame}',) + points)
+    video.release()
+    return views, frame_size
+
+
+def _create_board(calibration_type, board_args):
+    """
+    Creates the aruco board and detector in the worker process. Boards can't be pickled.
+    """
+    if calibration_type == 'checkerboard':
+        return None, None
+    board = create_aruco_board(**board_args)
+    detector = cv2.aruco.ArucoDetector(board.getDictionary(), cv2.aruco.DetectorParameters())
+    return board, detector
+
+
+def _check_size(frame_size, grey, name):
+    """
+    Returns the (width, height) of grey, checking it's the same as the previous images.
+    """
+    size = (grey.shape[1], grey.shape[0])
+    if frame_size is not None and size != frame_size:
+        raise ValueError(f"{name} is {size[0]}x{size[1]}, but previous images are {frame_size[0]}x{frame_size[1]}.")
+    return size
+
+
+def _pack_views(views):
+    """
+    Concatenates the points of views into the arrays solve_calibration takes.
+    """
+    offsets = np.zeros(len(views) + 1, np.int64)
+    offsets[1:] = np.cumsum([len(obj_points) for _, obj_points, _ in views])
+    obj_points = np.concatenate([obj_points for _, obj_points, _ in views])
+    img_points = np.concatenate([img_points for _, _, img_points in views])
+    return obj_points, img_points, offsets
+
+
+def _solve_views(views, frame_size):
+    """
+    Calibrates from a list of views. Runs in a worker process for bootstrap subsets.
+    """
+    return solve_calibration(*_pack_views(views), frame_size)
+
+
+def calibrate_from_source(source, calibration_type, board_args=None, checkerboard_dims=None,
+                          workers=None, frame_step=10, max_views=80, bootstrap_samples=20, seed=0):
+    """
+    Calibrates the camera from a folder of images or a video.
+
+    params:
+        - source: folder of calibration images, or path of a video
+        - calibration_type: 'aruco' or 'checkerboard'
+        - board_args: keyword arguments of create_aruco_board, for aruco calibration
+        - checkerboard_dims: (columns, rows) of inner corners, for checkerboard calibration
+        - workers: number of worker processes, [os.cpu_count()]
+        - frame_step: only every frame_step-th frame of a video is used, [10]
+        - max_views: the views used are evenly subsampled down to this many, [80]
+        - bootstrap_samples: number of calibrations on resampled views, 0 to skip, [20]
+        - seed: random seed of the bootstrap resampling, [0]
+    returns:
+        - dict with rms, intrinsics, distortion, per view errors, the names of the views used,
+          and if bootstrapped the standard deviations of the intrinsics and distortion
+    """
+    if calibration_type not in ('aruco', 'checkerboard'):
+        raise ValueError(f"Unknown calibration type {calibration_type}, expected aruco or checkerboard.")
+    if calibration_type == 'aruco' and board_args is None:
+        raise ValueError("Aruco calibration needs the board settings.")
+    if calibration_type == 'checkerboard' and checkerboard_dims is None:
+        raise ValueError("Checkerboard calibration needs the checkerboard dimensions.")
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if os.path.isdir(source):
+            image_paths = sorted(path for path in glob.glob(os.path.join(source, '*'))
+                                 if path.lower().endswith(IMAGE_EXTENSIONS))
+            if not image_paths:
+                raise ValueError(f"No calibration images found in {source}.")
+            LOGGER.info(f"Detecting the {calibration_type} pattern in {len(image_paths)} images of {source}")
+            chunks = [image_paths[i::workers] for i in range(workers) if image_paths[i::workers]]
+            futures = [executor.submit(detect_in_images, chunk, calibration_type, board_args, checkerboard_dims)
+                       for chunk in chunks]
+        elif os.path.isfile(source):
+            video = cv2.VideoCapture(source)
+            frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+            video.release()
+            if frame_count <= 0:
+                raise ValueError(f"Could not read the number of frames of {source}.")
+            LOGGER.info(f"Detecting the {calibration_type} pattern in every {frame_step}th of "
+                        f"{frame_count} frames of {source}")
+            # chunk boundaries are multiples of frame_step, so the same frames are used whatever the workers
+            chunk_size = frame_step * int(np.ceil(frame_count / (frame_step * workers)))
+            futures = [executor.submit(detect_in_video, source, first, min(first + chunk_size, frame_count),
+                                       frame_step, calibration_type, board_args, checkerboard_dims)
+                       for first in range(0, frame_count, chunk_size)]
+        else:
+            raise ValueError(f"Calibration source {source} doesn't exist.")
+
+        views = []
+        frame_size = None
+        for future in futures:
+            chunk_views, chunk_frame_size = future.result()
+            views.extend(chunk_views)
+            if chunk_frame_size is not None:
+                if frame_size is not None and chunk_frame_size != frame_size:
+                    raise ValueError(f"Calibration images of {source} don't all have the same size.")
+                frame_size = chunk_frame_size
+
+        if len(views) < 3:
+            raise ValueError(f"The calibration pattern was only found in {len(views)} images, at least 3 are needed.")
+        if len(views) > max_views:
+            views = [views[i] for i in np.linspace(0, len(views) - 1, max_views).round().astype(int)]
+        LOGGER.info(f"Calibrating with {len(views)} views")
+
+        rms, intrinsics, distortion, view_errors = _solve_views(views, frame_size)
+        result = {'rms': rms,
+                  'intrinsics': intrinsics,
+                  'distortion': distortion,
+                  'view_errors': view_errors,
+                  'views': [name for name, _, _ in views],
+                  'frame_size': frame_size}
+
+        if bootstrap_samples > 0:
+            rng = np.random.default_rng(seed)
+            subsets = [[views[i] for i in rng.integers(0, len(views), len(views))]
+                       for _ in range(bootstrap_samples)]
+            futures = [executor.submit(_solve_views, subset, frame_size) for subset in subsets]
+            estimates = []
+            for future in futures:
+                try:
+                    estimates.append(future.result())
+                except cv2.error as error:
+                    LOGGER.warning(f"Bootstrap calibration failed: {error}")
+            if estimates:
+                result['bootstrap_rms'] = np.array([estimate[0] for estimate in estimates])
+                result['intrinsics_std'] = np.std([estimate[1] for estimate in estimates], axis=0)
+                result['distortion_std'] = np.std([np.ravel(estimate[2])[:5] for estimate in estimates], axis=0)
+
+    return result
+
+
+def save_calibration(calibration_folder, intrinsics, distortion):
+    """
+    Saves intrinsics.txt (3x3) and distortion.txt (1x5) to calibration_folder,
+    in the format load_matrix reads.
+    """
+    os.makedirs(calibration_folder, exist_ok=True)
+    np.savetxt(os.path.join(calibration_folder, 'intrinsics.txt'), intrinsics)
+    np.savetxt(os.path.join(calibration_folder, 'distortion.txt'), np.reshape(distortion, (1, -1))[:, :5])
+    LOGGER.info(f"Saved intrinsics.txt and distortion.txt to {calibration_folder}")
+
+
+def format_calibration_report(result):
+    """
+    Formats the result of calibrate_from_source for printing.
+    """
+    intrinsics = result['intrinsics']
+    lines = [f"Calibrated {result['frame_size'][0]}x{result['frame_size'][1]} camera from "
+             f"{len(result['views'])} views, rms {result['rms']:.3f} px",
+             "worst views: " + ', '.join(f"{result['views'][i]} ({result['view_errors'][i]:.2f} px)"
+                                          for i in np.argsort(result['view_errors'])[::-1][:5])]
+    values = (intrinsics[0, 0], intrinsics[1, 1], intrinsics[0, 2], intrinsics[1, 2])
+    if 'intrinsics_std' in result:
+        std = result['intrinsics_std']
+        stds = (std[0, 0], std[1, 1], std[0, 2], std[1, 2])
+        lines.append(', '.join(f"{name} {value:.1f} +- {value_std:.1f}" for name, value, value_std
+                               in zip(('fx', 'fy', 'cx', 'cy'), values, stds)))
+        lines.append("distortion " + ', '.join(f"{value:.4f} +- {value_std:.4f}" for value, value_std
+                                               in zip(np.ravel(result['distortion'])[:5], result['distortion_std'])))
+        lines.append(f"bootstrap rms {np.min(result['bootstrap_rms']):.3f} to {np.max(result['bootstrap_rms']):.3f} px")
+    else:
+        lines.append(', '.join(f"{name} {value:.1f}" for name, value in zip(('fx', 'fy', 'cx', 'cy'), values)))
+        lines.append("distortion " + ', '.join(f"{value:.4f}" for value in np.ravel(result['distortion'])[:5]))
+    return '\n'.join(lines)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""
+Printable aruco boards at exact millimetre sizes: vector SVG and PDF, or
+raster tiles for boards too large to rasterise in one image. Many boards
+can be generated in parallel.
+"""
+
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+MM_TO_POINTS = 72.0 / 25.4
+
+FORMATS = ('png', 'svg', 'pdf', 'tiles')
+
+
+def board_bits(aruco_dict=cv2.aruco.DICT_4X4_50, markers_w=5, markers_h=8, border_bits=1,
+               gap_between_markers_in_bits=2, first_id=0):
+    """
+    Returns the board as an image with one pixel per bit (0 black, 255 white),
+    and the size of a marker in bits, border included. The markers have
+    consecutive ids from first_id, as tracked by aruco_utils.create_aruco_board.
+
+    The board is created with its lengths in bits, so generateImage draws
+    every bit as exactly one pixel, whatever the dictionary's marker size.
+    """
+    dictionary = cv2.aruco.getPredefinedDictionary(aruco_dict)
+    size_of_marker_in_bits = dictionary.markerSize + 2 * border_bits
+    grid_board = cv2.aruco.GridBoard((markers_w, markers_h),
+                                     size_of_marker_in_bits,
+                                     gap_between_markers_in_bits,
+                                     dictionary,
+                                     np.arange(first_id, first_id + markers_w * markers_h))
+    width_bits = markers_w * size_of_marker_in_bits + (markers_w - 1) * gap_between_markers_in_bits
+    height_bits = markers_h * size_of_marker_in_bits + (markers_h - 1) * gap_between_markers_in_bits
+    bits = grid_board.generateImage((width_bits, height_bits), marginSize=0, borderBits=border_bits)
+    return bits, size_of_marker_in_bits
+
+
+def black_runs(bits):
+    """
+    Returns the (x, y, length) of each horizontal run of black bits, so a
+    board is drawn with one rectangle per run rather than one per bit.
+    """
+    black = np.zeros((bits.shape[0], bits.shape[1] + 2), np.int8)
+    black[:, 1:-1] = bits < 128
+    edges = np.diff(black, axis=1)
+    starts_y, starts_x = np.nonzero(edges == 1)
+    ends_y, ends_x = np.nonzero(edges == -1)
+    # both are sorted row by row, then by x, so starts and ends pair up
+    return np.column_stack((starts_x, starts_y, ends_x - starts_x))
+
+
+def write_svg(bits, bit_mm, path, margin_mm=5.0):
+    """
+    Writes the board as an SVG whose width and height are in millimetres.
+    """
+    width_mm = bits.shape[1] * bit_mm + 2 * margin_mm
+    height_mm = bits.shape[0] * bit_mm + 2 * margin_mm
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{width_mm:g}mm" height="{height_mm:g}mm" '
+                f'viewBox="0 0 {width_mm:g} {height_mm:g}" shape-rendering="crispEdges">\n')
+        f.write(f'<rect x="0" y="0" width="{width_mm:g}" height="{height_mm:g}" fill="white"/>\n')
+        f.write('<g fill="black">\n')
+        for x, y, length in black_runs(bits):
+            f.write(f'<rect x="{margin_mm + x * bit_mm:g}" y="{margin_mm + y * bit_mm:g}" '
+                    f'width="{length * bit_mm:g}" height="{bit_mm:g}"/>\n')
+        f.write('</g>\n</svg>\n')
+
+
+def write_pdf(bits, bit_mm, path, margin_mm=5.0):
+    """
+    Writes the board as a one page PDF sized to the board, drawn in millimetres.
+    """
+    width_mm = bits.shape[1] * bit_mm + 2 * margin_mm
+    height_mm = bits.shape[0] * bit_mm + 2 * margin_mm
+
+    # PDF's origin is bottom left, and its unit is the point
+    commands = [f'{MM_TO_POINTS:.6f} 0 0 {MM_TO_POINTS:.6f} 0 0 cm', '0 g']
+    for x, y, length in black_runs(bits):
+        commands.append(f'{margin_mm + x * bit_mm:.4f} {height_mm - margin_mm - (y + 1) * bit_mm:.4f} '
+                        f'{length * bit_mm:.4f} {bit_mm:.4f} re')
+    commands.append('f')
+    content = '\n'.join(commands).encode('ascii')
+
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>',
+               b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+               f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width_mm * MM_TO_POINTS:.4f} '
+               f'{height_mm * MM_TO_POINTS:.4f}] /Contents 4 0 R >>'.encode('ascii'),
+               f'<< /Length {len(content)} >>\nstream\n'.encode('ascii') + content + b'\nendstream']
+
+    with open(path, 'wb') as f:
+        f.write(b'%PDF-1.4\n')
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(f'{number} 0 obj\n'.encode('ascii') + body + b'\nendobj\n')
+        xref = f.tell()
+        f.write(f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode('ascii'))
+        for offset in offsets:
+            f.write(f'{offset:010d} 00000 n \n'.encode('ascii'))
+        f.write(f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode('ascii'))
+
+
+def write_tiles(bits, pixels_per_bit, path, tile_size=4096):
+    """
+    Writes the board at pixels_per_bit as PNG tiles of at most tile_size
+    pixels, named <path>_r<row>_c<column>.png. Each tile is scaled up from
+    the bits on its own, so memory stays bounded by one tile.
+
+    returns:
+        - list of the tile paths
+    """
+    base, _ = os.path.splitext(path)
+    # tiles hold whole bits, so they line up exactly when assembled
+    tile_bits = max(1, tile_size // pixels_per_bit)
+    paths = []
+    for row, y in enumerate(range(0, bits.shape[0], tile_bits)):
+        for column, x in enumerate(range(0, bits.shape[1], tile_bits)):
+            tile = bits[y:y + tile_bits, x:x + tile_bits]
+            tile = np.repeat(np.repeat(tile, pixels_per_bit, axis=0), pixels_per_bit, axis=1)
+            tile_path = f'{base}_r{row}_c{column}.png'
+            cv2.imwrite(tile_path, tile)
+            paths.append(tile_path)
+    return paths
+
+
+def generate_printable_board(aruco_dict=cv2.aruco.DICT_4X4_50, border_bits=1, gap_between_markers_in_bits=2,
+                             marker_length=30, markers_w=5, markers_h=8, pixels_per_bit=10,
+                             save_path='data/resources/aruco_boards/aruco_board.svg', output_format='svg',
+                             margin_mm=5.0, tile_size=4096, first_id=0):
+    """
+    Generates one board for printing. Runs in a worker process with generate_printable_boards.
+
+    params:
+        - aruco_dict, border_bits, gap_between_markers_in_bits, markers_w, markers_h:
+          see aruco_utils.generate_aruco_board_for_printing
+        - marker_length: length of each marker, border included, in mm
+        - pixels_per_bit: pixels per bit of png and tiles output
+        - save_path: output path. Its extension is replaced to match output_format.
+        - output_format: 'svg' or 'pdf' (exact millimetres), 'png' (one image) or 'tiles' (png tiles)
+        - margin_mm: white margin around vector output, in mm, [5]
+        - tile_size: maximum tile side in pixels, [4096]
+        - first_id: id of the first marker, [0]
+    returns:
+        - description of what was written, with the printed size
+    """
+    if output_format not in FORMATS:
+        raise ValueError(f"Unknown board format {output_format}, expected one of {FORMATS}.")
+
+    bits, size_of_marker_in_bits = board_bits(aruco_dict, markers_w, markers_h, border_bits,
+                                              gap_between_markers_in_bits, first_id)
+    bit_mm = marker_length / size_of_marker_in_bits
+    width_mm = bits.shape[1] * bit_mm
+    height_mm = bits.shape[0] * bit_mm
+
+    base, _ = os.path.splitext(save_path)
+    path = f'{base}.png' if output_format == 'tiles' else f'{base}.{output_format}'
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    if output_format == 'svg':
+        write_svg(bits, bit_mm, path, margin_mm)
+    elif output_format == 'pdf':
+        write_pdf(bits, bit_mm, path, margin_mm)
+    elif output_format == 'png':
+        cv2.imwrite(path, np.repeat(np.repeat(bits, pixels_per_bit, axis=0), pixels_per_bit, axis=1))
+    else:
+        tiles = write_tiles(bits, pixels_per_bit, path, tile_size)
+        path = f'{len(tiles)} tiles {base}_r*_c*.png'
+
+    description = f"{path}: board {width_mm:g} x {height_mm:g} mm, " \
+                  f"marker {marker_length:g} mm, separation {gap_between_markers_in_bits * bit_mm:g} mm, " \
+                  f"ids {first_id}-{first_id + markers_w * markers_h - 1}"
+    if output_format in ('png', 'tiles'):
+        description += f", print at {pixels_per_bit / bit_mm:g} pixels per mm"
+    return description
+
+
+def generate_printable_boards(boards, workers=None):
+    """
+    Generates several boards in parallel.
+
+    params:
+        - boards: list of dicts of generate_printable_board arguments
+        - workers: number of worker processes, [os.cpu_count()]
+    returns:
+        - list of the descriptions returned by generate_printable_board
+    """
+    if len(boards) == 1:
+        return [generate_printable_board(**boards[0])]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(generate_printable_board, **board) for board in boards]
+        return [future.result() for future in futures]
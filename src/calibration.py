@@ -3,28 +3,32 @@ import numpy as np
 import glob
 import os
 #from cv2 import aruco
-from aruco_utils import create_aruco_board
+from src.aruco_utils import create_aruco_board
+from src.aruco_tracking import BoardTracker
+from src.calibration_engine import CalibrationEngine
 
-def calibrate_camera_intrinsics_with_aruco_board(board):
+def calibrate_camera_intrinsics_with_aruco_board(board, target_keyframes=30, max_rms=1.0):
     """
     Calibrates camera with an aruco borad
 
+    Frames are read live from the camera. Only frames showing the board from
+    a new pose, or covering a new part of the image, are kept, and the
+    calibration is solved in a background process as keyframes come in.
+    The current estimate is shown on the video. Stops when target_keyframes
+    are solved with an rms error below max_rms, or when q is pressed.
+
     params:
-        - calib_imgs_path: path where calibration images stored
         - board: aruco GridBoard object (board = cv2.aruco.GridBoard((markers_w, markers_h), marker_length, marker_separation, aruco_dict))
+        - target_keyframes: number of keyframes to calibrate with, [30]
+        - max_rms: rms reprojection error (pixels) below which the calibration is done, [1]
     returns:
         - mtx: intrinsics calibration params of camera
         - dist: distortion calibration params of camera
     """
 
-    # initialise aruco board params
-    arucoParams = cv2.aruco.DetectorParameters()
-    aruco_dict = board.getDictionary()
-
-    # going through all images to find corners
-    counter, corners_list, id_list = [], [], []
-    first = True
-    ids = 0
+    # initialise aruco board detector
+    tracker = BoardTracker(board)
+    engine = None
 
     cap = cv2.VideoCapture(0)
     # live calibration
@@ -35,38 +39,34 @@ def calibrate_camera_intrinsics_with_aruco_board(board):
             continue
 
         # load img and change to gray
-        #im = cv2.imread(str(fn))
         img_gray = cv2.cvtColor(im, cv2.COLOR_RGB2GRAY)
+        if engine is None:
+            engine = CalibrationEngine(board, (img_gray.shape[1], img_gray.shape[0]),
+                                       target_keyframes=target_keyframes, max_rms=max_rms)
 
-        # detect corners of aruco markers
-        corners, ids, rejectedImgPoints = cv2.aruco.detectMarkers(img_gray, aruco_dict, parameters=arucoParams)
-        if len(corners) == 0:  # if no corners detected go to next frame
-            continue
+        # detect corners of aruco markers, and keep them if they are a new view of the board
+        corners, ids, rejectedImgPoints = tracker.detect(img_gray)
+        engine.add_frame(corners, ids)
 
-        if first == True:
-            corners_list = corners
-            id_list = ids
-            first = False
-        else:
-            # adding corners and ids of detected aruco markers to list
-            corners_list = np.vstack((corners_list, corners))
-            id_list = np.vstack((id_list, ids))
-        counter.append(len(ids))
-
-        # draw detected markers corners on frame
-        im = cv2.aruco.drawDetectedMarkers(im, corners)
+        # draw detected markers corners and calibration progress on frame
+        if len(corners) > 0:
+            im = cv2.aruco.drawDetectedMarkers(im, corners)
+        cv2.putText(im, engine.status(), (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
 
         cv2.imshow('frame', im)
-        cv2.waitKey(1)
 
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+        if cv2.waitKey(1) & 0xFF == ord('q') or engine.is_complete:
             break
 
-    print('Found {} unique markers'.format(np.unique(ids)))
+    cap.release()
+    cv2.destroyAllWindows()
+
+    if engine is None or engine.keyframe_count == 0:
+        raise RuntimeError("The board wasn't seen, can't calibrate.")
 
-    counter = np.array(counter)
-    ret, mtx, dist, rvecs, tvecs = cv2.aruco.calibrateCameraAruco(corners_list, id_list, counter, board, img_gray.shape,
-                                                              None, None)
+    rms, mtx, dist = engine.solve()
+    engine.close()
+    print(f'Calibrated with {engine.keyframe_count} keyframes of {engine.frames_seen} frames, rms {rms} px')
 
     return mtx, dist
 
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming camera calibration: detected board points are accumulated into
+preallocated buffers, only frames that add new views of the board are kept,
+and the calibration is solved in a background process while frames keep
+coming in.
+"""
+
+import logging
+from concurrent.futures import ProcessPoolExecutor, wait
+import cv2
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+
+class GrowableArray:
+    """
+    Array of rows that doubles its capacity when full, so appending n rows
+    costs O(n) overall instead of the O(n^2) of repeated np.vstack.
+    """
+
+    def __init__(self, row_shape, dtype=np.float32, capacity=1024):
+        """
+        GrowableArray constructor.
+
+        params:
+            - row_shape: shape of one row, eg. (3,) for 3D points
+            - dtype: dtype of the array, [np.float32]
+            - capacity: number of rows preallocated, [1024]
+        """
+        self._data = np.empty((capacity,) + tuple(row_shape), dtype)
+        self.size = 0
+
+    def append(self, rows):
+        """
+        Appends rows, an array of shape (n,) + row_shape.
+        """
+        rows = np.asarray(rows, dtype=self._data.dtype).reshape((-1,) + self._data.shape[1:])
+        needed = self.size + len(rows)
+        if needed > len(self._data):
+            grown = np.empty((max(needed, 2 * len(self._data)),) + self._data.shape[1:], self._data.dtype)
+            grown[:self.size] = self._data[:self.size]
+            self._data = grown
+        self._data[self.size:needed] = rows
+        self.size = needed
+
+    def view(self):
+        """
+        Returns the filled part of the array, without copying.
+        """
+        return self._data[:self.size]
+
+    def __len__(self):
+        return self.size
+
+
+def solve_calibration(obj_points, img_points, offsets, frame_size, intrinsics=None, distortion=None):
+    """
+    Calibrates the camera from the points of several views. Runs in the
+    background process, so it only takes plain arrays.
+
+    params:
+        - obj_points: (N, 3) board points of all views
+        - img_points: (N, 2) image points of all views
+        - offsets: (V + 1,) start of each view in the points, and the total
+        - frame_size: (width, height)
+        - intrinsics, distortion: previous estimate to start from, [None]
+    returns:
+        - rms reprojection error (pixels), intrinsics, distortion, per view rms errors
+    """
+    views = range(len(offsets) - 1)
+    object_points = [obj_points[offsets[v]:offsets[v + 1]].reshape((-1, 1, 3)) for v in views]
+    image_points = [img_points[offsets[v]:offsets[v + 1]].reshape((-1, 1, 2)) for v in views]
+
+    flags = 0
+    if intrinsics is not None:
+        flags |= cv2.CALIB_USE_INTRINSIC_GUESS
+        intrinsics = intrinsics.copy()
+        distortion = distortion.copy()
+
+    rms, intrinsics, distortion, rvecs, tvecs = cv2.calibrateCamera(object_points, image_points,
+                                                                   tuple(frame_size), intrinsics,
+                                                                   distortion, flags=flags)
+    view_errors = np.empty(len(object_points))
+    for v, (obj, img, rvec, tvec) in enumerate(zip(object_points, image_points, rvecs, tvecs)):
+        projected, _ = cv2.projectPoints(obj, rvec, tvec, intrinsics, distortion)
+        view_errors[v] = np.sqrt(np.mean(np.sum((projected - img) ** 2, axis=-1)))
+    return rms, intrinsics, distortion, view_errors
+
+
+class CalibrationEngine:
+    """
+    Accumulates views of a calibration board and solves the camera
+    calibration in a background process.
+
+    A frame is only kept as a keyframe if it covers parts of the image no
+    keyframe covered yet, or if the board is seen from a pose sufficiently
+    different from all keyframes. Each time enough new keyframes have been
+    added, the calibration is solved again in the background, starting
+    from the previous estimate, while frames keep being added.
+    """
+
+    def __init__(self, board, frame_size, min_points=12, coverage_grid=(8, 6), min_new_cells=2,
+                 min_rotation_deg=10.0, min_translation=0.1, solve_every=5, target_keyframes=30,
+                 max_rms=1.0):
+        """
+        CalibrationEngine constructor.
+
+        params:
+            - board: cv2.aruco.GridBoard (or any board with matchImagePoints)
+            - frame_size: (width, height) of the frames
+            - min_points: minimum number of board points for a view to be used, [12]
+            - coverage_grid: number of (columns, rows) of image cells used to measure coverage, [(8, 6)]
+            - min_new_cells: number of not yet covered cells a frame must cover to be kept for coverage, [2]
+            - min_rotation_deg: minimum rotation from all keyframes for a frame to be kept for its pose, [10]
+            - min_translation: minimum translation from all keyframes, as a fraction of the
+                               distance to the board, for a frame to be kept for its pose, [0.1]
+            - solve_every: number of new keyframes before solving again, [5]
+            - target_keyframes: number of keyframes after which the calibration is complete, [30]
+            - max_rms: the calibration is only complete if its rms error (pixels) is below this, [1]
+        """
+        self.board = board
+        self.frame_size = (int(frame_size[0]), int(frame_size[1]))
+        self.min_points = min_points
+        self.coverage_grid = coverage_grid
+        self.min_new_cells = min_new_cells
+        self.min_rotation_deg = min_rotation_deg
+        self.min_translation = min_translation
+        self.solve_every = solve_every
+        self.target_keyframes = target_keyframes
+        self.max_rms = max_rms
+
+        self.obj_points = GrowableArray((3,), np.float32)
+        self.img_points = GrowableArray((2,), np.float32)
+        self.offsets = GrowableArray((), np.int64, capacity=64)
+        self.offsets.append([0])
+        self.keyframe_poses = []
+        self.coverage = np.zeros((coverage_grid[1], coverage_grid[0]), bool)
+        self.frames_seen = 0
+
+        # rough camera used for keyframe poses until the first solve
+        width, height = self.frame_size
+        self.intrinsics = None
+        self.distortion = None
+        self.rms = None
+        self.view_errors = None
+        self._pose_intrinsics = np.array([[max(width, height), 0, width / 2.0],
+                                          [0, max(width, height), height / 2.0],
+                                          [0, 0, 1]], dtype=np.float64)
+        self._pose_distortion = np.zeros((1, 5))
+
+        self._executor = None
+        self._future = None
+        self._keyframes_in_solve = 0
+        self.keyframes_solved = 0
+
+    @property
+    def keyframe_count(self):
+        """
+        Number of keyframes kept.
+        """
+        return len(self.offsets) - 1
+
+    @property
+    def is_complete(self):
+        """
+        True once target_keyframes keyframes have been solved with an rms error below max_rms.
+        """
+        return self.keyframes_solved >= self.target_keyframes and self.rms is not None and self.rms < self.max_rms
+
+    def _covered_cells(self, img_points):
+        """
+        Returns a mask of the coverage grid cells containing any of img_points.
+        """
+        columns, rows = self.coverage_grid
+        cells = np.zeros((rows, columns), bool)
+        x = np.clip((img_points[:, 0] * columns / self.frame_size[0]).astype(int), 0, columns - 1)
+        y = np.clip((img_points[:, 1] * rows / self.frame_size[1]).astype(int), 0, rows - 1)
+        cells[y, x] = True
+        return cells
+
+    def _is_new_pose(self, rvec, tvec):
+        """
+        Returns True if the pose is far enough from the poses of all keyframes.
+        """
+        rotation = cv2.Rodrigues(rvec)[0]
+        distance = np.linalg.norm(tvec)
+        for keyframe_rotation, keyframe_tvec in self.keyframe_poses:
+            cos_angle = np.clip((np.trace(rotation @ keyframe_rotation.T) - 1.0) / 2.0, -1.0, 1.0)
+            if np.degrees(np.arccos(cos_angle)) < self.min_rotation_deg and \
+                    np.linalg.norm(tvec - keyframe_tvec) < self.min_translation * distance:
+                return False
+        return True
+
+    def add_frame(self, corners, ids):
+        """
+        Adds the markers detected in one frame. The frame is kept if it is a
+        new view of the board, and a background solve is started if enough
+        new keyframes were added. Never blocks on a solve.
+
+        returns:
+            - True if the frame was kept as a keyframe
+        """
+        self.frames_seen += 1
+        self.poll()
+        if ids is None or len(corners) == 0 or self.is_complete:
+            return False
+
+        obj_points, img_points = self.board.matchImagePoints(corners, ids)
+        if obj_points is None or len(obj_points) < self.min_points:
+            return False
+        obj_points = obj_points.reshape((-1, 3))
+        img_points = img_points.reshape((-1, 2))
+
+        cells = self._covered_cells(img_points)
+        adds_coverage = np.count_nonzero(cells & ~self.coverage) >= self.min_new_cells
+
+        intrinsics = self.intrinsics if self.intrinsics is not None else self._pose_intrinsics
+        distortion = self.distortion if self.distortion is not None else self._pose_distortion
+        is_success, rvec, tvec = cv2.solvePnP(obj_points, img_points, intrinsics, distortion)
+        if not is_success:
+            return False
+        if not adds_coverage and not self._is_new_pose(rvec, tvec):
+            return False
+
+        self.obj_points.append(obj_points)
+        self.img_points.append(img_points)
+        self.offsets.append([len(self.obj_points)])
+        self.keyframe_poses.append((cv2.Rodrigues(rvec)[0], tvec))
+        self.coverage |= cells
+
+        if self.keyframe_count - self._keyframes_in_solve >= self.solve_every:
+            self._start_solve()
+        return True
+
+    def _start_solve(self):
+        """
+        Starts solving the calibration with all keyframes in the background
+        process, unless a solve is already running.
+        """
+        if self._future is not None or self.keyframe_count < 3:
+            return
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=1)
+        self._keyframes_in_solve = self.keyframe_count
+        # the views are copied, as the buffers keep growing while the solve runs
+        self._future = self._executor.submit(solve_calibration,
+                                             self.obj_points.view().copy(),
+                                             self.img_points.view().copy(),
+                                             self.offsets.view().copy(),
+                                             self.frame_size,
+                                             self.intrinsics,
+                                             self.distortion)
+
+    def poll(self):
+        """
+        Takes the result of a finished background solve, if any, and starts
+        the next one if keyframes were added since. Never blocks.
+
+        returns:
+            - True if a new estimate was taken
+        """
+        if self._future is None or not self._future.done():
+            return False
+        future, self._future = self._future, None
+        try:
+            self.rms, self.intrinsics, self.distortion, self.view_errors = future.result()
+            self.keyframes_solved = self._keyframes_in_solve
+            LOGGER.info(f"Calibration with {self.keyframes_solved} keyframes: rms {self.rms:.3f} px")
+        except cv2.error as error:
+            LOGGER.warning(f"Calibration failed: {error}")
+        if self.keyframe_count > self._keyframes_in_solve:
+            self._start_solve()
+        return True
+
+    def solve(self):
+        """
+        Waits for the running solve, then solves with all keyframes if any
+        were added since.
+
+        returns:
+            - rms, intrinsics, distortion of the latest estimate
+        """
+        # a finished solve may start the next one, with the keyframes added meanwhile
+        while self._future is not None:
+            wait([self._future])
+            self.poll()
+        if self.keyframe_count > self.keyframes_solved:
+            self.rms, self.intrinsics, self.distortion, self.view_errors = solve_calibration(
+                self.obj_points.view(), self.img_points.view(), self.offsets.view(),
+                self.frame_size, self.intrinsics, self.distortion)
+            self.keyframes_solved = self.keyframe_count
+        return self.rms, self.intrinsics, self.distortion
+
+    def status(self):
+        """
+        Returns a one line description of the calibration progress, for display.
+        """
+        coverage = 100.0 * np.count_nonzero(self.coverage) / self.coverage.size
+        text = f"keyframes {self.keyframe_count}/{self.target_keyframes}, coverage {coverage:.0f}%"
+        if self.rms is not None:
+            text += f", rms {self.rms:.3f} px ({self.keyframes_solved} keyframes)"
+        if self._future is not None:
+            text += ", solving"
+        return text
+
+    def close(self):
+        """
+        Shuts the background process down.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._future = None
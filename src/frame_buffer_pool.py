@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+""" Pool of preallocated frame buffers recycled through the per-frame loop. """
+
+import logging
+import threading
+from collections import namedtuple
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+
+# colour: undistorted colour frame, which annotations are drawn into and which is displayed
+# grey: grey frame used for tracking
+FrameBuffers = namedtuple('FrameBuffers', ['colour', 'grey'])
+
+
+class FrameBufferPool:
+    """
+    Fixed set of frame buffers, sized once per resolution and recycled.
+
+    A frame's buffers are acquired when it is grabbed and released once it
+    has been displayed, so with the tracking worker one set is being filled,
+    one waits to be rendered and one is being rendered. If all sets are in
+    use, a new one is allocated and kept in the pool.
+    """
+
+    def __init__(self, count=3):
+        """
+        FrameBufferPool constructor.
+
+        params:
+            - count: number of buffer sets expected to be in use at once, [3]
+        """
+        self.count = count
+        self._lock = threading.Lock()
+        self._free = []
+        self._in_use = {}
+        self._shape = None
+        self._dtype = None
+        self.sets_allocated = 0
+
+    def acquire(self, colour_shape, dtype=np.uint8):
+        """
+        Returns a free FrameBuffers for frames of colour_shape. If the frame
+        size changed, buffers of the old size are dropped.
+        """
+        with self._lock:
+            if self._shape != tuple(colour_shape) or self._dtype != np.dtype(dtype):
+                LOGGER.info(f"Allocating frame buffers for frames of shape {colour_shape}")
+                self._shape = tuple(colour_shape)
+                self._dtype = np.dtype(dtype)
+                self._free = []
+                self.sets_allocated = 0
+
+            if self._free:
+                buffers = self._free.pop()
+            else:
+                buffers = FrameBuffers(np.empty(self._shape, self._dtype),
+                                       np.empty(self._shape[:2], self._dtype))
+                self.sets_allocated += 1
+                if self.sets_allocated > self.count:
+                    LOGGER.warning(f"Frame buffer pool grew to {self.sets_allocated} sets")
+
+            self._in_use[id(buffers.colour)] = buffers
+        return buffers
+
+    def release(self, colour_image):
+        """
+        Returns the buffers whose colour frame is colour_image to the pool.
+        Images that don't belong to the pool are ignored.
+        """
+        with self._lock:
+            buffers = self._in_use.pop(id(colour_image), None)
+            if buffers is not None and buffers.colour.shape == self._shape:
+                self._free.append(buffers)
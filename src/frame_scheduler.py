@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+""" Scheduling of frame processing on frame arrival, and measurement of the achieved rate. """
+
+import logging
+import time
+from PySide6 import QtCore
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FrameNotifier(QtCore.QObject):
+    """
+    Posts the ready signal to the GUI thread when a new frame (or tracking
+    result) arrives on another thread.
+
+    At most one notification is pending at a time, so a slow GUI thread
+    processes the newest frame once instead of a queue of stale ones.
+    """
+
+    ready = QtCore.Signal()
+
+    def __init__(self):
+        """
+        FrameNotifier constructor.
+        """
+        super(FrameNotifier, self).__init__()
+        self._pending = False
+
+    def notify(self, *args):
+        """
+        Called from any thread when something new is available.
+        """
+        if not self._pending:
+            self._pending = True
+            self.ready.emit()
+
+    def clear(self):
+        """
+        Called on the GUI thread before taking the new frame, so that frames
+        arriving while it is processed trigger another notification.
+        """
+        self._pending = False
+
+
+class FrameRateMeter:
+    """
+    Measures the rate at which frames are processed, and the rate at which
+    the camera delivers them, and periodically reports both against the
+    configured frame rate.
+
+    The camera's rate is measured from the capture timestamps of the frames
+    (eg. TimestampedVideoSource's) when the source reports them, so it isn't
+    skewed by when the GUI thread happens to look, else from arrival times.
+    """
+
+    def __init__(self, expected_rate, report_period=5.0):
+        """
+        FrameRateMeter constructor.
+
+        params:
+            - expected_rate: configured frame rate (fps)
+            - report_period: seconds between reports, [5]
+        """
+        self.expected_rate = expected_rate
+        self.report_period = report_period
+        self.achieved_rate = 0.0
+        self.capture_rate = 0.0
+        self._frames = 0
+        self._period_start = None
+        self._captured_at_start = 0
+        self._timestamp_at_start = None
+
+    def tick(self, frames_captured=None, capture_timestamp=None):
+        """
+        Counts one processed frame.
+
+        params:
+            - frames_captured: running count of frames delivered by the camera, [None]
+            - capture_timestamp: capture timestamp (datetime) of the newest frame delivered, [None]
+        """
+        now = time.perf_counter()
+        if self._period_start is None:
+            self._start_period(now, frames_captured, capture_timestamp)
+            return
+
+        self._frames += 1
+        elapsed = now - self._period_start
+        if elapsed < self.report_period:
+            return
+
+        self.achieved_rate = self._frames / elapsed
+        if frames_captured is not None:
+            capture_elapsed = elapsed
+            if capture_timestamp is not None and self._timestamp_at_start is not None:
+                capture_elapsed = (capture_timestamp - self._timestamp_at_start).total_seconds()
+            if capture_elapsed > 0:
+                self.capture_rate = (frames_captured - self._captured_at_start) / capture_elapsed
+        LOGGER.info(f"Processed {self.achieved_rate:.1f} fps, camera delivered {self.capture_rate:.1f} fps, "
+                    f"configured frame rate {self.expected_rate} fps")
+
+        self._start_period(now, frames_captured, capture_timestamp)
+
+    def _start_period(self, now, frames_captured, capture_timestamp):
+        """
+        Starts a new measurement period.
+        """
+        self._frames = 0
+        self._period_start = now
+        self._captured_at_start = frames_captured or 0
+        self._timestamp_at_start = capture_timestamp
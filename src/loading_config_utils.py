@@ -1,8 +1,6 @@
 from data.aruco_dict_types import ARUCO_DICT
-import numpy as np
+from src.render_profiles import RENDER_PROFILES, DEFAULT_RENDER_PROFILE
 import os
-import numpy as np
-import sksurgeryvtk.models.vtk_surface_model_directory_loader as vdl
 
 
 def parse_int_tuple(input):
@@ -16,6 +14,8 @@ def load_matrix(name: str,
     """
     Loads a matrix and checks size.
     """
+    # imported here, so that the config can be loaded and checked without numpy
+    import numpy as np
     matrix = np.loadtxt(path_to_file)
     exp_rows, exp_cols = expected_shape
 
@@ -38,10 +38,15 @@ def load_matrix(name: str,
 
 def create_model_loader(path_to_directory: str,
                         rendering_defaults: str,
-                        is_mandatory: bool = True):
+                        is_mandatory: bool = True,
+                        cache_dir: str = None,
+                        defer_hidden: bool = True):
     """
     Loads models using sksurgeryvtk.models.vtk_surface_model_directory_loader,
     and returns the actual loader object containing all the models.
+    If cache_dir is given, models are loaded in parallel through a cache of
+    preprocessed meshes instead (see src.model_cache), and models hidden at
+    start are only loaded later if defer_hidden.
     """
     if path_to_directory is None or len(path_to_directory) == 0:
         raise ValueError(f"Invalid directory passed in:{path_to_directory}")
@@ -54,7 +59,13 @@ def create_model_loader(path_to_directory: str,
     if not os.path.isfile(defaults_file):
         raise ValueError(f"The rendering defaults file:{defaults_file}, does not exist.")
 
-    loader = vdl.VTKSurfaceModelDirectoryLoader(path_to_directory, defaults_file)
+    # imported here, so that headless tools can load the config without VTK
+    if cache_dir is not None:
+        from src.model_cache import CachedModelLoader
+        loader = CachedModelLoader(path_to_directory, defaults_file, cache_dir, defer_hidden=defer_hidden)
+    else:
+        import sksurgeryvtk.models.vtk_surface_model_directory_loader as vdl
+        loader = vdl.VTKSurfaceModelDirectoryLoader(path_to_directory, defaults_file)
 
     if is_mandatory and loader is None:
         raise ValueError(f"Failed to create VTKSurfaceModelDirectoryLoader from {path_to_directory}, and {rendering_defaults}.")
@@ -62,34 +73,83 @@ def create_model_loader(path_to_directory: str,
     return loader
 
 
-def load_aruco_config(config):
-    section = config['ARUCO']  # extracting first section of ini file
+def load_board_printing_config(config):
+    """
+    Loads the settings the boards of load_tool_config are printed with, from
+    [ARUCO]: border_bits, gap_between_markers_in_bits, pixels_per_bit, and
+    save_paths, the file each tool's board is saved to. Returns a dict.
+    """
+    section = config['ARUCO']
+
+    printing_args = dict()
+    printing_args['border_bits'] = int(section["border_bits"])
+    printing_args['gap_between_markers_in_bits'] = int(section["gap_between_markers_in_bits"])
+    printing_args['pixels_per_bit'] = int(section["pixels_per_bit"])
+
+    save_paths = {'board': section["save_path"],
+                  'pointer': section.get("pointer_save_path", "data/resources/aruco_boards/pointer_board.png")}
+    for section_name in config.sections():
+        if section_name.startswith('TOOL:'):
+            name = section_name[len('TOOL:'):].strip()
+            save_paths[name] = config[section_name].get("save_path", f"data/resources/aruco_boards/{name}_board.png")
+    printing_args['save_paths'] = save_paths
 
-    # extract args from config file section 'ARUCO'
-    aruco_dict = ARUCO_DICT[section["aruco_dict"]]
+    return printing_args
 
-    # aruco_dict = cv2.aruco.getPredefinedDictionary(aruco_dict_num)
-    size_in_bits = int(section["size_in_bits"])
-    border_bits = int(section["border_bits"])
-    gap_between_markers_in_bits = int(section["gap_between_markers_in_bits"])
-    marker_length = int(section["marker_length"])
-    markers_w = int(section["markers_w"])
-    markers_h = int(section["markers_h"])
-    pixels_per_bit = int(section["pixels_per_bit"])
-    save_path = section["save_path"]
-    marker_separation = float(section["marker_separation"])
 
-    pointer_present = bool(section["pointer_present"])
-    if pointer_present:
-        pointer_aruco_dict = ARUCO_DICT[section["pointer_aruco_dict"]]
-        pointer_marker_length = int(section["pointer_marker_length"])
-        pointer_markers_w = int(section["pointer_markers_w"])
-        pointer_markers_h = int(section["pointer_markers_h"])
-        pointer_marker_separation = float(section["pointer_marker_separation"])
-        pointer_save_path = section["pointer_save_path"]
+def load_tool_config(config):
+    """
+    Loads the tracked tools: the board of [ARUCO], which is the world
+    reference, the pointer of [ARUCO] if pointer_present, then one tool per
+    [TOOL:<name>] section, in order.
+
+    Tools sharing a dictionary are told apart by marker id, so each board uses
+    markers_w * markers_h consecutive ids from its first_id, and the id ranges
+    of tools sharing a dictionary must not overlap.
 
-    return aruco_dict, size_in_bits, border_bits, gap_between_markers_in_bits, marker_length, markers_w, markers_h, pixels_per_bit, save_path, marker_separation, pointer_marker_length, pointer_markers_w, pointer_markers_h, pointer_marker_separation, pointer_aruco_dict, pointer_save_path
+    Returns a list of (name, board_args), board_args being the keyword
+    arguments of aruco_utils.create_board_tracker.
+    """
+    section = config['ARUCO']
+    tools = [('board', dict(aruco_dict_type=ARUCO_DICT[section["aruco_dict"]],
+                            markers_w=int(section["markers_w"]),
+                            markers_h=int(section["markers_h"]),
+                            marker_length=int(section["marker_length"]),
+                            marker_separation=float(section["marker_separation"]),
+                            first_id=int(section.get("first_id", 0))))]
+    if _get_bool(section, "pointer_present", True):
+        tools.append(('pointer', dict(aruco_dict_type=ARUCO_DICT[section["pointer_aruco_dict"]],
+                                      markers_w=int(section["pointer_markers_w"]),
+                                      markers_h=int(section["pointer_markers_h"]),
+                                      marker_length=int(section["pointer_marker_length"]),
+                                      marker_separation=float(section["pointer_marker_separation"]),
+                                      first_id=int(section.get("pointer_first_id", 0)))))
 
+    for section_name in config.sections():
+        if not section_name.startswith('TOOL:'):
+            continue
+        name = section_name[len('TOOL:'):].strip()
+        if name in [tool_name for tool_name, _ in tools]:
+            raise ValueError(f"Tool {name} of [{section_name}] is already defined.")
+        tool = config[section_name]
+        tools.append((name, dict(aruco_dict_type=ARUCO_DICT[tool["aruco_dict"]],
+                                 markers_w=int(tool["markers_w"]),
+                                 markers_h=int(tool["markers_h"]),
+                                 marker_length=float(tool["marker_length"]),
+                                 marker_separation=float(tool["marker_separation"]),
+                                 first_id=int(tool.get("first_id", 0)))))
+
+    for i, (name, board_args) in enumerate(tools):
+        first = board_args['first_id']
+        last = first + board_args['markers_w'] * board_args['markers_h']
+        for other_name, other_args in tools[:i]:
+            other_first = other_args['first_id']
+            other_last = other_first + other_args['markers_w'] * other_args['markers_h']
+            if board_args['aruco_dict_type'] == other_args['aruco_dict_type'] and \
+                    first < other_last and other_first < last:
+                raise ValueError(f"Tools {other_name} and {name} use the same dictionary and overlapping "
+                                 f"marker ids [{other_first}, {other_last}) and [{first}, {last}).")
+    return tools
 
 
 def load_AR_display_config(config):
@@ -117,3 +177,194 @@ def load_AR_display_config(config):
     frame_rate = int(AR_section["frame_rate"])
 
     return intrinsics_pth, distortion_pth, video_source, registration_matrix, models, rendering_defaults, frame_rate
+
+
+def _get_bool(section, key, default):
+    """
+    Reads a boolean from a config section (or dict), the same way configparser does.
+    """
+    value = section.get(key, None)
+    if value is None:
+        return default
+    return str(value).strip().lower() in ('1', 'yes', 'true', 'on')
+
+
+def load_tracking_config(config):
+    """
+    Loads the optional [TRACKING] section, falling back to defaults for
+    anything not given. Returns a dict that can be merged into cl_args.
+    """
+    section = config['TRACKING'] if config.has_section('TRACKING') else {}
+
+    tracking_args = dict()
+
+    # detect markers on the raw (distorted) grey frame and undistort only the corners
+    tracking_args['detect_on_raw_frame'] = _get_bool(section, "detect_on_raw_frame", True)
+
+    # only search the region around boards tracked in the previous frame
+    tracking_args['roi_detection'] = _get_bool(section, "roi_detection", True)
+    tracking_args['roi_padding'] = float(section.get("roi_padding", 0.25))
+    tracking_args['full_frame_period'] = int(section.get("full_frame_period", 30))
+
+    # detect on a downscaled image, chosen from the marker size predicted by the last pose
+    tracking_args['pyramid_detection'] = _get_bool(section, "pyramid_detection", False)
+    tracking_args['pyramid_min_marker_pixels'] = float(section.get("pyramid_min_marker_pixels", 40))
+    tracking_args['pyramid_max_level'] = int(section.get("pyramid_max_level", 2))
+
+    # full detection every K frames, optical flow in between while enough corners are followed
+    tracking_args['klt_detection_interval'] = int(section.get("klt_detection_interval", 1))
+    tracking_args['klt_min_quality'] = float(section.get("klt_min_quality", 0.8))
+
+    return tracking_args
+
+
+def load_AR_display_options(config):
+    """
+    Loads the optional performance related settings of the [AR_DISPLAY] section,
+    falling back to defaults for anything not given. Returns a dict that can be
+    merged into cl_args.
+    """
+    section = config['AR_DISPLAY'] if config.has_section('AR_DISPLAY') else {}
+
+    display_args = dict()
+
+    # process frames as they arrive (frame_driven), or poll at frame_rate (timer)
+    display_args['scheduler'] = section.get("scheduler", "frame_driven").strip()
+    if display_args['scheduler'] not in ('frame_driven', 'timer'):
+        raise ValueError(f"Unknown scheduler {display_args['scheduler']}, expected frame_driven or timer.")
+
+    # number of frames kept by the capture thread. The oldest is dropped when full.
+    display_args['capture_buffer_size'] = int(section.get("capture_buffer_size", 2))
+
+    # track the next frame on a worker thread while the current one is rendered
+    display_args['pipelined'] = _get_bool(section, "pipelined", True)
+
+    # number of recycled frame buffer sets (one being tracked, one waiting, one displayed)
+    display_args['frame_buffer_count'] = int(section.get("frame_buffer_count", 3))
+
+    # draw detected markers and board axes on the video
+    display_args['annotate'] = _get_bool(section, "annotate", True)
+
+    # directory where undistortion maps derived from the calibration are cached between runs, None to not cache
+    display_args['calibration_cache'] = section.get("calibration_cache", "").strip() or None
+
+    # overlay render profile, one of src.render_profiles.RENDER_PROFILES
+    display_args['render_profile'] = section.get("render_profile", DEFAULT_RENDER_PROFILE).strip()
+    if display_args['render_profile'] not in RENDER_PROFILES:
+        raise ValueError(f"Unknown render profile {display_args['render_profile']}, "
+                         f"expected one of {', '.join(RENDER_PROFILES)}.")
+
+    # directory where models are cached cleaned and with normals, None to parse the model files at each start
+    display_args['model_cache'] = section.get("model_cache", "").strip() or None
+
+    # with model_cache, load the models hidden at start in the background once the GUI is up
+    display_args['defer_hidden_models'] = _get_bool(section, "defer_hidden_models", True)
+
+    return display_args
+
+
+def load_performance_config(config):
+    """
+    Loads the optional [PERFORMANCE] section, falling back to defaults for
+    anything not given. Returns a dict that can be merged into cl_args.
+    """
+    section = config['PERFORMANCE'] if config.has_section('PERFORMANCE') else {}
+
+    performance_args = dict()
+
+    # number of frames the per-stage latency statistics are computed over
+    performance_args['perf_stats_window'] = int(section.get("perf_stats_window", 600))
+
+    # draw the per-stage latencies on the video
+    performance_args['perf_hud'] = _get_bool(section, "perf_hud", False)
+    performance_args['perf_hud_period'] = float(section.get("perf_hud_period", 0.5))
+
+    # periodic export of the statistics as json, to a file and/or a local UDP port
+    performance_args['perf_export_path'] = section.get("perf_export_path", "").strip() or None
+    performance_args['perf_export_port'] = int(section.get("perf_export_port", 0)) or None
+    performance_args['perf_export_period'] = float(section.get("perf_export_period", 5.0))
+
+    return performance_args
+
+
+def load_recording_config(config):
+    """
+    Loads the optional [RECORDING] section, falling back to defaults for
+    anything not given. Returns a dict that can be merged into cl_args.
+    """
+    section = config['RECORDING'] if config.has_section('RECORDING') else {}
+
+    recording_args = dict()
+
+    # session directory the raw frames and tracking are recorded to, None to not record
+    recording_args['record_session'] = section.get("record_session", "").strip() or None
+
+    # replay recorded sessions (given as video_source) at their original timing, or as fast as possible (max)
+    recording_args['replay_timing'] = section.get("replay_timing", "original").strip()
+    if recording_args['replay_timing'] not in ('original', 'max'):
+        raise ValueError(f"Unknown replay timing {recording_args['replay_timing']}, expected original or max.")
+
+    return recording_args
+
+
+def load_scene_config(config):
+    """
+    Loads the optional [SCENE] section, binding models to the tracked tools they
+    move with, as tool = model, model. Without the section, the tweezers model
+    moves with the pointer, if it is tracked. Returns a dict that can be merged into cl_args.
+    """
+    thresholds = ('pose_threshold_mm', 'pose_threshold_deg')
+    if config.has_section('SCENE'):
+        section = config['SCENE']
+        # options of [DEFAULT] show up in every section, so they are skipped
+        bindings = {tool: [name.strip() for name in section[tool].split(',') if name.strip()]
+                    for tool in section
+                    if tool not in thresholds and tool not in config.defaults()}
+    else:
+        section = {}
+        pointer_tracked = config.has_section('ARUCO') and _get_bool(config['ARUCO'], "pointer_present", True)
+        bindings = {'pointer': ['tweezers']} if pointer_tracked else {}
+
+    scene_args = dict()
+    scene_args['scene_bindings'] = bindings
+
+    # a tool's models are only moved when its pose changed by more than this
+    scene_args['pose_threshold_mm'] = float(section.get("pose_threshold_mm", 0.5))
+    scene_args['pose_threshold_deg'] = float(section.get("pose_threshold_deg", 0.2))
+
+    return scene_args
+
+
+def load_calibration_config(config):
+    """
+    Loads the [CALIBRATION] section. Returns a dict.
+    """
+    section = config['CALIBRATION']
+
+    calibration_args = dict()
+
+    # folder of recorded calibration images, or a video of the calibration pattern
+    calibration_args['save_path_imgs'] = section["save_path_imgs"]
+
+    # aruco board (from [ARUCO]) or checkerboard
+    calibration_args['calibration_type'] = section["calibration_type"].strip()
+    if calibration_args['calibration_type'] not in ('aruco', 'checkerboard'):
+        raise ValueError(f"Unknown calibration type {calibration_args['calibration_type']}, "
+                         f"expected aruco or checkerboard.")
+
+    # inner corners of the checkerboard, eg. (9, 7)
+    calibration_args['checkerboard_dims'] = parse_int_tuple(section["checkerboard_dims"].strip())
+
+    # folder intrinsics.txt and distortion.txt are written to
+    calibration_args['calibration_data'] = section["calibration_data"]
+
+    # calibrate live from the camera instead of from save_path_imgs
+    calibration_args['run_live'] = _get_bool(section, "run_live", False)
+
+    # batch calibration: every frame_step-th frame of a video is used, at most max_views views,
+    # and bootstrap_samples calibrations on resampled views estimate the uncertainty
+    calibration_args['frame_step'] = int(section.get("frame_step", 10))
+    calibration_args['max_views'] = int(section.get("max_views", 80))
+    calibration_args['bootstrap_samples'] = int(section.get("bootstrap_samples", 20))
+
+    return calibration_args
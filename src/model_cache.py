@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+"""
+Loading of the surface models with a cache of preprocessed meshes: each
+mesh is cleaned and given normals once, then saved as uncompressed binary
+VTK polydata (.vtp), keyed by the hash of the source file and of its
+rendering_defaults.json entry. Later starts only read the cached files.
+
+Meshes missing from the cache are preprocessed in parallel processes,
+cached meshes are read in parallel threads, and models that are not
+visible at start can be loaded in the background once the GUI is up.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from src.model_lod import ModelLOD
+
+LOGGER = logging.getLogger(__name__)
+
+MODEL_EXTENSIONS = ('.vtk', '.vtp', '.stl', '.ply', '.obj')
+
+# bumped when preprocess_model changes, so old cache entries are not used
+CACHE_VERSION = 1
+
+# used for models without an entry in rendering_defaults.json
+DEFAULT_RENDERING = {"colour": [255, 255, 255],
+                     "opacity": 1.0,
+                     "visibility": True,
+                     "pickable": True,
+                     "outline": False}
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    Returns the hex digest of a file's content.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(source_path, rendering, vtk_version):
+    """
+    Returns the cache key of a model: its file content, its rendering
+    settings, the VTK version and the preprocessing version.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(file_hash(source_path).encode('ascii'))
+    digest.update(json.dumps(rendering, sort_keys=True).encode('utf-8'))
+    digest.update(f"{vtk_version}/{CACHE_VERSION}".encode('ascii'))
+    return digest.hexdigest()
+
+
+def read_polydata(path):
+    """
+    Reads a mesh file into vtkPolyData.
+    """
+    import vtk
+    readers = {'.vtk': vtk.vtkPolyDataReader,
+               '.vtp': vtk.vtkXMLPolyDataReader,
+               '.stl': vtk.vtkSTLReader,
+               '.ply': vtk.vtkPLYReader,
+               '.obj': vtk.vtkOBJReader}
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in readers:
+        raise ValueError(f"Unsupported model file {path}, expected one of {MODEL_EXTENSIONS}.")
+    reader = readers[extension]()
+    reader.SetFileName(path)
+    reader.Update()
+    return reader.GetOutput()
+
+
+def _with_normals(port):
+    """
+    Returns a filter computing the normals of port's output, oriented as
+    VTKSurfaceModel would, which then doesn't recompute them.
+    """
+    import vtk
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(port)
+    normals.SetAutoOrientNormals(True)
+    normals.SetFlipNormals(False)
+    return normals
+
+
+def _write_polydata(port, path):
+    """
+    Writes port's output to path as raw appended binary .vtp, so reading it
+    back is little more than a copy. The file only appears once complete.
+    """
+    import vtk
+    tmp_path = path + '.tmp'
+    writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetInputConnection(port)
+    writer.SetFileName(tmp_path)
+    writer.SetDataModeToAppended()
+    writer.EncodeAppendedDataOff()
+    writer.SetCompressorTypeToNone()
+    if writer.Write() != 1:
+        raise RuntimeError(f"Failed to write the preprocessed model {path}")
+    os.replace(tmp_path, path)
+
+
+def preprocess_model(source_path, cache_path, reductions=(), lod_paths=()):
+    """
+    Cleans a mesh (merging duplicate points, removing degenerate cells),
+    computes its normals and writes it to cache_path, then writes a
+    decimated version per level of detail. Runs in a worker process.
+
+    params:
+        - source_path: mesh file
+        - cache_path: .vtp file of the full resolution mesh
+        - reductions: fraction of the triangles removed by each level of detail, [()]
+        - lod_paths: .vtp file of each level of detail, [()]
+    returns:
+        - cache_path
+    """
+    import vtk
+    clean = vtk.vtkCleanPolyData()
+    clean.SetInputData(read_polydata(source_path))
+    _write_polydata(_with_normals(clean.GetOutputPort()).GetOutputPort(), cache_path)
+
+    # quadric decimation only takes triangles
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputConnection(clean.GetOutputPort())
+    for reduction, lod_path in zip(reductions, lod_paths):
+        # decimation moves points, so the normals are computed again
+        decimation = vtk.vtkQuadricDecimation()
+        decimation.SetInputConnection(triangles.GetOutputPort())
+        decimation.SetTargetReduction(reduction)
+        decimation.VolumePreservationOn()
+        _write_polydata(_with_normals(decimation.GetOutputPort()).GetOutputPort(), lod_path)
+    return cache_path
+
+
+def lod_levels(rendering):
+    """
+    Returns the levels of detail of a rendering_defaults.json entry, from
+    the finest to the coarsest. Each has the fraction of triangles removed
+    ("reduction") and the projected size, in pixels, below which it is
+    used ("max_pixels").
+    """
+    levels = sorted(rendering.get("lod", []), key=lambda level: -level["max_pixels"])
+    for level in levels:
+        if not 0 < level["reduction"] < 1 or level["max_pixels"] <= 0:
+            raise ValueError(f"Invalid level of detail {level}, expected 0 < reduction < 1 and max_pixels > 0.")
+    return levels
+
+
+def create_model(name, path, rendering):
+    """
+    Creates a VTKSurfaceModel from a mesh file and its rendering settings
+    (colours 0-255, as in rendering_defaults.json).
+    """
+    from sksurgeryvtk.models.vtk_surface_model import VTKSurfaceModel
+    model = VTKSurfaceModel(path,
+                            [c / 255.0 for c in rendering["colour"]],
+                            visibility=rendering["visibility"],
+                            opacity=rendering["opacity"],
+                            pickable=rendering["pickable"],
+                            outline=rendering["outline"])
+    model.set_name(name)
+    return model
+
+
+def create_model_with_lod(name, path, rendering, lod_paths):
+    """
+    Creates a VTKSurfaceModel as create_model, and its levels of detail if
+    rendering has any.
+
+    returns:
+        - model, ModelLOD or None
+    """
+    model = create_model(name, path, rendering)
+    if len(lod_paths) == 0:
+        return model, None
+    levels = [(read_polydata(lod_path), level["max_pixels"])
+              for lod_path, level in zip(lod_paths, lod_levels(rendering))]
+    return model, ModelLOD(model, levels)
+
+
+class CachedModelLoader:
+    """
+    Loads every model of a directory, like
+    sksurgeryvtk's VTKSurfaceModelDirectoryLoader, through the preprocessed
+    mesh cache. The loaded models are in .models, and the levels of detail
+    of those that have any in .lods.
+    """
+
+    def __init__(self, directory, defaults_file, cache_dir, defer_hidden=True, workers=None):
+        """
+        CachedModelLoader constructor. Loads the models visible at start.
+
+        params:
+            - directory: directory holding the model files
+            - defaults_file: rendering_defaults.json, with an entry per model name
+            - cache_dir: directory of the preprocessed meshes
+            - defer_hidden: only load models not visible at start with load_deferred, [True]
+            - workers: number of processes and threads used to load, [os.cpu_count()]
+        """
+        import vtk
+        self.vtk_version = vtk.vtkVersion.GetVTKVersion()
+        self.cache_dir = cache_dir
+        self.workers = workers
+        os.makedirs(cache_dir, exist_ok=True)
+
+        with open(defaults_file) as f:
+            self.configuration_data = json.load(f)
+
+        # (name, source file, rendering settings) per model, in file name order
+        entries = []
+        for file_name in sorted(os.listdir(directory)):
+            name, extension = os.path.splitext(file_name)
+            if extension.lower() not in MODEL_EXTENSIONS:
+                continue
+            rendering = dict(DEFAULT_RENDERING)
+            rendering.update(self.configuration_data.get(name, {}))
+            entries.append((name, os.path.join(directory, file_name), rendering))
+
+        self.models = []
+        self.lods = []
+        self.deferred = [entry for entry in entries if defer_hidden and not entry[2]["visibility"]]
+        self._load([entry for entry in entries if entry not in self.deferred])
+        LOGGER.info(f"Loaded {len(self.models)} models, {len(self.deferred)} deferred")
+
+    def _cached_paths(self, entries):
+        """
+        Returns the cached file and levels of detail files of each entry,
+        preprocessing the ones not cached yet in parallel.
+        """
+        paths = []
+        missing = []
+        for _, source, rendering in entries:
+            key = cache_key(source, rendering, self.vtk_version)
+            path = os.path.join(self.cache_dir, key + '.vtp')
+            levels = lod_levels(rendering)
+            lod_paths = [os.path.join(self.cache_dir, f"{key}_lod{i + 1}.vtp") for i in range(len(levels))]
+            paths.append((path, lod_paths))
+            if not all(os.path.isfile(p) for p in [path] + lod_paths):
+                missing.append((source, path, [level["reduction"] for level in levels], lod_paths))
+
+        if len(missing) == 1:
+            preprocess_model(*missing[0])
+        elif len(missing) > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(preprocess_model, *zip(*missing)))
+        if missing:
+            LOGGER.info(f"Preprocessed {len(missing)} models into {self.cache_dir}")
+        return paths
+
+    def _load(self, entries):
+        """
+        Creates the models of entries from their cached files, and adds them
+        to .models and .lods. No rendering happens here, so the VTK objects
+        can be created off the GUI thread.
+
+        returns:
+            - list of the models created
+        """
+        if len(entries) == 0:
+            return []
+        paths = self._cached_paths(entries)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            loaded = list(executor.map(create_model_with_lod,
+                                       [name for name, _, _ in entries],
+                                       [path for path, _ in paths],
+                                       [rendering for _, _, rendering in entries],
+                                       [lod_paths for _, lod_paths in paths]))
+        models = [model for model, _ in loaded]
+        self.models.extend(models)
+        self.lods.extend(lod for _, lod in loaded if lod is not None)
+        return models
+
+    def load_deferred(self):
+        """
+        Loads the models deferred at start and adds them to .models.
+
+        returns:
+            - list of the models loaded
+        """
+        models = self._load(self.deferred)
+        self.deferred = []
+        return models
+
+    def load_deferred_in_background(self):
+        """
+        Runs load_deferred on a background thread.
+
+        returns:
+            - concurrent.futures.Future of the list of models loaded
+        """
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(self.load_deferred)
+        executor.shutdown(wait=False)
+        return future
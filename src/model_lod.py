@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+"""
+Level of detail switching for the overlay models: each model with
+decimated versions is drawn with the coarsest one whose size threshold its
+projected size on screen is below.
+"""
+
+import math
+import numpy as np
+
+
+class ModelLOD:
+    """
+    Levels of detail of one VTKSurfaceModel. Switching level swaps the
+    mapper of the model's actor, so the actor keeps its user matrix and
+    properties (colour, opacity, visibility).
+    """
+
+    def __init__(self, model, levels, hysteresis=0.1):
+        """
+        ModelLOD constructor.
+
+        params:
+            - model: VTKSurfaceModel, drawn at full resolution at level 0
+            - levels: list of (vtkPolyData, max_pixels), from the finest to the coarsest.
+                      A level is used when the model's projected size is below its max_pixels.
+            - hysteresis: fraction above max_pixels the projected size must reach to go back
+                          to a finer level, so the level doesn't flicker at a threshold, [0.1]
+        """
+        import vtk
+        self.model = model
+        self.hysteresis = hysteresis
+        full_mapper = model.actor.GetMapper()
+        self.mappers = [full_mapper]
+        self.max_pixels = [math.inf]
+        for polydata, max_pixels in levels:
+            mapper = vtk.vtkPolyDataMapper()
+            mapper.SetInputData(polydata)
+            mapper.SetScalarVisibility(full_mapper.GetScalarVisibility())
+            self.mappers.append(mapper)
+            self.max_pixels.append(max_pixels)
+        self.level = 0
+
+    def projected_size(self, camera_to_world, focal_length):
+        """
+        Returns the diameter in pixels of the model's bounding sphere, seen
+        from the camera, or inf if the camera is inside it.
+        """
+        bounds = np.array(self.model.actor.GetBounds()).reshape((3, 2))
+        centre = bounds.mean(axis=1)
+        radius = 0.5 * np.linalg.norm(bounds[:, 1] - bounds[:, 0])
+        # depth of the centre along the camera's viewing direction
+        depth = camera_to_world[0:3, 2] @ (centre - camera_to_world[0:3, 3])
+        if depth <= radius:
+            return math.inf
+        return 2.0 * radius * focal_length / depth
+
+    def update(self, camera_to_world, focal_length):
+        """
+        Switches to the level of detail matching the model's projected size.
+        Hidden models are left as they are.
+
+        params:
+            - camera_to_world: 4x4 camera pose, as given to the overlay window
+            - focal_length: focal length of the rendered image, in pixels
+        returns:
+            - True if the level changed
+        """
+        if not self.model.actor.GetVisibility():
+            return False
+        pixels = self.projected_size(camera_to_world, focal_length)
+        level = self.level
+        while level + 1 < len(self.mappers) and pixels < self.max_pixels[level + 1]:
+            level += 1
+        while level > 0 and pixels > self.max_pixels[level] * (1.0 + self.hysteresis):
+            level -= 1
+        if level == self.level:
+            return False
+        self.model.actor.SetMapper(self.mappers[level])
+        self.level = level
+        return True
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+"""
+Headless board and pointer tracking over recorded videos. Doesn't use
+PySide6 or VTK, so it can run on machines without a display.
+"""
+
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+from src.aruco_utils import create_board_tracker
+from src.aruco_tracking import MultiBoardTracker
+from src.undistortion_utils import UndistortionEngine
+
+LOGGER = logging.getLogger(__name__)
+
+
+def create_tracking(tools, intrinsics, distortion, tracking_args):
+    """
+    Creates the BoardTrackers and MultiBoardTracker for the given tools.
+
+    params:
+        - tools: list of (name, board_args) where board_args are the keyword
+                 arguments of create_board_tracker (aruco_dict_type, markers_w, ...)
+        - intrinsics: camera matrix (3x3)
+        - distortion: distortion coefficients (1x5)
+        - tracking_args: dict returned by load_tracking_config
+    returns:
+        - list of BoardTracker, MultiBoardTracker
+    """
+    parameters = cv2.aruco.DetectorParameters()
+    tracking_distortion = distortion if tracking_args['detect_on_raw_frame'] else None
+    trackers = [create_board_tracker(intrinsics, tracking_distortion, parameters=parameters, **board_args)
+                for _, board_args in tools]
+    tracking = MultiBoardTracker(trackers, parameters,
+                                 use_roi=tracking_args['roi_detection'],
+                                 roi_padding=tracking_args['roi_padding'],
+                                 full_frame_period=tracking_args['full_frame_period'],
+                                 use_pyramid=tracking_args['pyramid_detection'],
+                                 min_marker_pixels=tracking_args['pyramid_min_marker_pixels'],
+                                 max_pyramid_level=tracking_args['pyramid_max_level'],
+                                 detection_interval=tracking_args['klt_detection_interval'],
+                                 min_flow_quality=tracking_args['klt_min_quality'])
+    return trackers, tracking
+
+
+def seek_frame(video, frame_index):
+    """
+    Moves a newly opened cv2.VideoCapture to frame_index, so the next read() returns it.
+
+    Seeking with CAP_PROP_POS_FRAMES isn't frame accurate on compressed video
+    for some backends, which land on a nearby keyframe. If the position read
+    back doesn't match, the video is decoded from its start up to frame_index.
+
+    returns:
+        - True if the video is at frame_index
+    """
+    if frame_index == 0:
+        return True
+    video.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+    if int(video.get(cv2.CAP_PROP_POS_FRAMES)) == frame_index:
+        return True
+    LOGGER.info(f"Seeking to frame {frame_index} isn't frame accurate, decoding from the start instead")
+    video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    for _ in range(frame_index):
+        if not video.grab():
+            return False
+    return True
+
+
+def track_chunk(video_path, first_frame, last_frame, tools, intrinsics, distortion, tracking_args):
+    """
+    Tracks all tools in frames [first_frame, last_frame) of a video. Runs in a worker process.
+    If last_frame is None, the chunk goes on to the end of the video, as the
+    frame count reported by the container may only be an estimate.
+
+    returns:
+        - dict of per-frame columns: frame_index, timestamp, and for each tool
+          <name>_ok, <name>_pose, <name>_reprojection_error and <name>_ids (list of arrays)
+    """
+    trackers, tracking = create_tracking(tools, intrinsics, distortion, tracking_args)
+    undistortion = None if tracking_args['detect_on_raw_frame'] else UndistortionEngine(intrinsics, distortion)
+
+    video = cv2.VideoCapture(video_path)
+    if not seek_frame(video, first_frame):
+        LOGGER.warning(f"{video_path} ends before frame {first_frame}")
+        last_frame = first_frame
+
+    # the number of frames of the last chunk isn't known, so its columns grow as needed
+    frame_count = last_frame - first_frame if last_frame is not None else 0
+    columns = {'frame_index': [], 'timestamp': []}
+    for name, _ in tools:
+        columns[f'{name}_ok'] = []
+        columns[f'{name}_pose'] = []
+        columns[f'{name}_reprojection_error'] = []
+        columns[f'{name}_ids'] = []
+
+    grey = None
+    read = 0
+    while last_frame is None or read < frame_count:
+        ret, image = video.read()
+        if not ret:
+            break
+        # frames are counted from the verified seek position, so each gets its own index
+        columns['frame_index'].append(first_frame + read)
+        columns['timestamp'].append(video.get(cv2.CAP_PROP_POS_MSEC) / 1000.0)
+        read += 1
+        for name, _ in tools:
+            columns[f'{name}_ok'].append(False)
+            columns[f'{name}_pose'].append(np.full((4, 4), np.nan))
+            columns[f'{name}_reprojection_error'].append(np.nan)
+            columns[f'{name}_ids'].append(np.empty(0, np.int32))
+        row = read - 1
+
+        # cv2.VideoCapture reads frames as BGR
+        grey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=grey)
+        tracking_image = grey if undistortion is None else undistortion.undistort(grey)
+
+        for (name, _), tracker, (corners, ids) in zip(tools, trackers, tracking.detect(tracking_image)):
+            if ids is None:
+                tracker.reset()
+                continue
+            columns[f'{name}_ids'][row] = ids.ravel().astype(np.int32)
+            is_success, _, _ = tracker.estimate_pose(corners, ids)
+            if is_success:
+                columns[f'{name}_ok'][row] = True
+                columns[f'{name}_pose'][row] = tracker.pose
+                columns[f'{name}_reprojection_error'][row] = tracker.reprojection_error()
+
+    video.release()
+
+    if last_frame is not None and read < frame_count:
+        LOGGER.warning(f"Only read {read} of frames {first_frame} to {last_frame} of {video_path}")
+
+    columns['frame_index'] = np.array(columns['frame_index'], np.int64)
+    columns['timestamp'] = np.array(columns['timestamp'], np.float64)
+    for name, _ in tools:
+        columns[f'{name}_ok'] = np.array(columns[f'{name}_ok'], bool)
+        columns[f'{name}_pose'] = np.array(columns[f'{name}_pose'], np.float64).reshape((-1, 4, 4))
+        columns[f'{name}_reprojection_error'] = np.array(columns[f'{name}_reprojection_error'], np.float32)
+    return columns
+
+
+def _concatenate_chunks(chunks, tools):
+    """
+    Joins the columns of consecutive chunks. The ragged id lists are stored
+    as one flat array plus per-frame offsets.
+    """
+    columns = {'frame_index': np.concatenate([chunk['frame_index'] for chunk in chunks]),
+               'timestamp': np.concatenate([chunk['timestamp'] for chunk in chunks]),
+               'tools': np.array([name for name, _ in tools])}
+    for name, _ in tools:
+        for suffix in ('ok', 'pose', 'reprojection_error'):
+            key = f'{name}_{suffix}'
+            columns[key] = np.concatenate([chunk[key] for chunk in chunks])
+
+        ids = [frame_ids for chunk in chunks for frame_ids in chunk[f'{name}_ids']]
+        offsets = np.zeros(len(ids) + 1, np.int64)
+        offsets[1:] = np.cumsum([len(frame_ids) for frame_ids in ids])
+        columns[f'{name}_ids'] = np.concatenate(ids) if ids else np.empty(0, np.int32)
+        columns[f'{name}_ids_offsets'] = offsets
+    return columns
+
+
+def track_video(video_path, output_path, tools, intrinsics, distortion, tracking_args,
+                workers=None, chunk_size=500):
+    """
+    Tracks all tools over a video file, splitting it into chunks processed by a
+    process pool, and writes the per-frame results to a compressed .npz file.
+
+    The file has one array per column: frame_index, timestamp, tools (names),
+    and for each tool <name>_ok, <name>_pose (Nx4x4, board to camera),
+    <name>_reprojection_error (pixels) and the detected ids as <name>_ids with
+    <name>_ids_offsets, so the ids of frame i are ids[offsets[i]:offsets[i + 1]].
+
+    params:
+        - video_path: path of the recorded video
+        - output_path: path of the .npz file to write
+        - tools: list of (name, board_args), see create_tracking
+        - intrinsics, distortion: camera calibration
+        - tracking_args: dict returned by load_tracking_config
+        - workers: number of worker processes, [os.cpu_count()]
+        - chunk_size: number of frames per chunk, [500]
+    returns:
+        - dict of the columns written
+    """
+    if not os.path.isfile(video_path):
+        raise ValueError(f"Video file {video_path} does not exist.")
+
+    video = cv2.VideoCapture(video_path)
+    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    video.release()
+    if frame_count <= 0:
+        raise ValueError(f"Could not read the number of frames of {video_path}.")
+
+    # tracking restarts at the start of each chunk, so chunks shouldn't be too small.
+    # The frame count is only an estimate for many containers, so the last chunk reads to the end.
+    bounds = [(start, start + chunk_size) for start in range(0, frame_count, chunk_size)]
+    bounds[-1] = (bounds[-1][0], None)
+    LOGGER.info(f"Tracking {frame_count} frames of {video_path} in {len(bounds)} chunks")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(track_chunk, video_path, first, last, tools,
+                                   intrinsics, distortion, tracking_args)
+                   for first, last in bounds]
+        chunks = [future.result() for future in futures]
+
+    columns = _concatenate_chunks(chunks, tools)
+    if np.any(np.diff(columns['frame_index']) != 1):
+        LOGGER.warning(f"Frames of {video_path} are missing from the tracking, some couldn't be read")
+
+    output_dir = os.path.dirname(output_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    np.savez_compressed(output_path, **columns)
+    LOGGER.info(f"Saved tracking of {len(columns['frame_index'])} frames to {output_path}")
+    return columns
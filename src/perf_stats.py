@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+""" Lightweight per-stage latency statistics, with a HUD and periodic export. """
+
+import json
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+
+class StageTimer:
+    """
+    Keeps the last durations of one stage in a fixed-size ring buffer, so
+    recording a duration never allocates.
+    """
+
+    def __init__(self, window=600):
+        """
+        StageTimer constructor.
+
+        params:
+            - window: number of durations kept, [600]
+        """
+        self._durations = np.zeros(window, dtype=np.float64)
+        self._next = 0
+        self.count = 0
+        self.last_ms = 0.0
+
+    def add(self, duration_ms):
+        """
+        Records one duration (ms), overwriting the oldest one when full.
+        """
+        self._durations[self._next] = duration_ms
+        self._next = (self._next + 1) % len(self._durations)
+        self.count += 1
+        self.last_ms = duration_ms
+
+    def values(self):
+        """
+        Returns a copy of the durations currently in the window.
+        """
+        return self._durations[:min(self.count, len(self._durations))].copy()
+
+    def summary(self):
+        """
+        Returns the mean, percentiles and max of the durations in the window (ms).
+        """
+        values = self.values()
+        if len(values) == 0:
+            return {'count': 0}
+        p50, p90, p99 = np.percentile(values, (50, 90, 99))
+        return {'count': self.count,
+                'last_ms': self.last_ms,
+                'mean_ms': float(values.mean()),
+                'p50_ms': float(p50),
+                'p90_ms': float(p90),
+                'p99_ms': float(p99),
+                'max_ms': float(values.max())}
+
+    def histogram(self, bin_edges_ms):
+        """
+        Returns the number of durations in the window falling in each bin.
+        """
+        counts, _ = np.histogram(self.values(), bins=bin_edges_ms)
+        return counts
+
+
+class PerfStats:
+    """
+    Rolling latency statistics of the named stages of the frame loop.
+
+    Stages can be recorded from the capture, tracking and GUI threads, so
+    access to the timers is guarded by a lock. Recording costs two
+    perf_counter() calls and a ring buffer write.
+    """
+
+    # histogram bins (ms), the last one catches everything slower
+    HISTOGRAM_BINS_MS = (0, 1, 2, 5, 10, 20, 33, 50, 100, float('inf'))
+
+    def __init__(self, window=600, frame_budget_ms=None):
+        """
+        PerfStats constructor.
+
+        params:
+            - window: number of durations kept per stage, [600]
+            - frame_budget_ms: time available per frame (1000 / frame_rate), used to flag slow stages, [None]
+        """
+        self.window = window
+        self.frame_budget_ms = frame_budget_ms
+        self._timers = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        """
+        Records the duration of one run of a stage.
+        """
+        with self._lock:
+            timer = self._timers.get(stage)
+            if timer is None:
+                timer = StageTimer(self.window)
+                self._timers[stage] = timer
+            timer.add(1000.0 * seconds)
+
+    @contextmanager
+    def measure(self, stage):
+        """
+        Context manager recording the time spent in its block under stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def summary(self):
+        """
+        Returns a dict with the summary of each stage.
+        """
+        with self._lock:
+            return {stage: timer.summary() for stage, timer in self._timers.items()}
+
+    def histograms(self):
+        """
+        Returns a dict with the histogram of each stage over HISTOGRAM_BINS_MS.
+        """
+        with self._lock:
+            return {stage: timer.histogram(self.HISTOGRAM_BINS_MS).tolist()
+                    for stage, timer in self._timers.items()}
+
+    def snapshot(self):
+        """
+        Returns everything that is exported: time, budget, summaries and histograms.
+        """
+        return {'time': time.time(),
+                'frame_budget_ms': self.frame_budget_ms,
+                'histogram_bins_ms': [edge if np.isfinite(edge) else None for edge in self.HISTOGRAM_BINS_MS],
+                'stages': self.summary(),
+                'histograms': self.histograms()}
+
+    def format_text(self):
+        """
+        Returns a short text table of the stages, for the HUD or the log.
+        Stages whose p90 exceeds the frame budget are marked with '!'.
+        """
+        lines = [f"{'stage':<14}{'last':>7}{'p50':>7}{'p90':>7}{'max':>7} ms"]
+        for stage, summary in self.summary().items():
+            if summary['count'] == 0:
+                continue
+            over_budget = self.frame_budget_ms is not None and summary['p90_ms'] > self.frame_budget_ms
+            lines.append(f"{stage:<14}{summary['last_ms']:>7.1f}{summary['p50_ms']:>7.1f}"
+                         f"{summary['p90_ms']:>7.1f}{summary['max_ms']:>7.1f}{' !' if over_budget else ''}")
+        if self.frame_budget_ms is not None:
+            lines.append(f"budget {self.frame_budget_ms:.1f} ms")
+        return '\n'.join(lines)
+
+
+class PerfStatsExporter:
+    """
+    Periodically writes PerfStats snapshots as json lines to a file, and/or
+    sends them as UDP datagrams to a local port, so they can be watched from
+    another process without touching the display.
+    """
+
+    def __init__(self, stats, path=None, port=None, period=5.0, host='127.0.0.1'):
+        """
+        PerfStatsExporter constructor.
+
+        params:
+            - stats: PerfStats to export
+            - path: file the snapshots are appended to, [None]
+            - port: local UDP port the snapshots are sent to, [None]
+            - period: seconds between exports, [5]
+            - host: address the UDP datagrams are sent to, [127.0.0.1]
+        """
+        self.stats = stats
+        self.path = path
+        self.address = (host, port) if port else None
+        self.period = period
+        self._last_export = time.perf_counter()
+        self._socket = None
+        if self.address is not None:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.setblocking(False)
+
+    @property
+    def enabled(self):
+        """
+        True if there is somewhere to export to.
+        """
+        return bool(self.path) or self.address is not None
+
+    def maybe_export(self):
+        """
+        Exports a snapshot if the period has elapsed since the last one.
+        Cheap enough to call on every frame.
+        """
+        now = time.perf_counter()
+        if not self.enabled or now - self._last_export < self.period:
+            return
+        self._last_export = now
+        self.export()
+
+    def export(self):
+        """
+        Exports a snapshot now. Failures are logged, never raised, so the
+        display keeps running.
+        """
+        line = json.dumps(self.stats.snapshot())
+        if self.path:
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(line + '\n')
+            except OSError as error:
+                LOGGER.warning(f"Could not write performance stats to {self.path}: {error}")
+        if self._socket is not None:
+            try:
+                self._socket.sendto(line.encode('utf-8'), self.address)
+            except OSError as error:
+                LOGGER.debug(f"Could not send performance stats to {self.address}: {error}")
+
+    def close(self):
+        """
+        Closes the socket, if any.
+        """
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+class PerfHUD:
+    """
+    Draws the PerfStats text table in a corner of a VTKOverlayWindow.
+    """
+
+    def __init__(self, overlay_window, stats, period=0.5, font_size=14):
+        """
+        PerfHUD constructor.
+
+        params:
+            - overlay_window: sksurgeryvtk VTKOverlayWindow to draw on
+            - stats: PerfStats to show
+            - period: seconds between text updates, [0.5]
+            - font_size: font size of the text, [14]
+        """
+        import vtk
+
+        self.stats = stats
+        self.period = period
+        self._last_update = 0.0
+
+        self.text_actor = vtk.vtkTextActor()
+        self.text_actor.SetDisplayPosition(10, 10)
+        properties = self.text_actor.GetTextProperty()
+        properties.SetFontFamilyToCourier()
+        properties.SetFontSize(font_size)
+        properties.SetColor(1.0, 1.0, 0.0)
+        properties.SetBackgroundColor(0.0, 0.0, 0.0)
+        properties.SetBackgroundOpacity(0.5)
+        overlay_window.get_foreground_renderer().AddActor2D(self.text_actor)
+
+    def update(self):
+        """
+        Refreshes the text if the period has elapsed. Call on the GUI thread before Render().
+        """
+        now = time.perf_counter()
+        if now - self._last_update < self.period:
+            return
+        self._last_update = now
+        self.text_actor.SetInput(self.stats.format_text())
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""
+Render profiles of the overlay, trading visual fidelity for latency:
+transparency handling (depth peeling, or unsorted alpha blending),
+anti-aliasing, and the resolution the video background is uploaded at.
+Profiles can be timed offscreen, without a camera or a window.
+
+The profiles themselves only need the standard library, so the config can
+be checked against them before numpy is imported.
+"""
+
+import math
+import time
+
+# - depth_peeling: render translucent models with depth peeling, else blend them unsorted
+# - max_peels, occlusion_ratio: depth peeling stops after max_peels, or once less than
+#   occlusion_ratio of the pixels change
+# - fxaa: fast approximate anti-aliasing (multisampling can't be used with depth peeling)
+# - video_scale: the video background is scaled by this before upload, with the intrinsics
+#   scaled to match. The models are still rendered at the window's full resolution.
+RENDER_PROFILES = {
+    'quality': dict(depth_peeling=True, max_peels=100, occlusion_ratio=0.0, fxaa=True, video_scale=1.0),
+    'balanced': dict(depth_peeling=True, max_peels=4, occlusion_ratio=0.1, fxaa=False, video_scale=1.0),
+    'low_latency': dict(depth_peeling=False, max_peels=0, occlusion_ratio=0.0, fxaa=False, video_scale=0.5),
+}
+
+# used when the config doesn't set render_profile, as shipped in config/config.ini
+DEFAULT_RENDER_PROFILE = 'balanced'
+
+
+def apply_render_profile(render_window, renderer, profile):
+    """
+    Applies a profile of RENDER_PROFILES to the renderer the models are drawn by.
+    """
+    renderer.SetUseDepthPeeling(profile['depth_peeling'])
+    if profile['depth_peeling']:
+        render_window.SetAlphaBitPlanes(1)
+        render_window.SetMultiSamples(0)
+        renderer.SetMaximumNumberOfPeels(profile['max_peels'])
+        renderer.SetOcclusionRatio(profile['occlusion_ratio'])
+    renderer.SetUseFXAA(profile['fxaa'])
+
+
+def scale_intrinsics(intrinsics, scale):
+    """
+    Returns the intrinsics of images scaled by scale, pixel centres staying aligned.
+    """
+    import numpy as np
+    scaled = np.array(intrinsics, dtype=np.float64)
+    scaled[0:2, 0:2] *= scale
+    scaled[0:2, 2] = (scaled[0:2, 2] + 0.5) * scale - 0.5
+    return scaled
+
+
+def scaled_size(image_shape, scale):
+    """
+    Returns the (width, height) of an image of image_shape scaled by scale.
+    """
+    return max(1, round(image_shape[1] * scale)), max(1, round(image_shape[0] * scale))
+
+
+def benchmark_render_profile(actors, intrinsics, frame_size, profile, frame_count=200, seed=0):
+    """
+    Times the overlay rendering of a profile offscreen: each frame a new
+    video image is uploaded as the background, and the actors are drawn
+    from a camera orbiting them.
+
+    params:
+        - actors: vtkActors of the models, eg. [m.actor for m in loader.models]
+        - intrinsics: 3x3 camera matrix, used for the field of view
+        - frame_size: (width, height) of the video and window
+        - profile: one of RENDER_PROFILES
+        - frame_count: number of frames timed, [200]
+        - seed: random seed of the video images, [0]
+    returns:
+        - dict of the duration summary of each stage: scale, video_image, render, total
+    """
+    import cv2
+    import numpy as np
+    import vtk
+    from vtk.util import numpy_support
+    from src.tracking_benchmark import summarise_timings
+
+    width, height = frame_size
+    render_window = vtk.vtkRenderWindow()
+    render_window.SetOffScreenRendering(1)
+    render_window.SetSize(width, height)
+    render_window.SetNumberOfLayers(2)
+
+    # the video, drawn below the models as the overlay window does
+    scaled_width, scaled_height = scaled_size((height, width), profile['video_scale'])
+    image_data = vtk.vtkImageData()
+    image_data.SetDimensions(scaled_width, scaled_height, 1)
+    image_data.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 3)
+    pixels = numpy_support.vtk_to_numpy(image_data.GetPointData().GetScalars()).reshape(
+        (scaled_height, scaled_width, 3))
+    image_actor = vtk.vtkImageActor()
+    image_actor.SetInputData(image_data)
+    background = vtk.vtkRenderer()
+    background.SetLayer(0)
+    background.AddActor(image_actor)
+    background.ResetCamera()
+    background.InteractiveOff()
+    render_window.AddRenderer(background)
+
+    foreground = vtk.vtkRenderer()
+    foreground.SetLayer(1)
+    for actor in actors:
+        foreground.AddActor(actor)
+    render_window.AddRenderer(foreground)
+    apply_render_profile(render_window, foreground, profile)
+
+    # orbit the models at a distance where they fill about half the view
+    camera = foreground.GetActiveCamera()
+    camera.SetViewAngle(math.degrees(2.0 * math.atan(0.5 * height / intrinsics[1, 1])))
+    bounds = np.array(foreground.ComputeVisiblePropBounds()).reshape((3, 2))
+    centre = bounds.mean(axis=1)
+    radius = max(0.5 * np.linalg.norm(bounds[:, 1] - bounds[:, 0]), 1e-3)
+    distance = 4.0 * radius * intrinsics[1, 1] / height
+    camera.SetFocalPoint(*centre)
+    camera.SetViewUp(0, 1, 0)
+    camera.SetClippingRange(0.01, 5 * distance + radius)
+
+    rng = np.random.default_rng(seed)
+    videos = [rng.integers(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(4)]
+
+    times = {'scale': [], 'video_image': [], 'render': [], 'total': []}
+    for frame in range(frame_count):
+        angle = 2.0 * math.pi * frame / frame_count
+        camera.SetPosition(*(centre + distance * np.array([math.sin(angle), 0.2, math.cos(angle)])))
+
+        start = time.perf_counter()
+        video = videos[frame % len(videos)]
+        if profile['video_scale'] != 1.0:
+            video = cv2.resize(video, (scaled_width, scaled_height), interpolation=cv2.INTER_AREA)
+        scaled = time.perf_counter()
+        # vtk images start at the bottom row
+        pixels[:] = video[::-1]
+        image_data.Modified()
+        uploaded = time.perf_counter()
+        render_window.Render()
+        rendered = time.perf_counter()
+
+        times['scale'].append(1000.0 * (scaled - start))
+        times['video_image'].append(1000.0 * (uploaded - scaled))
+        times['render'].append(1000.0 * (rendered - uploaded))
+        times['total'].append(1000.0 * (rendered - start))
+
+    for actor in actors:
+        foreground.RemoveActor(actor)
+    render_window.Finalize()
+    return {stage: summarise_timings(stage_times) for stage, stage_times in times.items()}
+
+
+def format_render_report(results):
+    """
+    Returns the benchmark results of several profiles as a text table.
+    """
+    lines = [f"{'profile':<14}{'stage':<14}{'mean ms':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"]
+    for name, stages in results.items():
+        for stage, summary in stages.items():
+            lines.append(f"{name:<14}{stage:<14}{summary['mean_ms']:>10.2f}{summary['p50_ms']:>10.2f}"
+                         f"{summary['p90_ms']:>10.2f}{summary['p99_ms']:>10.2f}")
+    return '\n'.join(lines)
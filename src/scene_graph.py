@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""
+Scene graph binding the overlay models to the tracked tools declared in the
+[SCENE] section of the config.
+
+All models bound to a tool share one vtkMatrix4x4 as their user matrix, so
+moving a tool updates that matrix in place, whatever the number of models,
+and only when its pose changed by more than a threshold. Models not bound
+to a tool stay fixed in the world, which the camera is posed against.
+"""
+
+import logging
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TrackedBody:
+    """
+    A tracked tool, and the models moving with it.
+    """
+
+    def __init__(self, name, translation_threshold=0.5, rotation_threshold_deg=0.2):
+        """
+        TrackedBody constructor.
+
+        params:
+            - name: name of the tool
+            - translation_threshold: minimum translation (mm) for a new pose to be pushed to VTK, [0.5]
+            - rotation_threshold_deg: minimum rotation (degrees) for a new pose to be pushed to VTK, [0.2]
+        """
+        import vtk
+        self.name = name
+        self.translation_threshold = translation_threshold
+        self.min_cos_angle = np.cos(np.radians(rotation_threshold_deg))
+        self.matrix = vtk.vtkMatrix4x4()
+        self.pose = None
+        self.models = []
+        self.poses_pushed = 0
+        self.poses_skipped = 0
+
+    def bind(self, model):
+        """
+        Moves model with this body from now on.
+        """
+        model.set_user_matrix(self.matrix)
+        self.models.append(model)
+
+    def set_pose(self, pose):
+        """
+        Moves the models of this body to pose (4x4, body to world), unless it
+        is within the thresholds of the last pose pushed.
+
+        returns:
+            - True if the pose was pushed to VTK
+        """
+        if self.pose is not None:
+            translation = np.linalg.norm(pose[0:3, 3] - self.pose[0:3, 3])
+            # cosine of the rotation angle between the poses
+            cos_angle = (np.trace(pose[0:3, 0:3] @ self.pose[0:3, 0:3].T) - 1.0) / 2.0
+            if translation < self.translation_threshold and cos_angle > self.min_cos_angle:
+                self.poses_skipped += 1
+                return False
+        self.pose = np.array(pose, dtype=np.float64)
+        # the actors of all the models check the matrix's modified time when rendered
+        self.matrix.DeepCopy(self.pose.ravel().tolist())
+        self.poses_pushed += 1
+        return True
+
+
+class SceneGraph:
+    """
+    Models of the overlay indexed by name, and the tracked bodies they are bound to.
+    """
+
+    def __init__(self, bindings, tool_names, translation_threshold=0.5, rotation_threshold_deg=0.2):
+        """
+        SceneGraph constructor.
+
+        params:
+            - bindings: dict of tool name to the list of the names of the models moving with it
+            - tool_names: names of the tools tracked. The first one is the world reference,
+                          so its models are fixed and it can't be bound.
+            - translation_threshold, rotation_threshold_deg: see TrackedBody
+        """
+        movable = tuple(tool_names[1:])
+        self.bodies = dict()
+        self.body_of_model = dict()
+        for tool, model_names in bindings.items():
+            if tool not in movable:
+                raise ValueError(f"Models can't be bound to {tool} in [SCENE], expected one of {movable}.")
+            self.bodies[tool] = TrackedBody(tool, translation_threshold, rotation_threshold_deg)
+            for model_name in model_names:
+                if model_name in self.body_of_model:
+                    raise ValueError(f"Model {model_name} is bound to both {self.body_of_model[model_name]} "
+                                     f"and {tool} in [SCENE].")
+                self.body_of_model[model_name] = tool
+        self.models = dict()
+
+    def add_models(self, models):
+        """
+        Indexes models by name, and binds them to their bodies. Models may be
+        added at any time, eg. when loaded in the background.
+        """
+        for model in models:
+            name = model.get_name()
+            self.models[name] = model
+            tool = self.body_of_model.get(name)
+            if tool is not None:
+                self.bodies[tool].bind(model)
+                LOGGER.info(f"Model {name} moves with {tool}")
+
+    def set_pose(self, tool, pose):
+        """
+        Moves the models bound to tool, if any, to pose (4x4, tool to world).
+
+        returns:
+            - True if the pose was pushed to VTK
+        """
+        body = self.bodies.get(tool)
+        if body is None:
+            return False
+        return body.set_pose(pose)
+
+    def get_model(self, name):
+        """
+        Returns the model called name, or None.
+        """
+        return self.models.get(name)
+
+    def get_stats(self):
+        """
+        Returns the number of poses pushed to VTK and skipped, per body.
+        """
+        return {name: {'pushed': body.poses_pushed, 'skipped': body.poses_skipped, 'models': len(body.models)}
+                for name, body in self.bodies.items()}
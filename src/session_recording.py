@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+
+"""
+Recording of live sessions (raw frames, capture timestamps, detected corners
+and poses) into an append-only container, and replay of recorded sessions
+as a video source.
+
+A session is a directory holding:
+
+    - session.json: frame shape and dtype, tool names and calibration
+    - frames.bin: raw frames, one after the other
+    - frames_info.bin: FRAME_DTYPE record per frame
+    - tracking.bin: TRACKING_DTYPE record per frame and tool
+    - corners.bin: CORNER_DTYPE record per detected marker
+
+All files are only ever appended to, so a session cut short by a crash can
+still be read up to its last complete frame, and all are read back as
+memory maps, so replay doesn't load the whole recording.
+"""
+
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+# index: running frame number, the same as CapturedFrame.index
+# timestamp: capture timestamp reported by the video source (seconds since epoch), nan if none
+# arrival_time: seconds since the first frame, when the frame was read
+FRAME_DTYPE = np.dtype([('index', '<i8'), ('timestamp', '<f8'), ('arrival_time', '<f8')])
+
+# pose: board to camera
+TRACKING_DTYPE = np.dtype([('frame_index', '<i8'), ('tool', '<i4'), ('pose_ok', '?'), ('pose', '<f8', (4, 4))])
+
+# corners: as detected in the tracked frame, which is the raw frame if detect_on_raw_frame is set
+CORNER_DTYPE = np.dtype([('frame_index', '<i8'), ('tool', '<i4'), ('marker_id', '<i4'), ('corners', '<f4', (4, 2))])
+
+HEADER_FILE = 'session.json'
+FRAMES_FILE = 'frames.bin'
+FRAMES_INFO_FILE = 'frames_info.bin'
+TRACKING_FILE = 'tracking.bin'
+CORNERS_FILE = 'corners.bin'
+
+
+def is_session(path):
+    """
+    Returns True if path is a recorded session directory.
+    """
+    return isinstance(path, str) and os.path.isfile(os.path.join(path, HEADER_FILE))
+
+
+class SessionRecorder:
+    """
+    Appends frames and tracking results to a session directory.
+
+    Writing is done on a background thread, so that the capture thread and
+    the tracking worker only pay for putting a record in a queue. If the
+    disk falls behind, tracking records are dropped, while frames wait for
+    room in the queue so the recorded frames stay in step with their indices. Frames
+    must not be modified after being recorded; frames read from the video
+    source are fresh arrays, so this holds for the raw frames.
+    """
+
+    def __init__(self, path, tools=(), intrinsics=None, distortion=None, max_queued=64):
+        """
+        SessionRecorder constructor.
+
+        params:
+            - path: session directory to create. Must not already hold a session.
+            - tools: names of the tracked tools, in the order their results are recorded, [()]
+            - intrinsics, distortion: calibration, saved in the header for reference, [None]
+            - max_queued: maximum number of records waiting to be written, [64]
+        """
+        if is_session(path):
+            raise ValueError(f"There already is a recorded session in {path}.")
+        os.makedirs(path, exist_ok=True)
+
+        self.path = path
+        self.header = {'tools': list(tools),
+                       'intrinsics': None if intrinsics is None else np.asarray(intrinsics).tolist(),
+                       'distortion': None if distortion is None else np.asarray(distortion).tolist(),
+                       'created': datetime.datetime.now().isoformat()}
+        self._frame_shape = None
+        self._first_arrival = None
+        self.frames_recorded = 0
+        self.records_dropped = 0
+        self.frames_delayed = 0
+
+        self._files = {name: open(os.path.join(path, name), 'ab')
+                       for name in (FRAMES_FILE, FRAMES_INFO_FILE, TRACKING_FILE, CORNERS_FILE)}
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._thread = threading.Thread(target=self._run, name='session_recorder', daemon=True)
+        self._thread.start()
+
+    def _put(self, item, block=False):
+        """
+        Queues an item for the writer thread. If the disk can't keep up, the
+        item is dropped rather than blocking the frame loop, unless block is
+        set: frames are never dropped, as their position in frames.bin must
+        match the index given to them.
+        """
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            if block:
+                self.frames_delayed += 1
+                if self.frames_delayed == 1:
+                    LOGGER.warning("Session recorder can't keep up, waiting for the disk")
+                self._queue.put(item)
+                return
+            self.records_dropped += 1
+            if self.records_dropped == 1:
+                LOGGER.warning("Session recorder can't keep up, dropping tracking records")
+
+    def record_frame(self, image, timestamp=None, arrival_time=None):
+        """
+        Records one raw frame. Called in capture order, on the capture thread.
+
+        params:
+            - image: the frame
+            - timestamp: capture timestamp (datetime) from the video source, [None]
+            - arrival_time: time.perf_counter() when the frame was read, [now]
+        """
+        if self._thread is None:
+            return
+        if self._frame_shape is None:
+            self._frame_shape = image.shape
+            self.header['frame_shape'] = list(image.shape)
+            self.header['frame_dtype'] = np.dtype(image.dtype).str
+            with open(os.path.join(self.path, HEADER_FILE), 'w') as f:
+                json.dump(self.header, f, indent=2)
+        elif image.shape != self._frame_shape:
+            raise ValueError(f"Recorded frames must all have shape {self._frame_shape}, got {image.shape}")
+
+        arrival_time = time.perf_counter() if arrival_time is None else arrival_time
+        if self._first_arrival is None:
+            self._first_arrival = arrival_time
+
+        info = np.zeros(1, FRAME_DTYPE)
+        info['index'] = self.frames_recorded
+        info['timestamp'] = timestamp.timestamp() if timestamp is not None else np.nan
+        info['arrival_time'] = arrival_time - self._first_arrival
+        self.frames_recorded += 1
+        self._put((FRAMES_FILE, np.ascontiguousarray(image), info), block=True)
+
+    def record_tracking(self, frame_index, results):
+        """
+        Records the tracking of one frame.
+
+        params:
+            - frame_index: index of the tracked frame
+            - results: list, one per tool, of (corners, ids, pose_ok, pose)
+        """
+        if self._thread is None:
+            return
+        tracking = np.zeros(len(results), TRACKING_DTYPE)
+        corner_records = []
+        for tool, (corners, ids, pose_ok, pose) in enumerate(results):
+            tracking[tool] = (frame_index, tool, pose_ok, pose)
+            if ids is None or len(corners) == 0:
+                continue
+            markers = np.zeros(len(ids), CORNER_DTYPE)
+            markers['frame_index'] = frame_index
+            markers['tool'] = tool
+            markers['marker_id'] = np.asarray(ids).ravel()
+            markers['corners'] = np.concatenate([np.asarray(c).reshape((1, 4, 2)) for c in corners])
+            corner_records.append(markers)
+        corners = np.concatenate(corner_records) if corner_records else np.zeros(0, CORNER_DTYPE)
+        self._put((TRACKING_FILE, tracking, corners))
+
+    def _run(self):
+        """
+        Writer loop, runs on the recorder thread.
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            kind, first, second = item
+            if kind == FRAMES_FILE:
+                # the frame is written before its info, so a frame with info is always complete
+                self._files[FRAMES_FILE].write(first.tobytes())
+                self._files[FRAMES_INFO_FILE].write(second.tobytes())
+            else:
+                self._files[TRACKING_FILE].write(first.tobytes())
+                self._files[CORNERS_FILE].write(second.tobytes())
+
+    def close(self):
+        """
+        Writes everything still queued and closes the files. Later records are ignored.
+        """
+        # taken at once, as the capture thread closes the recorder if recording fails
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join()
+        for f in self._files.values():
+            f.close()
+        LOGGER.info(f"Recorded {self.frames_recorded} frames to {self.path}, "
+                    f"{self.records_dropped} tracking records dropped, "
+                    f"{self.frames_delayed} frames waited for the disk")
+
+
+class RecordingVideoSource:
+    """
+    Wraps a video source (eg. TimestampedVideoSource) and records every frame
+    read from it, so it can be used wherever the wrapped source is.
+    """
+
+    def __init__(self, video_source, recorder):
+        """
+        RecordingVideoSource constructor.
+
+        params:
+            - video_source: object with a read() method returning (ret, image)
+            - recorder: SessionRecorder the frames are recorded to
+        """
+        self.video = video_source
+        self.recorder = recorder
+        self.timestamp = None
+        # time.perf_counter() when the last frame was read, before it was recorded.
+        # ThreadedVideoSource uses it as the frame's arrival time.
+        self.arrival_time = None
+
+    def read(self):
+        """
+        Reads a frame from the wrapped source and records it. If recording
+        fails (eg. the frame size changed), recording stops but the video
+        keeps running.
+        """
+        ret, image = self.video.read()
+        if ret:
+            self.arrival_time = time.perf_counter()
+            self.timestamp = getattr(self.video, 'timestamp', None)
+            if self.recorder is not None:
+                try:
+                    self.recorder.record_frame(image, self.timestamp, self.arrival_time)
+                except Exception:  # pylint: disable=broad-except
+                    LOGGER.exception("Recording failed, stopping the recording")
+                    self.recorder.close()
+                    self.recorder = None
+        return ret, image
+
+
+class SessionReader:
+    """
+    Memory mapped, read only access to a recorded session.
+    """
+
+    def __init__(self, path):
+        """
+        SessionReader constructor.
+
+        params:
+            - path: session directory
+        """
+        if not is_session(path):
+            raise ValueError(f"{path} is not a recorded session.")
+        self.path = path
+        with open(os.path.join(path, HEADER_FILE)) as f:
+            self.header = json.load(f)
+        self.tools = self.header['tools']
+
+        frame_shape = tuple(self.header['frame_shape'])
+        frame_dtype = np.dtype(self.header['frame_dtype'])
+        self.frames_info = self._map(FRAMES_INFO_FILE, FRAME_DTYPE)
+
+        # frames are written before their info, so there may be one frame more than infos, not less
+        frame_bytes = int(np.prod(frame_shape)) * frame_dtype.itemsize
+        frame_count = min(len(self.frames_info), os.path.getsize(os.path.join(path, FRAMES_FILE)) // frame_bytes)
+        self.frames_info = self.frames_info[:frame_count]
+        self.frames = self._map(FRAMES_FILE, frame_dtype, (frame_count,) + frame_shape)
+
+        self.tracking = self._map(TRACKING_FILE, TRACKING_DTYPE)
+        self.corners = self._map(CORNERS_FILE, CORNER_DTYPE)
+
+    def _map(self, name, dtype, shape=None):
+        """
+        Memory maps one of the session files, dropping any incomplete trailing record.
+        """
+        file_path = os.path.join(self.path, name)
+        if shape is None:
+            shape = (os.path.getsize(file_path) // dtype.itemsize,)
+        if int(np.prod(shape)) == 0:
+            return np.zeros(shape, dtype)
+        return np.memmap(file_path, dtype=dtype, mode='r', shape=shape)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def tracking_of(self, frame_index, tool):
+        """
+        Returns (pose_ok, pose, ids, corners) recorded for one tool in one frame,
+        or None if the frame wasn't tracked.
+        """
+        rows = self.tracking[(self.tracking['frame_index'] == frame_index) & (self.tracking['tool'] == tool)]
+        if len(rows) == 0:
+            return None
+        markers = self.corners[(self.corners['frame_index'] == frame_index) & (self.corners['tool'] == tool)]
+        return bool(rows[-1]['pose_ok']), np.array(rows[-1]['pose']), \
+            np.array(markers['marker_id']), np.array(markers['corners'])
+
+
+class ReplayVideoSource:
+    """
+    Plays a recorded session back, with the same read() interface as
+    TimestampedVideoSource.
+
+    At original timing each frame is returned when it arrived during the
+    recording, relative to the first read. Otherwise frames are returned as
+    fast as they are read. Reads fail once the recording has ended.
+    """
+
+    def __init__(self, path, original_timing=True, loop=False):
+        """
+        ReplayVideoSource constructor.
+
+        params:
+            - path: session directory
+            - original_timing: replay at the recorded timing, else as fast as possible, [True]
+            - loop: restart from the first frame at the end, [False]
+        """
+        self.session = SessionReader(path)
+        self.original_timing = original_timing
+        self.loop = loop
+        self.position = 0
+        self.timestamp = None
+        self._start = None
+        LOGGER.info(f"Replaying {len(self.session)} frames from {path}")
+
+    def read(self):
+        """
+        Returns (ret, image) for the next recorded frame. The image is a copy,
+        as the recording is mapped read only.
+        """
+        if self.position >= len(self.session):
+            if not self.loop or len(self.session) == 0:
+                return False, None
+            self.position = 0
+            self._start = None
+
+        info = self.session.frames_info[self.position]
+        if self.original_timing:
+            now = time.perf_counter()
+            if self._start is None:
+                self._start = now - info['arrival_time']
+            delay = self._start + info['arrival_time'] - now
+            if delay > 0:
+                time.sleep(delay)
+
+        image = np.array(self.session.frames[self.position])
+        self.timestamp = None if np.isnan(info['timestamp']) else \
+            datetime.datetime.fromtimestamp(info['timestamp'])
+        self.position += 1
+        return True, image
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+
+"""
+Fast startup of AR_gui: the config is checked before anything heavy is
+imported, so mistakes are reported in one go, in milliseconds, before Qt,
+VTK, OpenCV and numpy are loaded. Also times the startup phases.
+
+Only the standard library is used here.
+"""
+
+import configparser
+import contextlib
+import json
+import os
+import sys
+import time
+
+from data.aruco_dict_types import ARUCO_DICT, ARUCO_DICT_MARKER_SIZE
+from src.loading_config_utils import load_tracking_config, load_AR_display_options, \
+    load_performance_config, load_recording_config, load_scene_config, load_tool_config, \
+    load_board_printing_config
+
+
+def _positive_int(value):
+    number = int(value)
+    if number <= 0:
+        raise ValueError(value)
+    return number
+
+
+def _non_negative_int(value):
+    number = int(value)
+    if number < 0:
+        raise ValueError(value)
+    return number
+
+
+def _non_negative_float(value):
+    number = float(value)
+    if number < 0:
+        raise ValueError(value)
+    return number
+
+
+def _dictionary(value):
+    if value not in ARUCO_DICT:
+        raise ValueError(value)
+    return value
+
+
+def _not_empty(value):
+    if len(value.strip()) == 0:
+        raise ValueError(value)
+    return value.strip()
+
+
+def _bool(value):
+    if value.strip().lower() not in ('1', 'yes', 'true', 'on', '0', 'no', 'false', 'off'):
+        raise ValueError(value)
+    return value.strip().lower() in ('1', 'yes', 'true', 'on')
+
+
+# (key, parser, description) of the board and its printing settings,
+# parsed the same way as in load_tool_config and load_board_printing_config
+ARUCO_FIELDS = (
+    ('aruco_dict', _dictionary, 'a dictionary of data/aruco_dict_types.py'),
+    ('size_in_bits', _positive_int, 'a positive integer'),
+    ('border_bits', _non_negative_int, 'a non negative integer'),
+    ('gap_between_markers_in_bits', _non_negative_int, 'a non negative integer'),
+    ('marker_length', _positive_int, 'a positive integer (mm)'),
+    ('markers_w', _positive_int, 'a positive integer'),
+    ('markers_h', _positive_int, 'a positive integer'),
+    ('pixels_per_bit', _positive_int, 'a positive integer'),
+    ('save_path', _not_empty, 'a path'),
+    ('marker_separation', _non_negative_float, 'a non negative number (mm)'),
+)
+
+# (key, parser, description) of the pointer, only required if pointer_present
+POINTER_FIELDS = (
+    ('pointer_aruco_dict', _dictionary, 'a dictionary of data/aruco_dict_types.py'),
+    ('pointer_marker_length', _positive_int, 'a positive integer (mm)'),
+    ('pointer_markers_w', _positive_int, 'a positive integer'),
+    ('pointer_markers_h', _positive_int, 'a positive integer'),
+    ('pointer_marker_separation', _non_negative_float, 'a non negative number (mm)'),
+)
+
+# (key, parser, description), parsed the same way as in load_AR_display_config
+AR_DISPLAY_FIELDS = (
+    ('intrinsics_pth', _not_empty, 'a path'),
+    ('distortion_pth', _not_empty, 'a path'),
+    ('video_source', _not_empty, 'a device id, video or recorded session'),
+    ('registration_matrix', _not_empty, 'a path'),
+    ('models', _not_empty, 'a path'),
+    ('rendering_defaults', _not_empty, 'a file name'),
+    ('frame_rate', _positive_int, 'a positive integer (fps)'),
+)
+
+
+def _check_fields(config, section_name, fields, errors):
+    """
+    Parses the fields of a section, adding an error for each missing or
+    invalid one.
+
+    returns:
+        - dict of the valid fields' values
+    """
+    if not config.has_section(section_name):
+        errors.append(f"[{section_name}] section is missing.")
+        return {}
+    section = config[section_name]
+    values = dict()
+    for key, parse, description in fields:
+        if key not in section:
+            errors.append(f"[{section_name}] {key} is missing.")
+            continue
+        try:
+            value = section[key]
+        except configparser.Error as error:
+            errors.append(f"[{section_name}] {key} can't be read: {error}")
+            continue
+        try:
+            values[key] = parse(value)
+        except ValueError:
+            errors.append(f"[{section_name}] {key} = {value!r} is not {description}.")
+    return values
+
+
+def matrix_shape(path_to_file):
+    """
+    Returns the shape of a whitespace separated matrix file, read as
+    np.loadtxt would, without numpy: (columns,) for a single row, else
+    (rows, columns).
+    """
+    rows = []
+    with open(path_to_file) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if len(line) == 0:
+                continue
+            # raises ValueError for anything that isn't a number
+            rows.append([float(value) for value in line.split()])
+    if len(rows) == 0:
+        raise ValueError("it is empty")
+    if any(len(row) != len(rows[0]) for row in rows):
+        raise ValueError("its rows have different lengths")
+    if len(rows) == 1:
+        return (len(rows[0]),)
+    return (len(rows), len(rows[0]))
+
+
+def _check_matrix(name, path_to_file, expected_shape, errors):
+    """
+    Checks a matrix file exists and can be loaded by load_matrix with expected_shape.
+    """
+    if not os.path.isfile(path_to_file):
+        errors.append(f"{name} file {path_to_file} does not exist.")
+        return
+    try:
+        shape = matrix_shape(path_to_file)
+    except ValueError as error:
+        errors.append(f"{name} file {path_to_file} is not a matrix: {error}.")
+        return
+    # load_matrix reshapes a single row, so only its number of values matters
+    rows, columns = expected_shape
+    if (len(shape) == 1 and shape[0] != rows * columns) or (len(shape) == 2 and shape != expected_shape):
+        errors.append(f"{name} matrix at {path_to_file} has shape {shape}, expected {expected_shape}.")
+
+
+def check_AR_display_files(intrinsics_pth, distortion_pth, video_source, registration_matrix,
+                           models, rendering_defaults):
+    """
+    Checks the files given to AR_gui exist and have the expected content.
+
+    Arguments that weren't given (None or empty), eg. on the command line,
+    are reported as missing, and only the others are checked.
+
+    returns:
+        - list of error messages, empty if all is well
+    """
+    given = dict(intrinsics=intrinsics_pth, distortion=distortion_pth, video_source=video_source,
+                 registration_matrix=registration_matrix, models=models, rendering_defaults=rendering_defaults)
+    missing = [name for name, value in given.items() if value is None or len(str(value)) == 0]
+    errors = [f"{name} is missing." for name in missing]
+
+    for name, expected_shape in (('intrinsics', (3, 3)), ('distortion', (1, 5)), ('registration_matrix', (4, 4))):
+        if name not in missing:
+            _check_matrix(name, given[name], expected_shape, errors)
+
+    # a device id, a video file, a recorded session directory or a stream url
+    if 'video_source' not in missing and not video_source.isdigit() and '://' not in video_source \
+            and not os.path.exists(video_source):
+        errors.append(f"video_source {video_source} is not a device id and does not exist.")
+
+    if 'models' not in missing:
+        if not os.path.isdir(models):
+            errors.append(f"models directory {models} does not exist.")
+        elif 'rendering_defaults' not in missing:
+            defaults_file = os.path.join(models, rendering_defaults)
+            if not os.path.isfile(defaults_file):
+                errors.append(f"The rendering defaults file {defaults_file} does not exist.")
+            else:
+                try:
+                    with open(defaults_file) as f:
+                        defaults = json.load(f)
+                    if not isinstance(defaults, dict):
+                        errors.append(f"The rendering defaults file {defaults_file} is not a json object.")
+                except ValueError as error:
+                    errors.append(f"The rendering defaults file {defaults_file} is not valid json: {error}.")
+    return errors
+
+
+def check_config(config):
+    """
+    Checks every field of the [ARUCO] and [AR_DISPLAY] sections, the files
+    they point to, and the optional sections read by AR_gui.
+
+    params:
+        - config: configparser.ConfigParser
+    returns:
+        - list of error messages, empty if all is well
+    """
+    errors = []
+
+    aruco = _check_fields(config, 'ARUCO', ARUCO_FIELDS, errors)
+    if 'aruco_dict' in aruco and 'size_in_bits' in aruco \
+            and aruco['size_in_bits'] != ARUCO_DICT_MARKER_SIZE[aruco['aruco_dict']]:
+        errors.append(f"[ARUCO] size_in_bits = {aruco['size_in_bits']} does not match {aruco['aruco_dict']}, "
+                      f"whose markers are {ARUCO_DICT_MARKER_SIZE[aruco['aruco_dict']]} bits wide.")
+    if config.has_section('ARUCO'):
+        pointer_present = config['ARUCO'].get('pointer_present', 'True')
+        try:
+            if _bool(pointer_present):
+                _check_fields(config, 'ARUCO', POINTER_FIELDS, errors)
+        except ValueError:
+            errors.append(f"[ARUCO] pointer_present = {pointer_present!r} is not a boolean.")
+
+    display = _check_fields(config, 'AR_DISPLAY', AR_DISPLAY_FIELDS, errors)
+    paths = ('intrinsics_pth', 'distortion_pth', 'video_source', 'registration_matrix', 'models',
+             'rendering_defaults')
+    if all(key in display for key in paths):
+        errors.extend(check_AR_display_files(display['intrinsics_pth'], display['distortion_pth'],
+                                             display['video_source'], display['registration_matrix'],
+                                             display['models'], display['rendering_defaults']))
+
+    loaded = dict()
+    for loader in (load_tracking_config, load_AR_display_options, load_performance_config,
+                   load_recording_config, load_scene_config, load_tool_config, load_board_printing_config):
+        try:
+            loaded[loader] = loader(config)
+        except (ValueError, KeyError, configparser.Error) as error:
+            errors.append(f"{loader.__name__}: {error}")
+
+    # models can only be bound to the tools tracked, other than the board
+    if load_scene_config in loaded and load_tool_config in loaded:
+        movable = [name for name, _ in loaded[load_tool_config][1:]]
+        for tool in loaded[load_scene_config]['scene_bindings']:
+            if tool not in movable:
+                errors.append(f"[SCENE] {tool} is not a tracked tool, expected one of {movable}.")
+
+    return errors
+
+
+def read_config(config_path):
+    """
+    Reads a config file.
+
+    returns:
+        - configparser.ConfigParser, list of error messages
+    """
+    config = configparser.ConfigParser()
+    if not os.path.isfile(config_path):
+        return config, [f"Config file {config_path} does not exist."]
+    try:
+        config.read(config_path)
+    except configparser.Error as error:
+        return config, [f"Config file {config_path} can't be parsed: {error}"]
+    return config, []
+
+
+class StartupTimer:
+    """
+    Times the phases of startup, and counts the modules each one imports.
+    For a breakdown per module, run with python -X importtime.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager timing one phase.
+        """
+        modules = len(sys.modules)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, 1000.0 * (time.perf_counter() - start), len(sys.modules) - modules))
+
+    def report(self):
+        """
+        Returns the phases as a text table.
+        """
+        lines = [f"{'phase':<32}{'ms':>10}{'modules':>10}"]
+        for name, milliseconds, modules in self.phases:
+            lines.append(f"{name:<32}{milliseconds:>10.1f}{modules:>10}")
+        lines.append(f"{'total':<32}{1000.0 * (time.perf_counter() - self.start):>10.1f}{len(sys.modules):>10}")
+        return '\n'.join(lines)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic camera frames of aruco boards at known poses, rendered through
+the real intrinsics and distortion, for benchmarking without a camera.
+"""
+
+import cv2
+import numpy as np
+
+
+def render_board_texture(board, pixels_per_mm=4.0, margin_mm=10.0):
+    """
+    Renders a board with GridBoard.generateImage, and finds the homography
+    from board coordinates (mm) to texture pixels by detecting the markers
+    in the rendered image, so the mapping doesn't depend on the OpenCV version.
+
+    returns:
+        - texture: grey image of the board on a white margin
+        - board_to_texture: 3x3 homography from board (x, y) in mm to texture pixels
+    """
+    obj_points = np.concatenate([np.asarray(p, dtype=np.float64).reshape((-1, 3)) for p in board.getObjPoints()])
+    size_mm = obj_points.max(axis=0)[:2] - obj_points.min(axis=0)[:2]
+    margin_px = int(round(margin_mm * pixels_per_mm))
+    width_px, height_px = (np.round(size_mm * pixels_per_mm).astype(int) + 2 * margin_px)
+
+    texture = board.generateImage((int(width_px), int(height_px)), marginSize=margin_px, borderBits=1)
+
+    detector = cv2.aruco.ArucoDetector(board.getDictionary(), cv2.aruco.DetectorParameters())
+    corners, ids, _ = detector.detectMarkers(texture)
+    if ids is None:
+        raise RuntimeError("Could not detect the markers of the rendered board texture.")
+    board_points, texture_points = board.matchImagePoints(corners, ids)
+    board_to_texture, _ = cv2.findHomography(board_points.reshape((-1, 3))[:, :2],
+                                             texture_points.reshape((-1, 2)))
+    return texture, board_to_texture
+
+
+def board_center(board):
+    """
+    Returns the centre of the board in board coordinates.
+    """
+    obj_points = np.concatenate([np.asarray(p, dtype=np.float64).reshape((-1, 3)) for p in board.getObjPoints()])
+    return (obj_points.min(axis=0) + obj_points.max(axis=0)) / 2.0
+
+
+def pose_looking_at(intrinsics, image_point, distance, angles_deg, center):
+    """
+    Returns (rvec, tvec) placing the board's centre at distance mm along the ray
+    through image_point, rotated by angles_deg (about x, y, z) from fronto-parallel.
+    """
+    rotation = np.eye(3)
+    for axis, angle in enumerate(angles_deg):
+        rotation_vector = np.zeros(3)
+        rotation_vector[axis] = np.deg2rad(angle)
+        rotation = cv2.Rodrigues(rotation_vector)[0] @ rotation
+    ray = np.linalg.inv(intrinsics) @ np.array([image_point[0], image_point[1], 1.0])
+    tvec = ray / ray[2] * distance - rotation @ center
+    rvec = cv2.Rodrigues(rotation)[0]
+    return rvec.reshape((3, 1)), tvec.reshape((3, 1))
+
+
+class SyntheticFrameGenerator:
+    """
+    Renders aruco boards into synthetic camera frames at known poses.
+
+    Each board texture is projected through the undistorted camera
+    (intrinsics), then the frame is distorted with the real distortion
+    coefficients, so it looks like what the camera delivers. Noise, blur
+    and occlusions can be added.
+    """
+
+    def __init__(self, boards, intrinsics, distortion, frame_size, pixels_per_mm=4.0, seed=0):
+        """
+        SyntheticFrameGenerator constructor.
+
+        params:
+            - boards: list of cv2.aruco.GridBoard to render
+            - intrinsics: camera matrix (3x3)
+            - distortion: distortion coefficients (1x5)
+            - frame_size: (width, height) of the frames
+            - pixels_per_mm: resolution of the board textures, [4]
+            - seed: random seed for noise and occlusions, [0]
+        """
+        self.boards = boards
+        self.intrinsics = np.asarray(intrinsics, dtype=np.float64)
+        self.distortion = np.asarray(distortion, dtype=np.float64)
+        self.frame_size = (int(frame_size[0]), int(frame_size[1]))
+        self.rng = np.random.default_rng(seed)
+
+        self.textures = [render_board_texture(board, pixels_per_mm) for board in boards]
+        self.centers = [board_center(board) for board in boards]
+
+        # for each pixel of the distorted frame, where it comes from in the undistorted frame
+        width, height = self.frame_size
+        pixels = np.stack(np.meshgrid(np.arange(width, dtype=np.float32),
+                                      np.arange(height, dtype=np.float32)), axis=-1).reshape((-1, 1, 2))
+        ideal = cv2.undistortPoints(pixels, self.intrinsics, self.distortion, P=self.intrinsics)
+        ideal = ideal.reshape((height, width, 2))
+        self.distort_map_x = np.ascontiguousarray(ideal[:, :, 0])
+        self.distort_map_y = np.ascontiguousarray(ideal[:, :, 1])
+
+    def trajectory(self, frame_count, distance_range=(400.0, 900.0), max_tilt_deg=30.0):
+        """
+        Returns a smooth, repeatable trajectory of (rvec, tvec) per board, so that
+        trackers relying on the previous frame (roi, optical flow) behave as on video.
+
+        returns:
+            - list (one per frame) of lists (one per board) of (rvec, tvec)
+        """
+        width, height = self.frame_size
+        poses = []
+        for frame in range(frame_count):
+            phase = 2.0 * np.pi * frame / max(frame_count, 1)
+            frame_poses = []
+            for i, center in enumerate(self.centers):
+                # boards are spread horizontally so that they don't overlap
+                x = width * (i + 1) / (len(self.boards) + 1) + 0.05 * width * np.sin(phase + i)
+                y = height / 2.0 + 0.15 * height * np.cos(phase + i)
+                distance = distance_range[0] + (distance_range[1] - distance_range[0]) * \
+                    (0.5 + 0.5 * np.sin(0.5 * phase + i))
+                angles = (max_tilt_deg * np.sin(phase + 2 * i),
+                          max_tilt_deg * np.cos(1.5 * phase + i),
+                          20.0 * np.sin(0.7 * phase))
+                frame_poses.append(pose_looking_at(self.intrinsics, (x, y), distance, angles, center))
+            poses.append(frame_poses)
+        return poses
+
+    def render(self, poses, noise_std=0.0, blur_sigma=0.0, occlusion=0.0, background=128):
+        """
+        Renders one colour frame with each board at its pose.
+
+        params:
+            - poses: list of (rvec, tvec), one per board (board to camera)
+            - noise_std: standard deviation of added gaussian noise (grey levels), [0]
+            - blur_sigma: sigma of gaussian blur (pixels), [0]
+            - occlusion: fraction of each board's bounding box covered by a random rectangle, [0]
+            - background: grey level of the background, [128]
+        returns:
+            - distorted BGR frame (height, width, 3) uint8
+        """
+        width, height = self.frame_size
+        frame = np.full((height, width), background, np.uint8)
+
+        for (texture, board_to_texture), (rvec, tvec) in zip(self.textures, poses):
+            rotation = cv2.Rodrigues(np.asarray(rvec, dtype=np.float64))[0]
+            board_to_image = self.intrinsics @ np.column_stack((rotation[:, 0], rotation[:, 1],
+                                                                np.asarray(tvec, dtype=np.float64).ravel()))
+            texture_to_image = board_to_image @ np.linalg.inv(board_to_texture)
+
+            warped = cv2.warpPerspective(texture, texture_to_image, (width, height), flags=cv2.INTER_LINEAR)
+            mask = cv2.warpPerspective(np.full(texture.shape, 255, np.uint8), texture_to_image,
+                                       (width, height), flags=cv2.INTER_NEAREST)
+            np.copyto(frame, warped, where=mask > 0)
+
+            if occlusion > 0:
+                ys, xs = np.nonzero(mask)
+                if len(xs) > 0:
+                    box_w = int((xs.max() - xs.min()) * np.sqrt(occlusion))
+                    box_h = int((ys.max() - ys.min()) * np.sqrt(occlusion))
+                    x0 = int(self.rng.integers(xs.min(), max(xs.min() + 1, xs.max() - box_w)))
+                    y0 = int(self.rng.integers(ys.min(), max(ys.min() + 1, ys.max() - box_h)))
+                    frame[y0:y0 + box_h, x0:x0 + box_w] = int(self.rng.integers(0, 256))
+
+        frame = cv2.remap(frame, self.distort_map_x, self.distort_map_y, cv2.INTER_LINEAR,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=background)
+
+        if blur_sigma > 0:
+            frame = cv2.GaussianBlur(frame, (0, 0), blur_sigma)
+        if noise_std > 0:
+            noise = self.rng.normal(0.0, noise_std, frame.shape)
+            frame = np.clip(frame.astype(np.float32) + noise, 0, 255).astype(np.uint8)
+
+        return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the per-frame tracking stages on synthetic frames with known
+board poses. Needs no camera, PySide6 or VTK, so that performance changes to
+the tracking code can be measured and compared between commits.
+"""
+
+import json
+import logging
+import time
+import cv2
+import numpy as np
+from src.aruco_tracking import MultiDictionaryDetector, pose_matrix
+from src.offline_tracking import create_tracking
+from src.synthetic_frames import SyntheticFrameGenerator
+from src.undistortion_utils import UndistortionEngine
+
+LOGGER = logging.getLogger(__name__)
+
+
+def summarise_timings(times_ms):
+    """
+    Returns the mean, percentiles and max of a list of stage durations (ms).
+    """
+    times_ms = np.asarray(times_ms, dtype=np.float64)
+    if len(times_ms) == 0:
+        return {'count': 0}
+    return {'count': int(len(times_ms)),
+            'mean_ms': float(times_ms.mean()),
+            'p50_ms': float(np.percentile(times_ms, 50)),
+            'p90_ms': float(np.percentile(times_ms, 90)),
+            'p99_ms': float(np.percentile(times_ms, 99)),
+            'max_ms': float(times_ms.max())}
+
+
+def pose_error(estimated_pose, rvec, tvec):
+    """
+    Returns the rotation error (degrees) and translation error (mm) of an
+    estimated 4x4 board to camera pose against the ground truth (rvec, tvec).
+    """
+    true_pose = pose_matrix(rvec, tvec)
+    rotation_difference = estimated_pose[:3, :3] @ true_pose[:3, :3].T
+    cos_angle = np.clip((np.trace(rotation_difference) - 1.0) / 2.0, -1.0, 1.0)
+    rotation_error = float(np.degrees(np.arccos(cos_angle)))
+    translation_error = float(np.linalg.norm(estimated_pose[:3, 3] - true_pose[:3, 3]))
+    return rotation_error, translation_error
+
+
+def run_benchmark(tools, intrinsics, distortion, tracking_args, frame_count=300, frame_size=None,
+                  noise_std=0.0, blur_sigma=0.0, occlusion=0.0, warmup_frames=5, seed=0):
+    """
+    Renders the tools on a synthetic trajectory and times each tracking stage,
+    the same way the GUI processes a frame:
+
+        - undistort: undistortion of the colour frame for display
+        - grey: conversion of the tracked frame to grey
+        - detect_<tool>: full-frame detection with the tool's own dictionary
+        - detect_multi_dictionary: MultiDictionaryDetector, one pass per distinct dictionary
+        - tracking: MultiBoardTracker.detect, with the [TRACKING] settings (roi, pyramid, optical flow)
+        - pose_<tool>: pose estimation from the tracked corners
+        - total: undistort + grey + tracking + pose of all tools
+
+    params:
+        - tools: list of (name, board_args), see offline_tracking.create_tracking
+        - intrinsics, distortion: camera calibration the frames are rendered with
+        - tracking_args: dict returned by load_tracking_config
+        - frame_count: number of frames timed, [300]
+        - frame_size: (width, height), [twice the principal point]
+        - noise_std, blur_sigma, occlusion: see SyntheticFrameGenerator.render
+        - warmup_frames: frames processed before timing starts, [5]
+        - seed: random seed of the noise and occlusions, [0]
+    returns:
+        - dict with the settings, per-stage timing summaries, throughput,
+          and per-tool detection rate and pose errors
+    """
+    intrinsics = np.asarray(intrinsics, dtype=np.float64)
+    if frame_size is None:
+        frame_size = (int(round(2 * intrinsics[0, 2])), int(round(2 * intrinsics[1, 2])))
+
+    trackers, tracking = create_tracking(tools, intrinsics, distortion, tracking_args)
+    detect_on_raw_frame = tracking_args['detect_on_raw_frame']
+    undistortion = UndistortionEngine(intrinsics, distortion)
+    multi_detector = MultiDictionaryDetector([tracker.dictionary for tracker in trackers],
+                                             tracking.detector.parameters,
+                                             ids=[tracker.board.getIds() for tracker in trackers])
+
+    LOGGER.info(f"Rendering board textures and distortion maps for {frame_size[0]}x{frame_size[1]} frames")
+    generator = SyntheticFrameGenerator([tracker.board for tracker in trackers], intrinsics, distortion,
+                                        frame_size, seed=seed)
+    trajectory = generator.trajectory(warmup_frames + frame_count)
+
+    names = [name for name, _ in tools]
+    timings = {stage: [] for stage in ['undistort', 'grey'] + [f'detect_{name}' for name in names] +
+               ['detect_multi_dictionary', 'tracking'] + [f'pose_{name}' for name in names] + ['total']}
+    detected = {name: 0 for name in names}
+    rotation_errors = {name: [] for name in names}
+    translation_errors = {name: [] for name in names}
+
+    grey = None
+    for frame, poses in enumerate(trajectory):
+        image = generator.render(poses, noise_std=noise_std, blur_sigma=blur_sigma, occlusion=occlusion)
+        timed = frame >= warmup_frames
+        frame_times = {}
+
+        start = time.perf_counter()
+        undistorted = undistortion.undistort(image)
+        frame_times['undistort'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        grey = cv2.cvtColor(image if detect_on_raw_frame else undistorted, cv2.COLOR_RGB2GRAY, dst=grey)
+        frame_times['grey'] = time.perf_counter() - start
+
+        for name, tracker in zip(names, trackers):
+            start = time.perf_counter()
+            tracker.detect(grey)
+            frame_times[f'detect_{name}'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        multi_detector.detect(grey)
+        frame_times['detect_multi_dictionary'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = tracking.detect(grey)
+        frame_times['tracking'] = time.perf_counter() - start
+
+        for name, tracker, (corners, ids), (rvec, tvec) in zip(names, trackers, results, poses):
+            start = time.perf_counter()
+            is_success, _, _ = tracker.estimate_pose(corners, ids)
+            frame_times[f'pose_{name}'] = time.perf_counter() - start
+            if is_success and timed:
+                detected[name] += 1
+                rotation_error, translation_error = pose_error(tracker.pose, rvec, tvec)
+                rotation_errors[name].append(rotation_error)
+                translation_errors[name].append(translation_error)
+
+        frame_times['total'] = frame_times['undistort'] + frame_times['grey'] + frame_times['tracking'] + \
+            sum(frame_times[f'pose_{name}'] for name in names)
+
+        if timed:
+            for stage, seconds in frame_times.items():
+                timings[stage].append(1000.0 * seconds)
+
+    stages = {stage: summarise_timings(times) for stage, times in timings.items()}
+    total_mean = stages['total'].get('mean_ms', 0.0)
+
+    accuracy = {}
+    for name in names:
+        accuracy[name] = {'detection_rate': detected[name] / frame_count if frame_count else 0.0}
+        if rotation_errors[name]:
+            accuracy[name].update({'rotation_error_median_deg': float(np.median(rotation_errors[name])),
+                                   'rotation_error_p90_deg': float(np.percentile(rotation_errors[name], 90)),
+                                   'translation_error_median_mm': float(np.median(translation_errors[name])),
+                                   'translation_error_p90_mm': float(np.percentile(translation_errors[name], 90))})
+
+    return {'settings': {'frame_count': frame_count,
+                         'frame_size': list(frame_size),
+                         'noise_std': noise_std,
+                         'blur_sigma': blur_sigma,
+                         'occlusion': occlusion,
+                         'seed': seed,
+                         'tracking': tracking_args,
+                         'opencv_version': cv2.__version__},
+            'throughput_fps': 1000.0 / total_mean if total_mean > 0 else 0.0,
+            'stages': stages,
+            'accuracy': accuracy,
+            'tracking_stats': tracking.get_stats()}
+
+
+def format_report(results, baseline=None):
+    """
+    Formats benchmark results as a table. If baseline results are given (eg.
+    loaded from a run on another commit), the change of each stage's mean and
+    p90 is shown.
+    """
+    lines = [f"{'stage':<26}{'mean':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}  (ms)"]
+    for stage, summary in results['stages'].items():
+        if summary['count'] == 0:
+            continue
+        line = f"{stage:<26}" + ''.join(f"{summary[key]:>9.2f}" for key in
+                                         ('mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms'))
+        base = baseline['stages'].get(stage) if baseline else None
+        if base and base.get('count'):
+            line += f"   mean {_change(summary['mean_ms'], base['mean_ms'])}" \
+                    f", p90 {_change(summary['p90_ms'], base['p90_ms'])}"
+        lines.append(line)
+
+    line = f"throughput: {results['throughput_fps']:.1f} fps"
+    if baseline:
+        line += f" (baseline {baseline['throughput_fps']:.1f} fps)"
+    lines.append(line)
+
+    for name, accuracy in results['accuracy'].items():
+        line = f"{name}: detected in {100.0 * accuracy['detection_rate']:.1f}% of frames"
+        if 'rotation_error_median_deg' in accuracy:
+            line += f", rotation error median {accuracy['rotation_error_median_deg']:.3f} deg" \
+                    f" (p90 {accuracy['rotation_error_p90_deg']:.3f})" \
+                    f", translation error median {accuracy['translation_error_median_mm']:.3f} mm" \
+                    f" (p90 {accuracy['translation_error_p90_mm']:.3f})"
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def _change(value, baseline_value):
+    """
+    Relative change of value against baseline_value, as a signed percentage string.
+    """
+    if baseline_value == 0:
+        return 'n/a'
+    return f"{100.0 * (value - baseline_value) / baseline_value:+.1f}%"
+
+
+def save_results(results, path):
+    """
+    Saves benchmark results as json.
+    """
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path):
+    """
+    Loads benchmark results saved by save_results.
+    """
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+""" Worker thread running frame acquisition and tracking ahead of rendering. """
+
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+class LatestValueSlot:
+    """
+    Single slot hand-over between two threads that only keeps the newest value.
+
+    put() never blocks and replaces any value that wasn't taken yet,
+    take() never blocks and returns None if nothing new was put.
+    """
+
+    def __init__(self, on_discard=None):
+        """
+        LatestValueSlot constructor.
+
+        params:
+            - on_discard: callable called with each value that is replaced before
+                          being taken, eg. to recycle its buffers, [None]
+        """
+        self.on_discard = on_discard
+        self._lock = threading.Lock()
+        self._value = None
+        self.values_put = 0
+        self.values_overwritten = 0
+
+    def put(self, value):
+        """
+        Puts value in the slot, replacing the previous one if it wasn't taken.
+        """
+        with self._lock:
+            discarded = self._value
+            self._value = value
+            self.values_put += 1
+        if discarded is not None:
+            self.values_overwritten += 1
+            if self.on_discard is not None:
+                self.on_discard(discarded)
+
+    def take(self):
+        """
+        Returns the newest value and empties the slot, or None if it is empty.
+        """
+        with self._lock:
+            value = self._value
+            self._value = None
+        return value
+
+
+class TrackingWorker:
+    """
+    Runs acquire and process on a worker thread, so that frame N+1 is
+    undistorted and tracked while frame N is rendered on the GUI thread.
+    Results are handed over through a LatestValueSlot.
+
+    OpenCV releases the GIL in its heavy calls, so both threads really run
+    in parallel.
+    """
+
+    def __init__(self, acquire, process, slot=None, on_result=None, release=None):
+        """
+        TrackingWorker constructor.
+
+        params:
+            - acquire: callable(timeout) returning the arguments of process as a tuple,
+                       or None if no frame arrived within timeout seconds
+            - process: callable taking the acquired frame and returning the result to render
+            - slot: LatestValueSlot the results are put in, [new slot]
+            - on_result: callable called on the worker thread after each result is put in the slot, [None]
+            - release: callable taking the acquired frame, called if process fails on it, so
+                       its buffers can be recycled, [None]
+        """
+        self.acquire = acquire
+        self.process = process
+        self.slot = slot if slot is not None else LatestValueSlot()
+        self.on_result = on_result
+        self.release = release
+        self._thread = None
+        self._running = False
+        self.frames_processed = 0
+        self.frames_failed = 0
+
+    def start(self):
+        """
+        Starts the worker thread.
+        """
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='tracking_worker', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the worker thread and waits for it to finish.
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+
+    def _run(self):
+        """
+        Worker loop.
+        """
+        while self._running:
+            frame = self.acquire(0.1)
+            if frame is None:
+                continue
+            try:
+                result = self.process(*frame)
+            except Exception:  # pylint: disable=broad-except
+                self.frames_failed += 1
+                LOGGER.exception("Tracking failed on frame")
+                # the frame won't be rendered, so its buffers are returned here
+                if self.release is not None:
+                    self.release(*frame)
+                continue
+            self.frames_processed += 1
+            self.slot.put(result)
+            if self.on_result is not None:
+                self.on_result()
+
+    def get_stats(self):
+        """
+        Returns the worker counters as a dict.
+        """
+        return {'frames_processed': self.frames_processed,
+                'frames_failed': self.frames_failed,
+                'results_overwritten': self.slot.values_overwritten}
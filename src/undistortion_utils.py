@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+
+""" Undistortion using cached, fixed-point remap tables. """
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from collections import OrderedDict
+import cv2
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+
+def calibration_hash(intrinsics, distortion):
+    """
+    Returns a hex digest identifying the contents of a calibration.
+    """
+    digest = hashlib.sha1()
+    for matrix in (intrinsics, distortion):
+        digest.update(np.ascontiguousarray(matrix, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+class UndistortionMaps:
+    """
+    Rectification maps for one (intrinsics, distortion, frame size, alpha) key.
+
+    The maps are stored in OpenCV's fixed-point form (CV_16SC2 + CV_16UC1),
+    which is what cv2.remap processes fastest.
+    """
+
+    def __init__(self, intrinsics, distortion, frame_size, alpha=None):
+        """
+        Builds the maps.
+
+        params:
+            - intrinsics: camera matrix (3x3)
+            - distortion: distortion coefficients (1x5)
+            - frame_size: (width, height) of the frames to undistort
+            - alpha: free scaling parameter passed to cv2.getOptimalNewCameraMatrix.
+                     If None, the original intrinsics are kept, like cv2.undistort does.
+        """
+        width, height = int(frame_size[0]), int(frame_size[1])
+        intrinsics = np.asarray(intrinsics, dtype=np.float64)
+        distortion = np.asarray(distortion, dtype=np.float64)
+
+        if alpha is None:
+            new_camera_matrix = intrinsics.copy()
+        else:
+            new_camera_matrix, _ = cv2.getOptimalNewCameraMatrix(intrinsics, distortion,
+                                                                 (width, height), alpha,
+                                                                 (width, height))
+        self.frame_size = (width, height)
+        self.alpha = alpha
+        self.new_camera_matrix = new_camera_matrix
+        self.map1, self.map2 = cv2.initUndistortRectifyMap(intrinsics, distortion, None,
+                                                           new_camera_matrix, (width, height),
+                                                           cv2.CV_16SC2)
+
+    @classmethod
+    def from_arrays(cls, frame_size, alpha, new_camera_matrix, map1, map2):
+        """
+        Creates UndistortionMaps from previously built arrays, eg. loaded from an UndistortionMapCache.
+        """
+        maps = cls.__new__(cls)
+        maps.frame_size = (int(frame_size[0]), int(frame_size[1]))
+        maps.alpha = alpha
+        maps.new_camera_matrix = new_camera_matrix
+        maps.map1 = map1
+        maps.map2 = map2
+        return maps
+
+
+class UndistortionMapCache:
+    """
+    On-disk cache of UndistortionMaps, so they aren't rebuilt at every start.
+
+    Each entry is a directory of .npy files (map1, map2, new camera matrix),
+    named after the calibration hash, frame size and alpha, and loaded as
+    read-only memory maps. A changed calibration gets a new entry, and the
+    least recently used entries beyond max_entries are deleted. Entries
+    built by another OpenCV version are rebuilt.
+    """
+
+    def __init__(self, cache_dir, max_entries=8):
+        """
+        UndistortionMapCache constructor.
+
+        params:
+            - cache_dir: directory of the cache, created if needed
+            - max_entries: number of entries kept, [8]
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_dir(self, cal_hash, frame_size, alpha):
+        """
+        Returns the directory of the entry for one maps key.
+        """
+        alpha_name = 'none' if alpha is None else f'{float(alpha):g}'
+        return os.path.join(self.cache_dir, f'{cal_hash}_{int(frame_size[0])}x{int(frame_size[1])}_{alpha_name}')
+
+    def load(self, cal_hash, frame_size, alpha):
+        """
+        Returns the cached UndistortionMaps for the key, memory mapped, or None if not cached.
+        """
+        entry = self._entry_dir(cal_hash, frame_size, alpha)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                meta = json.load(f)
+            if meta['opencv_version'] != cv2.__version__:
+                return None
+            maps = UndistortionMaps.from_arrays(frame_size, alpha,
+                                                np.load(os.path.join(entry, 'new_camera_matrix.npy')),
+                                                np.load(os.path.join(entry, 'map1.npy'), mmap_mode='r'),
+                                                np.load(os.path.join(entry, 'map2.npy'), mmap_mode='r'))
+        except (OSError, ValueError, KeyError):
+            return None
+        # the modification time orders the entries for eviction
+        os.utime(entry)
+        return maps
+
+    def save(self, cal_hash, maps):
+        """
+        Stores maps under the key, replacing any previous entry, then evicts old entries.
+        Failures are logged, as the cache is only an optimisation.
+        """
+        entry = self._entry_dir(cal_hash, maps.frame_size, maps.alpha)
+        temporary = f'{entry}.tmp{os.getpid()}'
+        try:
+            os.makedirs(temporary, exist_ok=True)
+            np.save(os.path.join(temporary, 'map1.npy'), maps.map1)
+            np.save(os.path.join(temporary, 'map2.npy'), maps.map2)
+            np.save(os.path.join(temporary, 'new_camera_matrix.npy'), maps.new_camera_matrix)
+            with open(os.path.join(temporary, 'meta.json'), 'w') as f:
+                json.dump({'calibration_hash': cal_hash,
+                           'frame_size': list(maps.frame_size),
+                           'alpha': maps.alpha,
+                           'opencv_version': cv2.__version__}, f)
+            # the entry only appears once complete
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.replace(temporary, entry)
+        except OSError as error:
+            LOGGER.warning(f"Could not cache undistortion maps in {self.cache_dir}: {error}")
+            shutil.rmtree(temporary, ignore_errors=True)
+            return
+        self._evict()
+
+    def cached_keys(self, cal_hash):
+        """
+        Returns the (frame_size, alpha) of the entries cached for a calibration.
+        """
+        keys = []
+        for name in os.listdir(self.cache_dir):
+            if not name.startswith(cal_hash + '_') or '.tmp' in name:
+                continue
+            try:
+                with open(os.path.join(self.cache_dir, name, 'meta.json')) as f:
+                    meta = json.load(f)
+                keys.append((tuple(meta['frame_size']), meta['alpha']))
+            except (OSError, ValueError, KeyError):
+                continue
+        return keys
+
+    def _evict(self):
+        """
+        Deletes the least recently used entries beyond max_entries.
+        """
+        entries = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+                   if '.tmp' not in name]
+        entries = [entry for entry in entries if os.path.isdir(entry)]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for entry in entries[self.max_entries:]:
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+class UndistortionEngine:
+    """
+    Undistorts frames with rectification maps that are built once per
+    (intrinsics, distortion, frame size, alpha) key and written into
+    preallocated output buffers.
+
+    Maps are only rebuilt when the frame size or calibration changes, so the
+    per-frame cost is a single cv2.remap. With a cache_dir, maps are also
+    kept on disk, so the next start doesn't rebuild them.
+    """
+
+    def __init__(self, intrinsics=None, distortion=None, alpha=None, max_cached_maps=4, cache_dir=None):
+        """
+        UndistortionEngine constructor.
+
+        params:
+            - intrinsics: default camera matrix (3x3), can be set later with set_calibration
+            - distortion: default distortion coefficients (1x5)
+            - alpha: default free scaling parameter, None keeps the original intrinsics
+            - max_cached_maps: number of map sets kept before the least recently used is dropped
+            - cache_dir: directory of an UndistortionMapCache, None to not cache maps on disk
+        """
+        self.max_cached_maps = max_cached_maps
+        self.disk_cache = UndistortionMapCache(cache_dir) if cache_dir else None
+        self._maps = OrderedDict()
+        self._buffers = {}
+        self.intrinsics = None
+        self.distortion = None
+        self.alpha = alpha
+        self._calibration_hash = None
+        if intrinsics is not None and distortion is not None:
+            self.set_calibration(intrinsics, distortion, alpha)
+
+    def set_calibration(self, intrinsics, distortion, alpha=None):
+        """
+        Sets the default calibration. Maps for the new calibration are built
+        lazily on the next frame.
+        """
+        self.intrinsics = np.asarray(intrinsics, dtype=np.float64)
+        self.distortion = np.asarray(distortion, dtype=np.float64)
+        self.alpha = alpha
+        self._calibration_hash = calibration_hash(self.intrinsics, self.distortion)
+
+    def get_maps(self, frame_size, intrinsics=None, distortion=None, alpha=None):
+        """
+        Returns the UndistortionMaps for the given frame size, building them if needed.
+
+        If intrinsics and distortion are not given, the default calibration is used.
+        """
+        if intrinsics is None or distortion is None:
+            if self._calibration_hash is None:
+                raise ValueError("No calibration set on UndistortionEngine.")
+            intrinsics, distortion = self.intrinsics, self.distortion
+            alpha = self.alpha if alpha is None else alpha
+            cal_hash = self._calibration_hash
+        else:
+            cal_hash = calibration_hash(intrinsics, distortion)
+
+        key = (cal_hash, int(frame_size[0]), int(frame_size[1]), alpha)
+        maps = self._maps.get(key)
+        if maps is None:
+            if self.disk_cache is not None:
+                maps = self.disk_cache.load(cal_hash, frame_size, alpha)
+            if maps is None:
+                LOGGER.info(f"Building undistortion maps for frame size {frame_size}, alpha {alpha}")
+                maps = UndistortionMaps(intrinsics, distortion, frame_size, alpha)
+                if self.disk_cache is not None:
+                    self.disk_cache.save(cal_hash, maps)
+            self._maps[key] = maps
+            while len(self._maps) > self.max_cached_maps:
+                self._maps.popitem(last=False)
+        else:
+            self._maps.move_to_end(key)
+        return maps
+
+    def preload(self):
+        """
+        Loads the maps cached on disk for the default calibration, for any frame
+        size, so the first frame doesn't wait for them.
+
+        returns:
+            - list of the (frame_size, alpha) loaded
+        """
+        if self.disk_cache is None or self._calibration_hash is None:
+            return []
+        keys = self.disk_cache.cached_keys(self._calibration_hash)
+        for frame_size, alpha in keys[:self.max_cached_maps]:
+            self.get_maps(frame_size, alpha=alpha)
+        return keys[:self.max_cached_maps]
+
+    def get_new_camera_matrix(self, frame_size, intrinsics=None, distortion=None, alpha=None):
+        """
+        Returns the camera matrix of the undistorted frames.
+        """
+        return self.get_maps(frame_size, intrinsics, distortion, alpha).new_camera_matrix
+
+    def _get_buffer(self, image):
+        """
+        Returns a preallocated output buffer matching the shape and type of image.
+        """
+        key = (image.shape, image.dtype.str)
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            buffer = np.empty_like(image)
+            self._buffers[key] = buffer
+        return buffer
+
+    def undistort(self, image, dst=None, intrinsics=None, distortion=None, alpha=None):
+        """
+        Undistorts image.
+
+        If dst is None, the result is written into a buffer owned by the
+        engine, which is overwritten by the next call with the same image
+        shape. Copy it if it has to outlive the frame.
+        """
+        height, width = image.shape[:2]
+        maps = self.get_maps((width, height), intrinsics, distortion, alpha)
+        if dst is None:
+            dst = self._get_buffer(image)
+        return cv2.remap(image, maps.map1, maps.map2, cv2.INTER_LINEAR, dst=dst,
+                         borderMode=cv2.BORDER_CONSTANT)
+
+
+def undistort_marker_corners(corners, intrinsics, distortion, new_camera_matrix=None):
+    """
+    Maps aruco marker corners detected on a distorted frame into the
+    undistorted frame, so they can be drawn on the undistorted image.
+
+    params:
+        - corners: tuple of (1, 4, 2) corner arrays, as returned by cv2.aruco.detectMarkers
+        - new_camera_matrix: camera matrix of the undistorted frame, [intrinsics]
+    returns:
+        - tuple of undistorted (1, 4, 2) corner arrays
+    """
+    if len(corners) == 0:
+        return corners
+    if new_camera_matrix is None:
+        new_camera_matrix = intrinsics
+    points = np.concatenate(corners).reshape((-1, 1, 2)).astype(np.float32)
+    points = cv2.undistortPoints(points, intrinsics, distortion, P=new_camera_matrix)
+    points = points.reshape((-1, 1, 4, 2))
+    return tuple(points[i] for i in range(points.shape[0]))
+
+
+_SHARED_ENGINE = None
+
+
+def get_shared_engine():
+    """
+    Returns the process wide UndistortionEngine, so that the GUI, calibration
+    and offline tools reuse the same cached maps.
+    """
+    global _SHARED_ENGINE
+    if _SHARED_ENGINE is None:
+        _SHARED_ENGINE = UndistortionEngine()
+    return _SHARED_ENGINE
+
+
+def undistort(image, intrinsics, distortion, dst=None, alpha=None):
+    """
+    Drop-in replacement for cv2.undistort(image, intrinsics, distortion)
+    that reuses cached maps from the shared engine. As with cv2.undistort,
+    the result is a new array if dst is None; use the engine directly to
+    write into its reused buffer.
+    """
+    if dst is None:
+        dst = np.empty_like(image)
+    return get_shared_engine().undistort(image, dst=dst, intrinsics=intrinsics,
+                                         distortion=distortion, alpha=alpha)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+""" Background video capture into a bounded ring buffer of timestamped frames. """
+
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+
+LOGGER = logging.getLogger(__name__)
+
+
+# index: running frame number assigned by the capture thread
+# timestamp: capture timestamp reported by the video source (datetime), if any
+# arrival_time: time.perf_counter() when the frame was read
+# image: the frame itself
+CapturedFrame = namedtuple('CapturedFrame', ['index', 'timestamp', 'arrival_time', 'image'])
+
+
+class ThreadedVideoSource:
+    """
+    Reads frames from a video source (eg. sksurgeryimage TimestampedVideoSource)
+    on its own thread and keeps the newest ones in a bounded ring buffer.
+
+    When the buffer is full the oldest frame is dropped, and read_latest()
+    always returns the newest frame without blocking, discarding any older
+    ones. Counters for captured, dropped and late frames are kept so that
+    the consumer can report them.
+
+    With drop_frames=False (eg. deterministic replay of a recording), the
+    capture thread waits for space instead, and frames are read in order.
+    """
+
+    def __init__(self, video_source, buffer_size=2, frame_rate=None, pace=False, on_frame=None,
+                 drop_frames=True):
+        """
+        ThreadedVideoSource constructor.
+
+        params:
+            - video_source: object with a read() method returning (ret, image)
+            - buffer_size: number of frames kept in the ring buffer, [2]
+            - frame_rate: expected frame rate, used to count late frames, [None]
+            - pace: if True, reads are throttled to frame_rate. Use for video files,
+                    which would otherwise be read as fast as possible. [False]
+            - on_frame: callable called on the capture thread with each new CapturedFrame, [None]
+            - drop_frames: if False, no frame is ever dropped: reads wait while the buffer is full
+                           and read_latest() returns the oldest frame, [True]
+        """
+        if buffer_size < 1:
+            raise ValueError(f"Capture buffer size must be at least 1, got {buffer_size}")
+
+        self.video = video_source
+        self.expected_interval = 1.0 / frame_rate if frame_rate else None
+        self.pace = pace and self.expected_interval is not None
+        self.on_frame = on_frame
+        self.drop_frames = drop_frames
+
+        self._buffer = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+        self._new_frame = threading.Condition(self._lock)
+        self._thread = None
+        self._running = False
+
+        self.frames_captured = 0
+        self.frames_dropped = 0
+        self.frames_late = 0
+        self.read_failures = 0
+        self._last_arrival = None
+        # capture timestamp of the newest frame, if the video source reports them
+        self.last_timestamp = None
+
+    def start(self):
+        """
+        Starts the capture thread.
+        """
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='video_capture', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the capture thread and waits for it to finish.
+        """
+        self._running = False
+        with self._new_frame:
+            self._new_frame.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+
+    def _run(self):
+        """
+        Capture loop, runs on the capture thread.
+        """
+        next_read = time.perf_counter()
+        failure_logged = False
+
+        while self._running:
+            if self.pace:
+                delay = next_read - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_read = max(next_read + self.expected_interval, time.perf_counter())
+
+            ret, image = self.video.read()
+            # sources doing work after the read (eg. recording) report when the frame arrived
+            arrival_time = getattr(self.video, 'arrival_time', None) or time.perf_counter()
+
+            if not ret:
+                self.read_failures += 1
+                if not failure_logged:
+                    LOGGER.error("Failed to read from source")
+                    failure_logged = True
+                time.sleep(0.005)
+                continue
+            failure_logged = False
+
+            frame = CapturedFrame(self.frames_captured,
+                                  getattr(self.video, 'timestamp', None),
+                                  arrival_time,
+                                  image)
+
+            with self._new_frame:
+                while not self.drop_frames and self._running and len(self._buffer) == self._buffer.maxlen:
+                    self._new_frame.wait(0.1)
+                if len(self._buffer) == self._buffer.maxlen:
+                    self.frames_dropped += 1
+                self._buffer.append(frame)
+                self.frames_captured += 1
+                if self._last_arrival is not None and self.expected_interval is not None:
+                    if arrival_time - self._last_arrival > 1.5 * self.expected_interval:
+                        self.frames_late += 1
+                self._last_arrival = arrival_time
+                self.last_timestamp = frame.timestamp
+                self._new_frame.notify_all()
+
+            if self.on_frame is not None:
+                self.on_frame(frame)
+
+    def read_latest(self, timeout=0.0):
+        """
+        Returns the newest CapturedFrame and discards older ones, or the
+        oldest one if drop_frames is False.
+
+        params:
+            - timeout: seconds to wait for a frame if the buffer is empty, [0, don't wait]
+        returns:
+            - CapturedFrame, or None if no new frame is available
+        """
+        with self._new_frame:
+            if not self._buffer and timeout > 0:
+                self._new_frame.wait(timeout)
+            if not self._buffer:
+                return None
+            if not self.drop_frames:
+                frame = self._buffer.popleft()
+                self._new_frame.notify_all()
+                return frame
+            frame = self._buffer.pop()
+            self.frames_dropped += len(self._buffer)
+            self._buffer.clear()
+        return frame
+
+    def capture_progress(self):
+        """
+        Returns the number of frames captured and the capture timestamp of the
+        newest one (None if the source doesn't report them), read together.
+        """
+        with self._new_frame:
+            return self.frames_captured, self.last_timestamp
+
+    def frames_buffered(self):
+        """
+        Returns the number of frames captured and not read yet.
+        """
+        with self._new_frame:
+            return len(self._buffer)
+
+    def read(self):
+        """
+        Same interface as TimestampedVideoSource.read(), but never blocks.
+        """
+        frame = self.read_latest()
+        if frame is None:
+            return False, None
+        return True, frame.image
+
+    def get_stats(self):
+        """
+        Returns the capture counters as a dict.
+        """
+        return {'frames_captured': self.frames_captured,
+                'frames_dropped': self.frames_dropped,
+                'frames_late': self.frames_late,
+                'read_failures': self.read_failures}